@@ -0,0 +1,145 @@
+# encoding:utf-8
+"""
+插件整体的基准测试：通过收消息入口写入合成的群聊流量，大模型换成固定耗时的假实现，测量
+- 写入吞吐(条/秒)
+- 数据库达到不同规模时 get_records 各类查询的延迟
+- 从发出总结指令到收到图片的端到端延迟
+- 进程的峰值内存
+
+    python benchmarks/bench_pipeline.py --sizes 10000 50000 200000 --llm-latency 0.5 --output pipeline.json
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import (FakeChannel, FakeLLM, TrafficGenerator, bootstrap, create_plugin, make_event,  # noqa: E402
+                     peak_rss_mb, percentiles, write_results)
+
+bootstrap()
+
+
+def ingest(plugin, messages, count: int) -> dict:
+    """把count条消息交给收消息入口，直到全部落盘"""
+    start = time.perf_counter()
+    written = 0
+    for group, user, content, msg_id, timestamp in messages:
+        plugin.on_receive_message(make_event(content, group, user, msg_id, timestamp))
+        written += 1
+        if written >= count:
+            break
+    plugin.db.flush()
+    elapsed = time.perf_counter() - start
+    return {"messages": written, "seconds": round(elapsed, 3), "msgs_per_sec": round(written / elapsed, 1)}
+
+
+def query_latency(db, traffic: TrafficGenerator, now: int, repeat: int) -> dict:
+    """最活跃、中等和最冷清的群上各类查询的延迟"""
+    results = {}
+    for label, group in (("hot", traffic.groups[0]), ("median", traffic.groups[len(traffic.groups) // 2]),
+                         ("cold", traffic.groups[-1])):
+        user = traffic.users[group][0]
+        queries = {
+            "latest_500": dict(limit=500),
+            "last_3h": dict(start_timestamp=now - 3 * 3600),
+            "keyword": dict(keywords=[traffic.topics[group][0]], limit=500),
+            "user": dict(username=[user]),
+        }
+        for name, kwargs in queries.items():
+            samples = []
+            rows = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rows = len(db.get_records(group, **kwargs))
+                samples.append(time.perf_counter() - start)
+            results["{}.{}".format(label, name)] = dict(percentiles(samples), rows=rows)
+    return results
+
+
+def summary_latency(plugin, channel: FakeChannel, traffic: TrafficGenerator, command: str, count: int,
+                    timeout: float) -> dict:
+    """依次在不同的群发出总结指令，从指令到收到最终回复的耗时"""
+    samples = []
+    failures = 0
+    for index in range(min(count, len(traffic.groups))):
+        group = traffic.groups[index]
+        event = make_event(command, group, "群主", "summary-{}".format(index), int(time.time()), channel)
+        start = time.perf_counter()
+        # 和框架一样，指令先经过收消息入口再交给处理入口
+        plugin.on_receive_message(event)
+        plugin.on_handle_context(event)
+        reply = event.get("reply")
+        if reply is not None and reply.type.name == "IMAGE":
+            # 已有报告时直接回复，不经过通道
+            result = time.perf_counter(), reply
+        else:
+            result = channel.wait_result(event["context"], timeout)
+        if result is None or result[1].type.name != "IMAGE":
+            failures += 1
+            continue
+        samples.append(result[0] - start)
+    return dict(percentiles(samples), failures=failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000],
+                        help="依次把数据库写到这些规模，每个规模测一次查询延迟")
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--users", type=int, default=80, help="每个群最多的发言人数")
+    parser.add_argument("--hours", type=float, default=48, help="消息分布在最近多少小时内")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20, help="每个查询重复的次数")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="假大模型每次调用的耗时(单位秒)")
+    parser.add_argument("--summaries", type=int, default=5, help="端到端测试的总结次数，每次用不同的群")
+    parser.add_argument("--command", default="$总结 3 小时内消息")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="结果JSON文件")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="summary-bench-")
+    llm = FakeLLM(latency=args.llm_latency)
+    channel = FakeChannel()
+    results = {"config": vars(args), "ingest": [], "get_records": {}}
+    try:
+        start = time.perf_counter()
+        plugin = create_plugin(data_dir, llm, rate_limit_summary=0, save_time=-1, db_shards=args.shards)
+        plugin.db.wait_migrations()
+        results["startup_seconds"] = round(time.perf_counter() - start, 3)
+
+        traffic = TrafficGenerator(groups=args.groups, users_per_group=args.users, seed=args.seed)
+        now = int(time.time())
+        sizes = sorted(args.sizes)
+        messages = traffic.messages(sizes[-1], now - int(args.hours * 3600), now)
+        written = 0
+        for size in sizes:
+            result = ingest(plugin, messages, size - written)
+            written += result["messages"]
+            results["ingest"].append(dict(result, total=written, peak_rss_mb=peak_rss_mb()))
+            print("ingest  {total:>8} records  {msgs_per_sec:>8.0f} msgs/s".format(**results["ingest"][-1]))
+            latency = query_latency(plugin.db, traffic, now, args.repeat)
+            results["get_records"][str(written)] = latency
+            for name, item in latency.items():
+                print("  {:<20} p50 {:>8.2f}ms  p95 {:>8.2f}ms  rows {}".format(name, item["p50_ms"], item["p95_ms"],
+                                                                              item["rows"]))
+
+        calls = llm.calls
+        results["summary"] = summary_latency(plugin, channel, traffic, args.command, args.summaries, args.timeout)
+        results["summary"]["llm_calls"] = llm.calls - calls
+        print("summary p50 {p50_ms:.0f}ms  p95 {p95_ms:.0f}ms  failures {failures}".format(
+            **dict({"p50_ms": 0, "p95_ms": 0}, **results["summary"])))
+        results["peak_rss_mb"] = peak_rss_mb()
+        print("peak rss {}MB".format(results["peak_rss_mb"]))
+        plugin.db.close()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    if args.output:
+        write_results(args.output, "pipeline", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# encoding:utf-8
+"""
+分库写入吞吐的基准测试：多个线程同时为不同的群写入消息，比较不同分库数量下每秒落盘的消息数。
+
+    python benchmarks/bench_sharding.py --messages 200000 --shards 1 2 4 8 --output sharding.json
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import bootstrap, write_results  # noqa: E402
+
+bootstrap()
+
+from plugins.plugin_summary.db import Db  # noqa: E402
+from plugins.plugin_summary.sharded_db import ShardedDb  # noqa: E402
+
+WORDS = "今天 部署 新版本 服务器 又挂了 中午 吃什么 周末 开黑 这个 需求 明天 上线 哈哈哈 收到 好的".split()
+
+
+def make_message(rng: random.Random) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+
+
+def run(shards: int, messages: int, groups: int, threads: int, batch_size: int) -> dict:
+    directory = tempfile.mkdtemp(prefix="summary-bench-")
+    try:
+        if shards > 1:
+            db = ShardedDb(directory, shards=shards, batch_size=batch_size)
+        else:
+            db = Db(os.path.join(directory, "chat.db"), batch_size=batch_size)
+        db.wait_migrations()
+        per_thread = messages // threads
+        base = int(time.time()) - 86400
+
+        def writer(worker: int):
+            rng = random.Random(worker)
+            # 每个线程负责一部分群，模拟不同群的消息由不同线程收到
+            own_groups = ["group-{}".format(g) for g in range(worker, groups, threads)] or ["group-0"]
+            for i in range(per_thread):
+                db.insert_record(rng.choice(own_groups), "{}-{}".format(worker, i), "user-{}".format(rng.randint(0, 50)),
+                                 make_message(rng), "TEXT", base + i, 0)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        db.flush()
+        elapsed = time.perf_counter() - start
+        db.close()
+        total = per_thread * threads
+        return {"shards": shards, "messages": total, "seconds": round(elapsed, 3),
+                "msgs_per_sec": round(total / elapsed, 1)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--groups", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--output", help="结果JSON文件")
+    args = parser.parse_args()
+
+    results = []
+    for shards in args.shards:
+        result = run(shards, args.messages, args.groups, args.threads, args.batch_size)
+        results.append(result)
+        print("shards={shards:<3} {messages} msgs in {seconds:.2f}s  {msgs_per_sec:.0f} msgs/s".format(**result))
+    if args.output:
+        write_results(args.output, "sharding", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+# encoding:utf-8
+"""
+基准测试的运行环境。
+在 chatgpt-on-wechat 中运行时使用真实的框架模块；单独检出插件仓库运行时，为插件依赖的框架模块注册最小的替身。
+插件的 __init__ 会导入整个插件和框架，这里不经过它，直接按 plugins.plugin_summary.xxx 加载各个模块。
+大模型和消息通道总是替换为本地的假实现，结果只取决于插件自身的代码。
+"""
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import types
+from enum import Enum
+from unittest import mock
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bootstrap():
+    try:
+        import common.log  # noqa: F401
+    except ImportError:
+        logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+        _register_module("common")
+        _register_module("common.log", logger=logging.getLogger("summary-bench"))
+        _register_module("common.const")
+
+    try:
+        import bridge.context  # noqa: F401
+    except ImportError:
+        _register_framework()
+
+    if "plugins.plugin_summary" not in sys.modules:
+        try:
+            import plugins
+        except ImportError:
+            plugins = _register_module("plugins")
+        package = types.ModuleType("plugins.plugin_summary")
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules["plugins.plugin_summary"] = package
+        plugins.plugin_summary = package
+
+
+def _register_module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__path__ = []
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if "." in name:
+        parent, child = name.rsplit(".", 1)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# 框架的最小替身，只实现插件用到的部分
+class _ContextType(Enum):
+    TEXT = 1
+    VOICE = 2
+    IMAGE = 3
+
+    def __str__(self):
+        return self.name
+
+
+class _Context(dict):
+    def __init__(self, type=None, content=None, kwargs=None):
+        super().__init__(kwargs or {})
+        self.type = type
+        self.content = content
+
+
+class _ReplyType(Enum):
+    TEXT = 1
+    VOICE = 2
+    IMAGE = 3
+    INFO = 9
+    ERROR = 10
+
+
+class _Reply:
+    def __init__(self, type=None, content=None):
+        self.type = type
+        self.content = content
+
+
+class _Event(Enum):
+    ON_RECEIVE_MESSAGE = 1
+    ON_HANDLE_CONTEXT = 2
+    ON_DECORATE_REPLY = 3
+    ON_SEND_REPLY = 4
+
+
+class _EventAction(Enum):
+    CONTINUE = 1
+    BREAK = 2
+    BREAK_PASS = 3
+
+
+class _EventContext:
+    def __init__(self, event=None, econtext=None):
+        self.event = event
+        self.econtext = econtext or {}
+        self.action = _EventAction.CONTINUE
+
+    def __getitem__(self, key):
+        return self.econtext[key]
+
+    def __setitem__(self, key, value):
+        self.econtext[key] = value
+
+    def get(self, key, default=None):
+        return self.econtext.get(key, default)
+
+
+class _Plugin:
+    def __init__(self):
+        self.handlers = {}
+
+    def load_config(self):
+        return None
+
+
+class _ChatMessage:
+    def __init__(self, _rawmsg=None):
+        self._rawmsg = _rawmsg
+        self.msg_id = None
+        self.create_time = None
+        self.from_user_id = None
+        self.from_user_nickname = None
+        self.actual_user_id = None
+        self.actual_user_nickname = None
+        self.is_at = False
+
+
+class _Bridge:
+    def __init__(self):
+        self.btype = {"chat": "fake"}
+
+
+class _Util:
+    @staticmethod
+    def is_admin(e_context) -> bool:
+        return False
+
+
+def _check_prefix(content, prefix_list):
+    for prefix in prefix_list or []:
+        if content.startswith(prefix):
+            return prefix
+    return None
+
+
+def _check_contain(content, keyword_list):
+    for keyword in keyword_list or []:
+        if content.find(keyword) != -1:
+            return True
+    return None
+
+
+_FRAMEWORK_CONFIG = {"channel_type": "wx", "plugin_trigger_prefix": "$"}
+
+
+def _register_framework():
+    plugins = _register_module("plugins", Event=_Event, EventAction=_EventAction, EventContext=_EventContext,
+                               Plugin=_Plugin, register=lambda **kwargs: (lambda cls: cls))
+    plugins.__all__ = ["Event", "EventAction", "EventContext", "Plugin", "register"]
+    _register_module("plugins.linkai")
+    _register_module("plugins.linkai.utils", Util=_Util)
+    _register_module("bridge")
+    _register_module("bridge.context", ContextType=_ContextType, Context=_Context)
+    _register_module("bridge.reply", ReplyType=_ReplyType, Reply=_Reply)
+    _register_module("bridge.bridge", Bridge=_Bridge)
+    _register_module("bot")
+    _register_module("bot.bot_factory", create_bot=lambda bot_type: FakeLLM())
+    _register_module("channel")
+    _register_module("channel.chat_channel", check_prefix=_check_prefix, check_contain=_check_contain)
+    _register_module("channel.chat_message", ChatMessage=_ChatMessage)
+    _register_module("config", conf=lambda: _FRAMEWORK_CONFIG)
+
+
+class FakeLLM:
+    """
+    确定性的假大模型：按请求内容的哈希生成固定格式的报告，每次调用等待latency秒模拟网络和推理耗时。
+    接口与框架中bot的sessions/reply_text一致。
+    """
+
+    def __init__(self, latency: float = 0.0, tokens_per_second: float = 0):
+        """
+        :param latency: 每次调用的固定耗时(单位秒)
+        :param tokens_per_second: 按prompt长度额外增加的耗时，0表示不增加
+        """
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.sessions = _FakeSessions()
+        self.calls = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def reply_text(self, session) -> dict:
+        query = session.queries[-1] if session.queries else ""
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += len(query)
+        delay = self.latency + (len(query) / self.tokens_per_second if self.tokens_per_second else 0)
+        if delay > 0:
+            time.sleep(delay)
+        if '"name"' in (session.system_prompt or ""):
+            # 指令解析
+            return {"total_tokens": 50, "completion_tokens": 20,
+                    "content": '{"name": "summary", "args": {"count": 500}}'}
+        seed = int(hashlib.md5(query.encode("utf-8")).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        sections = []
+        for index in range(rng.randint(3, 6)):
+            words = rng.sample(TOPIC_WORDS, 3)
+            sections.append("{}️⃣ 话题：{} 🔥\n参与者：{}\n时间段：10:00-11:30\n过程：{}\n评价：热烈"
+                            .format(index + 1, words[0], "、".join("用户{}".format(rng.randint(1, 99)) for _ in range(3)),
+                                    "，".join(words) * 3))
+        content = "本群整体风格：活跃\n------------\n" + "\n------------\n".join(sections)
+        return {"total_tokens": len(query) + len(content), "completion_tokens": len(content), "content": content}
+
+
+class _FakeSession:
+    def __init__(self, session_id, system_prompt=None):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        self.queries = []
+
+    def add_query(self, query):
+        self.queries.append(query)
+
+
+class _FakeSessions:
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def build_session(self, session_id, system_prompt=None):
+        with self._lock:
+            session = _FakeSession(session_id, system_prompt)
+            self._sessions[session_id] = session
+            return session
+
+    def clear_session(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class FakeChannel:
+    """记录插件发出的回复，可以等待某条指令的最终结果"""
+
+    # 总结过程中的进度通知，不算最终结果
+    PROGRESS_RE = re.compile(r"请稍等|总结进度|正在生成")
+
+    def __init__(self):
+        self.replies = []
+        self._cond = threading.Condition()
+
+    def send(self, reply, context):
+        with self._cond:
+            self.replies.append((time.perf_counter(), id(context), reply))
+            self._cond.notify_all()
+
+    def wait_result(self, context, timeout: float = 300):
+        """等待context的最终回复，返回(时间, 回复)，超时返回None"""
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while True:
+                for sent, context_id, reply in self.replies:
+                    if context_id == id(context) and not (isinstance(reply.content, str)
+                                                          and self.PROGRESS_RE.search(reply.content)):
+                        return sent, reply
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+def create_plugin(data_dir: str, llm: FakeLLM, **overrides):
+    """
+    创建插件实例，配置为 config.json.template 加上overrides，数据库、回复缓存和渲染缓存放在data_dir，大模型替换为llm
+    """
+    import plugins.plugin_summary.main as plugin_main
+    from plugins.plugin_summary.replies import ReplyPool
+    from plugins.plugin_summary.sharded_db import create_db
+
+    with open(os.path.join(PLUGIN_DIR, "config.json.template"), encoding="utf-8") as f:
+        config = json.load(f)
+    config["render_cache_dir"] = os.path.join(data_dir, "render_cache")
+    config.update(overrides)
+    with mock.patch.object(plugin_main.Plugin, "load_config", lambda self: config), \
+            mock.patch.object(plugin_main, "create_db",
+                              lambda config, directory, *args: create_db(config, data_dir, *args)), \
+            mock.patch.object(plugin_main, "ReplyPool",
+                              lambda path, **kwargs: ReplyPool(os.path.join(data_dir, os.path.basename(path)),
+                                                               **kwargs)):
+        plugin = plugin_main.Summary()
+    # 大模型客户端在第一次用到时才创建，直接换成假实现
+    plugin._bot = llm
+    return plugin
+
+
+def make_event(text: str, group: str, user: str, msg_id, create_time: int, channel: FakeChannel = None):
+    """构造一条群消息的事件，真实框架和替身都可以用"""
+    from bridge.context import Context, ContextType
+    from channel.chat_message import ChatMessage
+    from plugins import EventContext
+
+    msg = ChatMessage.__new__(ChatMessage)
+    msg.__dict__.update(msg_id=msg_id, create_time=create_time, from_user_id="@@" + group,
+                        from_user_nickname=group, actual_user_id="@" + user, actual_user_nickname=user,
+                        is_at=False, to_user_id="@bot", to_user_nickname="bot", other_user_id="@@" + group,
+                        other_user_nickname=group, is_group=True)
+    context = Context(ContextType.TEXT, text, {"isgroup": True, "msg": msg, "session_id": group})
+    return EventContext(None, {"context": context, "channel": channel})
+
+
+TOPIC_WORDS = ("部署 新版本 服务器 回滚 数据库 索引 慢查询 周报 需求评审 上线 测试环境 告警 值班 "
+               "午饭 火锅 奶茶 减肥 健身房 周末 爬山 电影 游戏 开黑 排位 基金 股票 房价 通勤 地铁 下雨 "
+               "猫咪 狗狗 搬家 装修 相亲 考试 论文 导师 面试 跳槽 工资 年终奖").split()
+_FILLERS = ("哈哈哈", "笑死", "确实", "[捂脸]", "+1", "好的", "收到", "6666", "草", "？？？")
+_TAILS = ("吧", "啊", "了", "呢", "吗", "！", "。", "…", "", "")
+
+
+class TrafficGenerator:
+    """
+    合成的群聊流量：群的活跃度和群内发言人都服从长尾分布，每个群有随时间漂移的话题，
+    夹杂短回复、复读、@提及和长粘贴。相同的seed生成相同的数据。
+    """
+
+    def __init__(self, groups: int = 50, users_per_group: int = 80, seed: int = 0, skew: float = 1.2):
+        self.rng = random.Random(seed)
+        self.groups = ["测试群{:03d}".format(index) for index in range(groups)]
+        self.group_weights = [1 / (rank + 1) ** skew for rank in range(groups)]
+        self.users = {group: ["成员{}_{}".format(index, self.rng.randint(100, 999))
+                              for index in range(self.rng.randint(max(users_per_group // 4, 2), users_per_group))]
+                      for group in self.groups}
+        self.topics = {group: self.rng.sample(TOPIC_WORDS, 3) for group in self.groups}
+        self._msg_id = 0
+
+    def messages(self, count: int, start: int, end: int):
+        """按时间顺序产出count条 (group, user, content, msg_id, timestamp)，时间均匀分布在[start, end)"""
+        step = (end - start) / max(count, 1)
+        groups = self.rng.choices(self.groups, weights=self.group_weights, k=count)
+        for index, group in enumerate(groups):
+            self._msg_id += 1
+            yield group, self._pick_user(group), self._content(group), self._msg_id, int(start + index * step)
+
+    def _pick_user(self, group: str) -> str:
+        users = self.users[group]
+        # 少数人贡献大部分发言
+        return users[min(int(self.rng.paretovariate(1.2)) - 1, len(users) - 1)]
+
+    def _content(self, group: str) -> str:
+        rng = self.rng
+        if rng.random() < 0.02:
+            # 话题漂移
+            self.topics[group][rng.randrange(3)] = rng.choice(TOPIC_WORDS)
+        roll = rng.random()
+        if roll < 0.2:
+            return rng.choice(_FILLERS)
+        words = [rng.choice(self.topics[group]) if rng.random() < 0.7 else rng.choice(TOPIC_WORDS)
+                 for _ in range(rng.randint(1, 5))]
+        text = "".join(word + rng.choice(_TAILS) for word in words)
+        if roll > 0.995:
+            text = (text + "，") * rng.randint(20, 60)
+        elif roll > 0.97:
+            text = "@{} {}".format(rng.choice(self.users[group]), text)
+        return text
+
+
+def peak_rss_mb() -> float:
+    """进程到目前为止的最大常驻内存(MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位是KB，macOS上是字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentiles(samples: list) -> dict:
+    """耗时样本的p50/p95/最大值(单位毫秒)"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 2)
+
+    return {"count": len(ordered), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def write_results(path: str, name: str, results):
+    """把结果连同运行环境写成JSON，便于不同提交之间比较"""
+    data = {
+        "benchmark": name,
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
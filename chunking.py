@@ -0,0 +1,92 @@
+# encoding:utf-8
+"""
+按token预算切分聊天记录，供分段总结使用
+"""
+import re
+import time
+from typing import Iterable, List, NamedTuple, Tuple
+
+CJK_RE = re.compile(r"[⺀-鿿豈-﫿＀-￯\U00020000-\U0002fa1f]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符按1个token，其余字符按4个字符1个token"""
+    if not text:
+        return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_into_chunks(lines: Iterable[str], max_tokens: int) -> List[str]:
+    """
+    把多行文本按顺序拼成若干段，每段不超过max_tokens，单行超长时单独成段
+
+    :param lines: 按时间顺序排列的聊天记录行
+    :param max_tokens: 每段的token上限
+    :return: 拼接好的文本段
+    """
+    chunks = []
+    current, current_tokens = [], 0
+    for line in lines:
+        tokens = estimate_tokens(line) + 1
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class ChatLogs(NamedTuple):
+    # 按时间正序排列的聊天记录行
+    lines: List[str]
+    # 使用的记录条数
+    rows: int
+    # 估算的token数
+    tokens: int
+    # 最新一条记录的时间戳
+    newest: int
+    # 是否因为超出预算截断了更早的记录
+    truncated: bool
+    # 因为超出预算被丢弃的记录条数和token数
+    dropped_rows: int = 0
+    dropped_tokens: int = 0
+    # 和lines一一对应的 (发言人列表, 时间戳, 内容)，供话题预分组使用
+    messages: list = None
+    # lines是否已经按话题整理过
+    grouped: bool = False
+    # 读取到的最早一条记录的时间戳
+    oldest: int = 0
+
+
+def build_chat_logs(records: Iterable[Tuple[str, int, str]], token_budget: int) -> ChatLogs:
+    """
+    从按时间倒序的 (user, timestamp, content) 记录流构建聊天记录行，
+    累计token超出预算即停止读取，内存占用只和预算有关
+
+    :param records: 按时间倒序的记录，可以是数据库游标上的生成器
+    :param token_budget: token预算，<=0 表示不限制
+    """
+    lines = []
+    messages = []
+    tokens = 0
+    newest = 0
+    truncated = False
+    for user, timestamp, content in records:
+        create_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(timestamp)))
+        line = f"{user}({create_time}): {content}"
+        line_tokens = estimate_tokens(line) + 1
+        if token_budget > 0 and lines and tokens + line_tokens > token_budget:
+            truncated = True
+            break
+        if not lines:
+            newest = int(timestamp)
+        lines.append(line)
+        messages.append(([user], int(timestamp), content))
+        tokens += line_tokens
+    lines.reverse()
+    messages.reverse()
+    oldest = messages[0][1] if messages else 0
+    return ChatLogs(lines, len(lines), tokens, newest, truncated, messages=messages, oldest=oldest)
@@ -0,0 +1,117 @@
+# encoding:utf-8
+"""
+总结指令的本地解析，识别数量和时间范围，例如"前九十九条"、"3小时内"、"last 50 messages"。
+无法完全识别的指令返回None，由调用方交给大模型解析。
+"""
+import re
+import time
+import unicodedata
+from typing import Optional, Tuple
+
+_CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4,
+              "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_CN_UNITS = {"十": 10, "百": 100, "千": 1000, "万": 10000}
+
+_NUM = r"[0-9]+(?:\.[0-9]+)?|[0-9零〇一二两三四五六七八九十百千万]+"
+
+# 时间单位，长的写法放前面避免被短的抢先匹配
+_DURATION_UNITS = (
+    (("秒钟", "秒", "seconds", "second", "secs", "sec", "s"), 1),
+    (("分钟", "分", "minutes", "minute", "mins", "min", "m"), 60),
+    (("小时", "钟头", "hours", "hour", "hrs", "hr", "h"), 3600),
+    (("天", "日", "days", "day", "d"), 86400),
+    (("星期", "礼拜", "周", "weeks", "week", "w"), 604800),
+)
+_UNIT_SECONDS = {name: seconds for names, seconds in _DURATION_UNITS for name in names}
+_UNIT_PATTERN = "|".join(sorted(_UNIT_SECONDS, key=len, reverse=True))
+
+_DURATION_RE = re.compile(r"(?P<num>{num})?(?P<ge>个)?(?P<half>半)?(?P<unit>{unit})(?![a-z])(?P<tail_half>半)?"
+                          .format(num=_NUM, unit=_UNIT_PATTERN))
+_TODAY_RE = re.compile(r"今天|今日|today")
+_COUNT_RE = re.compile(r"(?:前|最近|最新|last|latest|recent|top)?(?P<num>{num})"
+                       r"(?:条|句|个|messages|message|msgs|msg|records|record|lines|line)".format(num=_NUM))
+_BARE_NUM_RE = re.compile(r"(?:前|最近|最新|last|latest|recent|top)?(?P<num>{num})".format(num=_NUM))
+_FILLER_RE = re.compile(r"\$?总结|summarize|summary|帮我|请|一下|所有|全部|最近|最新|以内|之内|内|里|中|的|前|"
+                        r"群聊天|群聊|群里|聊天|记录|消息|信息|内容|chat|logs|log|messages|message|records|"
+                        r"within|in|the|last|past|of|for|and|with|[,，。.!！?？、:：]")
+
+
+def chinese_to_number(text: str) -> Optional[float]:
+    """把阿拉伯数字、中文数字及其混写(如"3千")转换为数值，无法识别返回None"""
+    if not text:
+        return None
+    try:
+        return float(text) if "." in text else int(text)
+    except ValueError:
+        pass
+    total, section, number = 0, 0, 0
+    for ch in text:
+        if ch.isdigit():
+            number = number * 10 + int(ch)
+        elif ch in _CN_DIGITS:
+            number = _CN_DIGITS[ch]
+        elif ch in _CN_UNITS:
+            unit = _CN_UNITS[ch]
+            if unit == 10000:
+                total += (section + number) * unit
+                section = 0
+            else:
+                section += (number or 1) * unit
+            number = 0
+        else:
+            return None
+    return total + section + number
+
+
+def normalize_command(text: str) -> str:
+    """统一全角半角、大小写并去掉空白，作为解析输入和缓存key"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", "", text)
+
+
+def parse_summary_command(text: str, now: float = None) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """
+    解析总结指令中的数量和时间范围
+
+    :param text: 去掉@用户后的指令内容，例如"$总结 3小时内的前99条消息"
+    :param now: 当前时间戳，计算"今天"时使用
+    :return: (消息数量, 时间范围(秒))，未提供的项为None；存在无法识别的内容时返回None
+    """
+    rest = normalize_command(text)
+    count, duration = None, None
+
+    match = _TODAY_RE.search(rest)
+    if match:
+        now = now or time.time()
+        duration = int(now - time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1)))
+        rest = rest[:match.start()] + rest[match.end():]
+    else:
+        # 单独的"天"、"h"等可能是别的词的一部分(如"聊天")，取第一个带数字或多字单位的匹配
+        match = next((match for match in _DURATION_RE.finditer(rest)
+                      if match.group("num") or match.group("half") or len(match.group("unit")) > 1), None)
+        if match:
+            number = chinese_to_number(match.group("num")) if match.group("num") else 0
+            if number is None:
+                return None
+            if match.group("half") or match.group("tail_half"):
+                number += 0.5
+            duration = int(number * _UNIT_SECONDS[match.group("unit")])
+            rest = rest[:match.start()] + rest[match.end():]
+
+    match = _COUNT_RE.search(rest)
+    if match:
+        count = chinese_to_number(match.group("num"))
+        rest = rest[:match.start()] + rest[match.end():]
+    else:
+        # "$总结 100"、"最近100" 这类只有数字的写法
+        remaining = _FILLER_RE.sub("", rest)
+        match = _BARE_NUM_RE.fullmatch(remaining)
+        if match:
+            count = chinese_to_number(match.group("num"))
+            rest = ""
+
+    if _FILLER_RE.sub("", rest):
+        return None
+    if count is not None:
+        count = int(count) or None
+    return count, duration or None
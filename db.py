@@ -7,160 +7,1072 @@
 @description  sqlite操作
 @Copyright (c) 2022 by sineom, All Rights Reserved.
 """
-import datetime
+import atexit
 import os
 import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
 
 from common.log import logger
+from plugins.plugin_summary.chunking import CJK_RE
+from plugins.plugin_summary.metrics import SIZE_BUCKETS
+
+
+# 连接参数：WAL模式下读写互不阻塞，synchronous=NORMAL 在WAL下只在checkpoint时fsync
+SQLITE_PRAGMAS = (
+    ("synchronous", "NORMAL"),
+    ("cache_size", -32000),  # 负数表示KB，约32MB页缓存
+    ("mmap_size", 256 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", 5000),
+    # INSERT OR REPLACE 替换旧行时也要触发删除触发器，保持全文索引同步
+    ("recursive_triggers", "ON"),
+)
+
+
+def segment_text(text: str) -> str:
+    """全文索引分词：中文按单字切开，其余交给unicode61按单词切分，查询时用短语匹配连续的字"""
+    if not text:
+        return ""
+    return CJK_RE.sub(lambda m: " " + m.group(0) + " ", text)
+
+
+def content_text(value):
+    """读取聊天内容，版本6之后较长的内容以zlib压缩后的BLOB存储"""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def compress_text(text, threshold: int):
+    """超过threshold字节且压缩后确实变小的内容压缩为BLOB，其余原样存为TEXT"""
+    if not text or threshold <= 0:
+        return text
+    data = text.encode("utf-8")
+    if len(data) < threshold:
+        return text
+    compressed = zlib.compress(data)
+    return compressed if len(compressed) < len(data) else text
+
+
+def build_match_query(keywords: list) -> str:
+    """把关键词列表转换为FTS5查询，多个关键词之间为或的关系"""
+    phrases = []
+    for keyword in keywords:
+        tokens = segment_text(keyword).split()
+        if tokens:
+            phrases.append('"' + " ".join(tokens).replace('"', '""') + '"')
+    return " OR ".join(phrases)
 
 
 class Db:
-    def __init__(self):
-        curdir = os.path.dirname(__file__)
-        db_path = os.path.join(curdir, "chat.db")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS chat_records
+    # 数据库结构版本，修改表结构时在末尾追加迁移方法，版本号记录在 PRAGMA user_version 中
+    # 第三项为True的是在线迁移：放到后台线程分批执行，执行期间插件照常读写旧表
+    MIGRATIONS = (
+        (1, "_migrate_base_tables", False),
+        (2, "_migrate_session_time_index", True),
+        (3, "_migrate_integer_timestamp", True),
+        (4, "_migrate_full_text_index", True),
+        (5, "_migrate_activity_rollups", True),
+        (6, "_migrate_interned_records", True),
+        (7, "_migrate_digests", False),
+        (8, "_migrate_digest_position", False),
+        (9, "_migrate_null_users", False),
+    )
+    # 在线迁移每批搬运的行数，以及每批之间让出写锁的时间
+    MIGRATION_CHUNK_SIZE = 5000
+    MIGRATION_PAUSE = 0.05
+    # 过期清理每批之间让出写锁的时间
+    PURGE_PAUSE = 0.02
+    # chat_records 的列，读写都显式指定列名，兼容迁移前后的表结构
+    RECORD_COLUMNS = "sessionid, msgid, user, content, type, timestamp, is_triggered"
+    # 活跃度汇总表按小时分桶
+    ACTIVITY_BUCKET = 3600
+    # 版本6之后会话、用户和消息类型存为整数ID：原列名 -> (chat_records中的列, 名称表)
+    INTERN_TABLES = {
+        "sessionid": ("session", "chat_session_ids"),
+        "user": ("user", "chat_user_ids"),
+        "type": ("type", "chat_type_ids"),
+    }
+    INTERNED_COLUMNS = "session, msgid, user, content, type, timestamp, is_triggered"
+
+    def __init__(self, db_path: str = None, batch_size: int = 200, flush_interval: float = 1.0,
+                 queue_size: int = 10000, compress_threshold: int = 256, metrics=None):
+        """
+        :param db_path: 数据库文件路径，默认为插件目录下的chat.db
+        :param batch_size: 写缓冲区累计多少条消息后批量落盘
+        :param flush_interval: 写缓冲区最长多少秒落盘一次
+        :param queue_size: 写缓冲区上限，超过后写入方会等待后台线程落盘
+        :param compress_threshold: 聊天内容超过多少字节时压缩存储，<=0表示不压缩
+        :param metrics: 记录批量写库的条数和耗时，None表示不记录
+        """
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), "chat.db")
+        # 每个线程一个连接，读连接之间以及读写之间都不共享游标和事务
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        # SQLite同一时间只允许一个写事务，进程内的写操作在这里排队
+        self._write_lock = threading.RLock()
+        self._closed = False
+        self._migration_thread = None
+        # 在线建索引期间为True，见_migrate_session_time_index
+        self._building_index = False
+        self.compress_threshold = compress_threshold
+        self.metrics = metrics
+        # 名称到整数ID的缓存，只在写入事务提交后更新
+        self._intern_cache = {table: {} for _, table in self.INTERN_TABLES.values()}
+
+        conn = self.conn
+        # 只对新建的库生效，已有的库需要完整VACUUM才能切换，这里不做(全文索引依赖chat_records的rowid不变)
+        self._fetchone(conn, "PRAGMA auto_vacuum=INCREMENTAL")
+        self._fetchone(conn, "PRAGMA journal_mode=WAL")
+        self._migrate()
+
+        # 禁用的群聊和上次总结时间常驻内存，收消息和总结请求时直接查字典，修改时先写库再更新内存
+        # 两者都只整体替换、不原地修改，其他线程读到的总是一致的快照
+        self.disable_group = self._get_summary_stop()
+        self._summary_times = self._get_summary_times()
+
+        # 写缓冲区：消息先进内存队列，由后台线程批量写入
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = max(float(flush_interval), 0.05)
+        self.queue_size = max(int(queue_size), self.batch_size)
+        self._pending = []
+        self._pending_cond = threading.Condition()
+        self._writer = threading.Thread(target=self._writer_loop, name="summary-db-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered=0):
+        """写入一条聊天记录，实际写库由后台线程批量完成"""
+        logger.debug("[Summary] insert record: {} {} {} {} {} {} {}".format(session_id, msg_id, user, content, msg_type,
+                                                                         timestamp, is_triggered))
+        row = (session_id, msg_id, user, content, msg_type, int(timestamp), is_triggered)
+        with self._pending_cond:
+            closed = self._closed
+            if closed:
+                self._pending.append(row)
+        if closed:
+            # 已关闭时直接同步写入，避免丢消息
+            self.flush()
+            return
+        with self._pending_cond:
+            # 缓冲区满了就等待后台线程落盘，形成背压
+            while len(self._pending) >= self.queue_size:
+                self._pending_cond.notify_all()
+                self._pending_cond.wait(self.flush_interval)
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._pending_cond.notify_all()
+
+    def flush(self):
+        """把写缓冲区中的消息立即写入数据库"""
+        # 持有写锁直到写完，保证flush返回时之前的消息都已可查
+        with self._write_lock:
+            with self._pending_cond:
+                rows, self._pending = self._pending, []
+                self._pending_cond.notify_all()
+            if rows:
+                self._write_rows(rows)
+
+    def _flush_for_read(self):
+        """读取前把缓冲区中的消息落盘，保证刚收到的消息也能查到，在线建索引期间跳过"""
+        if not self._building_index:
+            self.flush()
+
+    def close(self):
+        """停止后台写线程并把剩余消息落盘"""
+        with self._pending_cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending_cond.notify_all()
+        self._writer.join(timeout=10)
+        # 在线迁移在批与批之间检查关闭标记，等它停下再关连接
+        if self._migration_thread is not None:
+            self._migration_thread.join(timeout=10)
+        self.flush()
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning("[Summary] close connection failed: {}".format(e))
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """当前线程的数据库连接，首次使用时创建"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _fetchone(conn: sqlite3.Connection, sql: str, params=()):
+        """
+        查询单行并关闭游标。
+        只fetchone不关闭时语句不会重置，WAL模式下会一直占着读快照，看不到其他连接之后提交的数据
+        """
+        c = conn.execute(sql, params)
+        try:
+            return c.fetchone()
+        finally:
+            c.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for name, value in SQLITE_PRAGMAS:
+            self._fetchone(conn, "PRAGMA {}={}".format(name, value))
+        # 全文索引的触发器和压缩内容的读写依赖这些函数，每个连接都要注册
+        conn.create_function("summary_segment", 1, segment_text, deterministic=True)
+        conn.create_function("summary_text", 1, content_text, deterministic=True)
+        conn.create_function("summary_compress", 1, lambda text: compress_text(text, self.compress_threshold),
+                             deterministic=True)
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    @property
+    def migrating(self) -> bool:
+        """表结构迁移是否还没有完成(正在后台进行，或者上次失败等待重启后继续)"""
+        return self.schema_version < self.MIGRATIONS[-1][0]
+
+    @property
+    def schema_version(self) -> int:
+        return self._fetchone(self.conn, "PRAGMA user_version")[0]
+
+    def wait_migrations(self, timeout: float = None) -> bool:
+        """等待后台在线迁移完成，返回是否已完成"""
+        thread = self._migration_thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def _migrate(self, background: bool = False):
+        """按版本号依次执行未完成的表结构迁移，遇到在线迁移时剩余部分转到后台线程"""
+        conn = self.conn
+        for target, name, online in self.MIGRATIONS:
+            if self.schema_version >= target:
+                continue
+            if online and not background:
+                self._migration_thread = threading.Thread(target=self._migrate_background,
+                                                          name="summary-db-migrate", daemon=True)
+                self._migration_thread.start()
+                return
+            logger.info("[Summary] migrating chat.db to version {}".format(target))
+            if online:
+                # 在线迁移自行分批提交，最后一批内更新版本号
+                if not getattr(self, name)(conn):
+                    return
+                continue
+            with self._write_lock:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    getattr(self, name)(conn)
+                    conn.execute("PRAGMA user_version={}".format(target))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+    def _migrate_background(self):
+        try:
+            self._migrate(background=True)
+        except Exception as e:
+            logger.error("[Summary] online migration failed, will retry on next start: {}".format(e))
+
+    def _migrate_base_tables(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS chat_records
                             (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp TEXT, is_triggered INTEGER, create_time TEXT,
                             PRIMARY KEY (sessionid, msgid))''')
 
         # 创建一个总结时间表，记录合适开始了总结的时间
-        c.execute('''CREATE TABLE IF NOT EXISTS summary_time
+        conn.execute('''CREATE TABLE IF NOT EXISTS summary_time
                             (sessionid TEXT, summary_time INTEGER, PRIMARY KEY (sessionid))''')
 
         # 创建一个关闭保存聊天记录的表
-        c.execute('''CREATE TABLE IF NOT EXISTS summary_stop
+        conn.execute('''CREATE TABLE IF NOT EXISTS summary_stop
                             (sessionid TEXT, PRIMARY KEY (sessionid))''')
 
-        # 后期增加了is_triggered字段，这里做个过渡，这段代码某天会删除
-        c = c.execute("PRAGMA table_info(chat_records);")
-        column_exists = False
-        for column in c.fetchall():
-            logger.debug("[Summary] column: {}".format(column))
-            if column[1] == 'is_triggered':
-                column_exists = True
-                break
-        if not column_exists:
-            self.conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
-            self.conn.execute("UPDATE chat_records SET is_triggered = 0;")
+        # 引入版本号之前创建的库可能缺少后加的is_triggered字段，已有的行直接读到默认值0，不需要逐行更新
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(chat_records)")]
+        if "is_triggered" not in columns:
+            conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0")
 
-        self.conn.commit()
-        # 禁用的群聊
-        self.disable_group = self._get_summary_stop()
+    def _migrate_session_time_index(self, conn) -> bool:
+        """
+        总结查询按 sessionid 过滤、按 timestamp 倒序取前N条，走这个索引即可免去排序。
+        大库上建索引要扫描全表，作为在线迁移在后台进行，不拖慢插件启动。SQLite建索引时整个库的写入都要等待，
+        新消息留在写缓冲区中；这期间读取不再先落盘缓冲区，读请求不会跟着等待，只是暂时查不到缓冲区中的消息。
+        建好后在短事务内更新版本号。
+        """
+        self._building_index = True
+        try:
+            with self._write_lock:
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_time "
+                             "ON chat_records (sessionid, timestamp)")
+        finally:
+            self._building_index = False
+        with self._write_lock:
+            conn.execute("PRAGMA user_version=2")
+            conn.commit()
+        return True
 
-    def insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered=0):
-        c = self.conn.cursor()
-        # 10位timestamp 转换为易读的时间
-        create_time = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-        logger.debug("[Summary] insert record: {} {} {} {} {} {} {} {}".format(session_id, msg_id, user, content, msg_type,
-                                                                            timestamp, is_triggered, create_time))
-        c.execute("INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?,?)",
-                  (session_id, msg_id, user, content, msg_type, timestamp, is_triggered, create_time))
-        self.conn.commit()
+    def _migrate_integer_timestamp(self, conn) -> bool:
+        """
+        timestamp 改为INTEGER并去掉冗余的create_time。
+        分批把旧表拷贝到新表，进度记录在 schema_progress 中，进程重启后从断点继续；
+        最后在一个短事务内补齐增量、替换旧表。返回是否完成。
+        """
+        with self._write_lock:
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_progress (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute('''CREATE TABLE IF NOT EXISTS chat_records_v3
+                            (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER,
+                            is_triggered INTEGER DEFAULT 0, PRIMARY KEY (sessionid, msgid))''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_ts ON chat_records_v3 (sessionid, timestamp)")
+            conn.commit()
 
-    # 根据时间删除记录
-    def delete_records(self, start_timestamp):
+        copy_sql = ('''INSERT OR REPLACE INTO chat_records_v3 ({0})
+                       SELECT sessionid, msgid, user, content, type, CAST(timestamp AS INTEGER), IFNULL(is_triggered, 0)
+                       FROM chat_records WHERE rowid > ? AND rowid <= ?'''.format(self.RECORD_COLUMNS))
+        if not self._copy_in_chunks(conn, "chat_records_v3", (copy_sql,)):
+            return False
+
+        with self._write_lock:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = self._fetchone(conn, "SELECT value FROM schema_progress WHERE name='chat_records_v3'")
+                conn.execute(copy_sql, (row[0] if row else 0, 2 ** 63 - 1))
+                conn.execute("DROP TABLE chat_records")
+                conn.execute("ALTER TABLE chat_records_v3 RENAME TO chat_records")
+                conn.execute("DELETE FROM schema_progress WHERE name='chat_records_v3'")
+                conn.execute("PRAGMA user_version=3")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        logger.info("[Summary] chat_records migrated to integer timestamps")
+        return True
+
+    def _migrate_full_text_index(self, conn) -> bool:
+        """
+        建立聊天内容的FTS5全文索引和按会话去重的用户名表，之后的写入由触发器同步，
+        已有记录分批回填。返回是否完成。
+        """
+        with self._write_lock:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                # 用户名表，(sessionid, user) 主键同时支持精确和前缀查找
+                conn.execute("CREATE TABLE IF NOT EXISTS chat_users "
+                             "(sessionid TEXT, user TEXT, PRIMARY KEY (sessionid, user)) WITHOUT ROWID")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_user_ts "
+                             "ON chat_records (sessionid, user, timestamp)")
+                # 无内容的全文索引，rowid与chat_records一致，索引的是分词后的文本
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chat_records_fts "
+                             "USING fts5(content, content='', tokenize='unicode61')")
+                conn.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_ai AFTER INSERT ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts (rowid, content) VALUES (new.rowid, summary_segment(new.content));
+                                    INSERT OR IGNORE INTO chat_users SELECT new.sessionid, new.user WHERE new.user IS NOT NULL;
+                                END''')
+                conn.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_ad AFTER DELETE ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts (chat_records_fts, rowid, content)
+                                    VALUES ('delete', old.rowid, summary_segment(old.content));
+                                END''')
+                conn.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_au AFTER UPDATE OF content ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts (chat_records_fts, rowid, content)
+                                    VALUES ('delete', old.rowid, summary_segment(old.content));
+                                    INSERT INTO chat_records_fts (rowid, content) VALUES (new.rowid, summary_segment(new.content));
+                                END''')
+                # 触发器生效前的记录需要回填，记下回填的终点
+                conn.execute("INSERT OR IGNORE INTO schema_progress "
+                             "SELECT 'chat_records_fts_until', IFNULL(MAX(rowid), 0) FROM chat_records")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        until = self._fetchone(conn, "SELECT value FROM schema_progress WHERE name='chat_records_fts_until'")[0]
+        backfill_sql = (
+            "INSERT INTO chat_records_fts (rowid, content) "
+            "SELECT rowid, summary_segment(content) FROM chat_records WHERE rowid > ? AND rowid <= ?",
+            "INSERT OR IGNORE INTO chat_users "
+            "SELECT DISTINCT sessionid, user FROM chat_records WHERE rowid > ? AND rowid <= ? AND user IS NOT NULL",
+        )
+        if not self._copy_in_chunks(conn, "chat_records_fts", backfill_sql, until):
+            return False
+
+        with self._write_lock:
+            conn.execute("DELETE FROM schema_progress WHERE name IN ('chat_records_fts', 'chat_records_fts_until')")
+            conn.execute("PRAGMA user_version=4")
+            conn.commit()
+        logger.info("[Summary] full text index is ready")
+        return True
+
+    def _migrate_activity_rollups(self, conn) -> bool:
+        """
+        建立按(会话, 小时)和(会话, 小时, 用户)汇总的消息数表，之后的写入和删除由触发器同步，
+        已有记录分批回填。返回是否完成。
+        """
+        with self._write_lock:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("CREATE TABLE IF NOT EXISTS chat_activity "
+                             "(sessionid TEXT, hour INTEGER, messages INTEGER, PRIMARY KEY (sessionid, hour)) "
+                             "WITHOUT ROWID")
+                conn.execute("CREATE TABLE IF NOT EXISTS chat_user_activity "
+                             "(sessionid TEXT, hour INTEGER, user TEXT, messages INTEGER, "
+                             "PRIMARY KEY (sessionid, hour, user)) WITHOUT ROWID")
+                conn.execute('''CREATE TRIGGER IF NOT EXISTS chat_activity_ai AFTER INSERT ON chat_records BEGIN
+                                    INSERT INTO chat_activity VALUES (new.sessionid, new.timestamp / {0}, 1)
+                                    ON CONFLICT (sessionid, hour) DO UPDATE SET messages = messages + 1;
+                                    INSERT INTO chat_user_activity
+                                    VALUES (new.sessionid, new.timestamp / {0}, IFNULL(new.user, ''), 1)
+                                    ON CONFLICT (sessionid, hour, user) DO UPDATE SET messages = messages + 1;
+                                END'''.format(self.ACTIVITY_BUCKET))
+                conn.execute('''CREATE TRIGGER IF NOT EXISTS chat_activity_ad AFTER DELETE ON chat_records BEGIN
+                                    UPDATE chat_activity SET messages = messages - 1
+                                    WHERE sessionid = old.sessionid AND hour = old.timestamp / {0};
+                                    DELETE FROM chat_activity
+                                    WHERE sessionid = old.sessionid AND hour = old.timestamp / {0} AND messages <= 0;
+                                    UPDATE chat_user_activity SET messages = messages - 1
+                                    WHERE sessionid = old.sessionid AND hour = old.timestamp / {0}
+                                    AND user = IFNULL(old.user, '');
+                                    DELETE FROM chat_user_activity
+                                    WHERE sessionid = old.sessionid AND hour = old.timestamp / {0}
+                                    AND user = IFNULL(old.user, '') AND messages <= 0;
+                                END'''.format(self.ACTIVITY_BUCKET))
+                # 触发器生效前的记录需要回填，记下回填的终点
+                conn.execute("INSERT OR IGNORE INTO schema_progress "
+                             "SELECT 'chat_activity_until', IFNULL(MAX(rowid), 0) FROM chat_records")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        until = self._fetchone(conn, "SELECT value FROM schema_progress WHERE name='chat_activity_until'")[0]
+        backfill_sql = (
+            "INSERT INTO chat_activity SELECT sessionid, timestamp / {0}, COUNT(*) FROM chat_records "
+            "WHERE rowid > ? AND rowid <= ? GROUP BY 1, 2 "
+            "ON CONFLICT (sessionid, hour) DO UPDATE SET messages = messages + excluded.messages"
+            .format(self.ACTIVITY_BUCKET),
+            "INSERT INTO chat_user_activity SELECT sessionid, timestamp / {0}, IFNULL(user, ''), COUNT(*) "
+            "FROM chat_records "
+            "WHERE rowid > ? AND rowid <= ? GROUP BY 1, 2, 3 "
+            "ON CONFLICT (sessionid, hour, user) DO UPDATE SET messages = messages + excluded.messages"
+            .format(self.ACTIVITY_BUCKET),
+        )
+        if not self._copy_in_chunks(conn, "chat_activity", backfill_sql, until):
+            return False
+        with self._write_lock:
+            conn.execute("DELETE FROM schema_progress WHERE name IN ('chat_activity', 'chat_activity_until')")
+            conn.execute("PRAGMA user_version=5")
+            conn.commit()
+        logger.info("[Summary] activity rollups are ready")
+        return True
+
+    def _migrate_interned_records(self, conn) -> bool:
+        """
+        会话、用户和消息类型改为整数ID，名称只在ID表中存一份；较长的内容压缩存储。
+        分批拷贝到新表，保留原rowid，全文索引和活跃度汇总不用重建；
+        最后在一个短事务内补齐增量、替换旧表并重建触发器。返回是否完成。
+        """
+        with self._write_lock:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for _, table in self.INTERN_TABLES.values():
+                    conn.execute("CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)"
+                                 .format(table))
+                conn.execute('''CREATE TABLE IF NOT EXISTS chat_records_v6
+                                (session INTEGER, msgid INTEGER, user INTEGER, content, type INTEGER, timestamp INTEGER,
+                                is_triggered INTEGER DEFAULT 0, PRIMARY KEY (session, msgid))''')
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_id_ts "
+                             "ON chat_records_v6 (session, timestamp)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_session_id_user_ts "
+                             "ON chat_records_v6 (session, user, timestamp)")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        copy_sql = tuple(
+            "INSERT OR IGNORE INTO {0} (name) SELECT DISTINCT {1} FROM chat_records "
+            "WHERE rowid > ? AND rowid <= ? AND {1} IS NOT NULL".format(table, column)
+            for column, (_, table) in self.INTERN_TABLES.items()
+        ) + ('''INSERT OR REPLACE INTO chat_records_v6 (rowid, {})
+                SELECT r.rowid, s.id, r.msgid, u.id, summary_compress(r.content), t.id, CAST(r.timestamp AS INTEGER),
+                IFNULL(r.is_triggered, 0)
+                FROM chat_records r
+                LEFT JOIN chat_session_ids s ON s.name = r.sessionid
+                LEFT JOIN chat_user_ids u ON u.name = r.user
+                LEFT JOIN chat_type_ids t ON t.name = r.type
+                WHERE r.rowid > ? AND r.rowid <= ?'''.format(self.INTERNED_COLUMNS),)
+        if not self._copy_in_chunks(conn, "chat_records_v6", copy_sql):
+            return False
+
+        with self._write_lock:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = self._fetchone(conn, "SELECT value FROM schema_progress WHERE name='chat_records_v6'")
+                for sql in copy_sql:
+                    conn.execute(sql, (row[0] if row else 0, 2 ** 63 - 1))
+                # 旧表的触发器随表一起删除，DROP不会触发删除触发器，全文索引和汇总表保持不变
+                conn.execute("DROP TABLE chat_records")
+                conn.execute("ALTER TABLE chat_records_v6 RENAME TO chat_records")
+                self._create_triggers(conn)
+                conn.execute("DELETE FROM schema_progress WHERE name='chat_records_v6'")
+                conn.execute("PRAGMA user_version=6")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        logger.info("[Summary] chat_records migrated to interned ids")
+        return True
+
+    def _migrate_digests(self, conn):
+        # 低峰期预先生成的群聊报告，每个群只保留最新的一份，图片在渲染缓存中
+        conn.execute('''CREATE TABLE IF NOT EXISTS summary_digest
+                            (sessionid TEXT PRIMARY KEY, start_time INTEGER, watermark INTEGER, report TEXT,
+                            created INTEGER)''')
+
+    def _migrate_digest_position(self, conn):
+        # 报告覆盖到的最新一条记录的rowid，和watermark一起区分同一秒内之后写入的消息，旧的报告为0
+        conn.execute("ALTER TABLE summary_digest ADD COLUMN watermark_id INTEGER DEFAULT 0")
+
+    def _migrate_null_users(self, conn):
+        # 旧的触发器把没有发送者的消息以NULL写入用户名表和汇总表的主键，插入失败会让整批写入回滚
+        for name in ("chat_records_ai", "chat_records_ad", "chat_records_au", "chat_activity_ai", "chat_activity_ad"):
+            conn.execute("DROP TRIGGER IF EXISTS {}".format(name))
+        self._create_triggers(conn)
+
+    def _create_triggers(self, conn):
+        """
+        版本6之后同步全文索引、用户名表和活跃度汇总的触发器。
+        汇总表仍然按名称统计，从ID表取回名称；没有发送者的消息不进用户名表，在汇总表中记为空字符串
+        """
+        conn.execute('''CREATE TRIGGER chat_records_ai AFTER INSERT ON chat_records BEGIN
+                            INSERT INTO chat_records_fts (rowid, content)
+                            VALUES (new.rowid, summary_segment(summary_text(new.content)));
+                            INSERT OR IGNORE INTO chat_users SELECT s.name, u.name FROM chat_session_ids s
+                            JOIN chat_user_ids u ON u.id = new.user WHERE s.id = new.session;
+                        END''')
+        conn.execute('''CREATE TRIGGER chat_records_ad AFTER DELETE ON chat_records BEGIN
+                            INSERT INTO chat_records_fts (chat_records_fts, rowid, content)
+                            VALUES ('delete', old.rowid, summary_segment(summary_text(old.content)));
+                        END''')
+        conn.execute('''CREATE TRIGGER chat_records_au AFTER UPDATE OF content ON chat_records BEGIN
+                            INSERT INTO chat_records_fts (chat_records_fts, rowid, content)
+                            VALUES ('delete', old.rowid, summary_segment(summary_text(old.content)));
+                            INSERT INTO chat_records_fts (rowid, content)
+                            VALUES (new.rowid, summary_segment(summary_text(new.content)));
+                        END''')
+        conn.execute('''CREATE TRIGGER chat_activity_ai AFTER INSERT ON chat_records BEGIN
+                            INSERT INTO chat_activity SELECT name, new.timestamp / {0}, 1 FROM chat_session_ids
+                            WHERE id = new.session
+                            ON CONFLICT (sessionid, hour) DO UPDATE SET messages = messages + 1;
+                            INSERT INTO chat_user_activity SELECT s.name, new.timestamp / {0}, IFNULL(u.name, ''), 1
+                            FROM chat_session_ids s LEFT JOIN chat_user_ids u ON u.id = new.user
+                            WHERE s.id = new.session
+                            ON CONFLICT (sessionid, hour, user) DO UPDATE SET messages = messages + 1;
+                        END'''.format(self.ACTIVITY_BUCKET))
+        conn.execute('''CREATE TRIGGER chat_activity_ad AFTER DELETE ON chat_records BEGIN
+                            UPDATE chat_activity SET messages = messages - 1
+                            WHERE sessionid = (SELECT name FROM chat_session_ids WHERE id = old.session)
+                            AND hour = old.timestamp / {0};
+                            DELETE FROM chat_activity
+                            WHERE sessionid = (SELECT name FROM chat_session_ids WHERE id = old.session)
+                            AND hour = old.timestamp / {0} AND messages <= 0;
+                            UPDATE chat_user_activity SET messages = messages - 1
+                            WHERE sessionid = (SELECT name FROM chat_session_ids WHERE id = old.session)
+                            AND hour = old.timestamp / {0}
+                            AND user = IFNULL((SELECT name FROM chat_user_ids WHERE id = old.user), '');
+                            DELETE FROM chat_user_activity
+                            WHERE sessionid = (SELECT name FROM chat_session_ids WHERE id = old.session)
+                            AND hour = old.timestamp / {0}
+                            AND user = IFNULL((SELECT name FROM chat_user_ids WHERE id = old.user), '')
+                            AND messages <= 0;
+                        END'''.format(self.ACTIVITY_BUCKET))
+
+    def _copy_in_chunks(self, conn, name: str, sqls: tuple, until: int = None) -> bool:
+        """
+        按chat_records的rowid分批执行sqls，每条sql接收(起始rowid, 结束rowid]两个参数。
+        进度以name记录在 schema_progress 中，中断后从断点继续。返回是否全部完成。
+        """
+        while not self._closed:
+            with self._write_lock:
+                row = self._fetchone(conn, "SELECT value FROM schema_progress WHERE name=?", (name,))
+                last_rowid = row[0] if row else 0
+                row = self._fetchone(conn, "SELECT MAX(rowid) FROM (SELECT rowid FROM chat_records WHERE rowid > ? "
+                                     "AND rowid <= ? ORDER BY rowid LIMIT ?)",
+                                     (last_rowid, until if until is not None else 2 ** 63 - 1,
+                                      self.MIGRATION_CHUNK_SIZE))
+                if row[0] is None:
+                    return True
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for sql in sqls:
+                        conn.execute(sql, (last_rowid, row[0]))
+                    conn.execute("INSERT OR REPLACE INTO schema_progress VALUES (?, ?)", (name, row[0]))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            logger.debug("[Summary] {} done up to rowid {}".format(name, row[0]))
+            time.sleep(self.MIGRATION_PAUSE)
+        return False
+
+    def _writer_loop(self):
+        while True:
+            with self._pending_cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_cond.wait(remaining)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("[Summary] flush records failed: {}".format(e))
+            if closed:
+                return
+
+    def _write_rows(self, rows):
+        """
+        写入从缓冲区取出的消息。数据库被锁、磁盘出错等暂时的错误时把消息放回缓冲区最前面，下次落盘时重试；
+        其他错误说明批内有写不进去的行，改为逐行写入，只丢弃出错的行。
+        """
         try:
-            c = self.conn.cursor()
-            c.execute('''
-                        DELETE FROM chat_records
-                        WHERE timestamp < ?
-                    ''', start_timestamp,)
-            self.conn.commit()
-            logger.info("Records older have been cleaned.")
+            self._write_batch(rows)
+            return
+        except sqlite3.OperationalError:
+            self._requeue(rows)
+            raise
         except Exception as e:
-            logger.error(e)
+            if len(rows) == 1:
+                self._drop_record(rows[0], e)
+                return
+            logger.warning("[Summary] write {} records failed, retry one by one: {}".format(len(rows), e))
+        for index, row in enumerate(rows):
+            try:
+                self._write_batch([row])
+            except sqlite3.OperationalError:
+                self._requeue(rows[index:])
+                raise
+            except Exception as e:
+                self._drop_record(row, e)
 
-    # 保存总结时间，如果表中不存在则插入，如果存在则更新
-    def save_summary_time(self, session_id, summary_time):
-        if self.get_summary_time(session_id) is None:
-            self._insert_summary_time(session_id, summary_time)
+    def _requeue(self, rows):
+        with self._pending_cond:
+            self._pending[:0] = rows
+
+    def _drop_record(self, row, error):
+        logger.error("[Summary] drop record {} {}: {}".format(row[0], row[1], error))
+        if self.metrics is not None:
+            self.metrics.incr("db_dropped_records")
+
+    def _write_batch(self, rows):
+        """一个事务内批量写入"""
+        start = time.perf_counter()
+        with self._write_lock:
+            # 新分配的ID在提交后才放进缓存，回滚时不会留下不存在的ID
+            staged = {}
+            try:
+                if self.schema_version >= 6:
+                    # 没有发送者的消息记为空字符串，和活跃度汇总表一致
+                    rows = [(self._intern_id("chat_session_ids", session_id, staged), msg_id,
+                             self._intern_id("chat_user_ids", "" if user is None else user, staged),
+                             compress_text(content, self.compress_threshold),
+                             self._intern_id("chat_type_ids", msg_type, staged), timestamp, is_triggered)
+                            for session_id, msg_id, user, content, msg_type, timestamp, is_triggered in rows]
+                    columns = self.INTERNED_COLUMNS
+                else:
+                    columns = self.RECORD_COLUMNS
+                self.conn.executemany("INSERT OR REPLACE INTO chat_records ({}) VALUES (?,?,?,?,?,?,?)"
+                                      .format(columns), rows)
+                self.conn.commit()
+                logger.debug("[Summary] flushed {} records".format(len(rows)))
+            except Exception:
+                self.conn.rollback()
+                raise
+            for (table, name), value in staged.items():
+                self._intern_cache[table][name] = value
+        if self.metrics is not None:
+            self.metrics.observe("db_write_seconds", time.perf_counter() - start)
+            self.metrics.observe("db_batch_size", len(rows), buckets=SIZE_BUCKETS)
+
+    def _intern_id(self, table: str, name, staged: dict):
+        """名称对应的整数ID，不存在时分配一个，需要在写锁和写事务内调用"""
+        if name is None:
+            return None
+        value = self._intern_cache[table].get(name) or staged.get((table, name))
+        if value is None:
+            self.conn.execute("INSERT OR IGNORE INTO {} (name) VALUES (?)".format(table), (name,))
+            value = self._fetchone(self.conn, "SELECT id FROM {} WHERE name=?".format(table), (name,))[0]
+            staged[(table, name)] = value
+        return value
+
+    # 根据时间删除记录
+    def delete_records(self, start_timestamp):
+        """删除所有会话中早于start_timestamp的记录，返回删除的条数"""
+        deleted = 0
+        for session_id in self.list_sessions():
+            try:
+                deleted += self.purge_records(start_timestamp, session_id)
+            except Exception as e:
+                logger.error(e)
+        logger.info("Records older have been cleaned.")
+        return deleted
+
+    def purge_records(self, before_timestamp: int, session_id, batch_size: int = 500, archive=None) -> int:
+        """
+        分批删除某个会话早于before_timestamp的记录，每批一个短事务，批与批之间让出写锁。
+        全文索引和活跃度汇总由删除触发器同步。
+
+        :param archive: 删除前调用 archive(rows)，rows为记录字典的列表，抛出异常时停止删除
+        :return: 删除的条数
+        """
+        self.flush()
+        columns = self.RECORD_COLUMNS.split(", ")
+        deleted = 0
+        while not self._closed:
+            select, source = self._record_source(columns)
+            c = self.conn.execute("SELECT r.rowid, {} FROM {} WHERE {} AND r.timestamp<? "
+                                  "ORDER BY r.timestamp LIMIT ?".format(select, source, self._session_filter()),
+                                  (session_id, int(before_timestamp), batch_size))
+            rows = c.fetchall()
+            if not rows:
+                break
+            if archive is not None:
+                archive([dict(zip(columns, row[1:])) for row in rows])
+            with self._write_lock:
+                try:
+                    self.conn.executemany("DELETE FROM chat_records WHERE rowid=?", [(row[0],) for row in rows])
+                    self.conn.commit()
+                except Exception:
+                    # 出错时回滚，否则隐式开启的事务会一直占着当前线程的连接
+                    self.conn.rollback()
+                    raise
+            deleted += len(rows)
+            if len(rows) < batch_size:
+                break
+            time.sleep(self.PURGE_PAUSE)
+        if deleted:
+            logger.debug("[Summary] purged {} records of {}".format(deleted, session_id))
+        return deleted
+
+    def list_sessions(self) -> list:
+        """所有有聊天记录的会话"""
+        if self.schema_version >= 5:
+            sql = "SELECT DISTINCT sessionid FROM chat_activity"
         else:
-            self._update_summary_time(session_id, summary_time)
+            sql = "SELECT DISTINCT sessionid FROM chat_records"
+        return [row[0] for row in self.conn.execute(sql).fetchall()]
 
-    # 插入总结时间
-    def _insert_summary_time(self, session_id, summary_time):
-        c = self.conn.cursor()
-        logger.debug("[Summary] insert summary time: {} {}".format(session_id, summary_time))
-        c.execute("INSERT OR REPLACE INTO summary_time VALUES (?,?)",
-                  (session_id, summary_time))
-        self.conn.commit()
+    def incremental_vacuum(self, pages: int = 0) -> int:
+        """回收最多pages个空闲页(0表示全部)，返回回收的页数。库不是增量VACUUM模式时只能复用空闲页，不会缩小文件"""
+        if self._fetchone(self.conn, "PRAGMA auto_vacuum")[0] != 2:
+            return 0
+        with self._write_lock:
+            before = self._fetchone(self.conn, "PRAGMA freelist_count")[0]
+            # 每返回一行回收一页，要把结果读完才会执行完
+            self.conn.execute("PRAGMA incremental_vacuum({})".format(int(pages))).fetchall()
+            return before - self._fetchone(self.conn, "PRAGMA freelist_count")[0]
+
+    # 保存总结时间，已存在时覆盖
+    def save_summary_time(self, session_id, summary_time):
+        logger.debug("[Summary] save summary time: {} {}".format(session_id, summary_time))
+        with self._write_lock:
+            try:
+                self.conn.execute("INSERT INTO summary_time VALUES (?,?) "
+                                  "ON CONFLICT (sessionid) DO UPDATE SET summary_time = excluded.summary_time",
+                                  (session_id, summary_time))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            self._summary_times = {**self._summary_times, session_id: summary_time}
 
-    # 更新总结时间
-    def _update_summary_time(self, session_id, summary_time):
-        c = self.conn.cursor()
-        logger.debug("[Summary] update summary time: {} {}".format(session_id, summary_time))
-        c.execute("UPDATE summary_time SET summary_time = ? WHERE sessionid = ?",
-                  (summary_time, session_id))
-        self.conn.commit()
-    
     # 获取总结时间，如果不存在返回None
     def get_summary_time(self, session_id):
+        return self._summary_times.get(session_id)
+
+    def _get_summary_times(self) -> dict:
+        return dict(self.conn.execute("SELECT sessionid, summary_time FROM summary_time").fetchall())
+
+    def get_records(self, session_id, start_timestamp:int = None, limit:int = None, username: list[str]=None,
+                    keywords: list[str] = None) -> list:
+        """
+        查询聊天记录，按时间倒序返回
+
+        :param username: 只看这些人的发言，支持昵称的一部分
+        :param keywords: 只看包含这些关键词之一的消息
+        """
+        # 先把缓冲区中的消息落盘，保证刚收到的消息也能被总结到
+        self._flush_for_read()
+        query = self._build_records_query(self.RECORD_COLUMNS, session_id, start_timestamp, limit, username, keywords)
+        if query is None:
+            return []
         c = self.conn.cursor()
-        c.execute("SELECT summary_time FROM summary_time WHERE sessionid=?", (session_id,))
-        row = c.fetchone()
-        if row is None:
-            return None
-        return row[0]
+        c.execute(*query)
+        return c.fetchall()
+
+    def latest_rowid(self, session_id) -> int:
+        """会话最后写入的一条记录的rowid，有新消息写入(包括时间较早、晚到的消息)时变大，没有记录时为0"""
+        self._flush_for_read()
+        row = self._fetchone(self.conn, "SELECT MAX(r.rowid) FROM chat_records r WHERE {}".format(
+            self._session_filter()), (session_id,))
+        return row[0] or 0
+
+    def iter_records(self, session_id, start_timestamp: int = None, limit: int = None, username: list[str] = None,
+                     keywords: list[str] = None, batch_size: int = 500, columns: str = "user, timestamp, content",
+                     after_id: int = None):
+        """
+        流式读取聊天记录，按时间倒序逐条产出 (user, timestamp, content)，
+        只查询生成总结需要的列，调用方可以随时停止读取
 
-    def get_records(self, session_id, start_timestamp:int = None, limit:int = None, username: list[str]=None) -> list:
+        :param columns: 需要的列，默认只取发言人、时间和内容，rowid用来记录读到的位置
+        :param after_id: 只读rowid大于after_id、即在其之后写入的记录，包括时间较早、晚到的消息，
+                         start_timestamp这时是包含在内的下限
+        """
+        self._flush_for_read()
+        query = self._build_records_query(columns, session_id, start_timestamp, limit, username, keywords,
+                                          after_id)
+        if query is None:
+            return
         c = self.conn.cursor()
+        try:
+            c.execute(*query)
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            c.close()
+
+    def _build_records_query(self, columns: str, session_id, start_timestamp: int = None, limit: int = None,
+                             username: list[str] = None, keywords: list[str] = None, after_id: int = None):
+        """构建聊天记录查询，返回(sql, 参数)，筛选的用户不存在时返回None"""
+        # 全文索引和用户名表在版本4的迁移完成后才可用
+        indexed = self.schema_version >= 4
         
         # 构建基础SQL查询
-        sql = "SELECT * FROM chat_records WHERE sessionid=?"
+        select, source = self._record_source([column.strip() for column in columns.split(",")])
+        session_filter = self._session_filter()
+        if after_id:
+            # 新写入的记录在rowid的末尾，一元+让会话条件不走索引，按rowid范围读，不用扫描整个会话的索引
+            session_filter = "+" + session_filter
+        sql = "SELECT {} FROM {} WHERE {}".format(select, source, session_filter)
         params = [session_id]
 
         # 添加时间筛选条件
-        if start_timestamp:
-            sql += " AND timestamp>?"
+        if after_id is not None:
+            sql += " AND r.rowid>?"
+            params.append(after_id)
+            if start_timestamp:
+                sql += " AND r.timestamp>=?"
+                params.append(start_timestamp)
+        elif start_timestamp:
+            sql += " AND r.timestamp>?"
             params.append(start_timestamp)
         
         # 添加用户名筛选条件
         if username:
-            # 将搜索条件按@分割成多个用户名,并去掉@符号
-            sql += " AND ("
-            sql += " OR ".join(["user LIKE ?" for _ in username])
-            sql += ")"
-            params.extend(["%" + u + "%" for u in username])
+            if indexed:
+                users = self.find_users(session_id, username)
+                if not users:
+                    return None
+                if self.schema_version >= 6:
+                    sql += " AND r.user IN (SELECT id FROM chat_user_ids WHERE name IN ({}))".format(
+                        ",".join("?" * len(users)))
+                else:
+                    sql += " AND r.user IN ({})".format(",".join("?" * len(users)))
+                params.extend(users)
+            else:
+                # 将搜索条件按@分割成多个用户名,并去掉@符号
+                sql += " AND ("
+                sql += " OR ".join(["r.user LIKE ?" for _ in username])
+                sql += ")"
+                params.extend(["%" + u + "%" for u in username])
             # 如果没有指定limit，则根据用户数量设置limit
             if limit is None:
                 limit = len(username) * 250
 
+        # 添加关键词筛选条件
+        if keywords:
+            if indexed:
+                sql += " AND r.rowid IN (SELECT rowid FROM chat_records_fts WHERE chat_records_fts MATCH ?)"
+                params.append(build_match_query(keywords))
+            else:
+                sql += " AND (" + " OR ".join(["r.content LIKE ?" for _ in keywords]) + ")"
+                params.extend(["%" + k + "%" for k in keywords])
+
         # 添加排序和限制条件
-        sql += " ORDER BY timestamp DESC"
+        # 同一秒内按写入顺序，rowid在索引中，不需要额外排序
+        sql += " ORDER BY r.timestamp DESC, r.rowid DESC"
         if limit:
             sql += " LIMIT ?"
             params.append(limit)
+        return sql, params
 
-        c.execute(sql, params)
-        return c.fetchall()
+    def _record_source(self, columns: list):
+        """
+        把chat_records的列名换成查询表达式，返回(select表达式, from子句)，表的别名为r。
+        版本6之后名称要关联ID表取回，内容要解压
+        """
+        if self.schema_version < 6:
+            return ", ".join("r." + column for column in columns), "chat_records r"
+        select = []
+        joins = []
+        for column in columns:
+            if column in self.INTERN_TABLES:
+                key, table = self.INTERN_TABLES[column]
+                select.append("{}.name".format(table))
+                joins.append("LEFT JOIN {0} ON {0}.id = r.{1}".format(table, key))
+            elif column == "content":
+                select.append("summary_text(r.content)")
+            else:
+                select.append("r." + column)
+        return ", ".join(select), " ".join(["chat_records r"] + joins)
+
+    def _session_filter(self) -> str:
+        """按会话名称过滤chat_records r的条件，接收一个会话名称参数"""
+        if self.schema_version >= 6:
+            return "r.session=(SELECT id FROM chat_session_ids WHERE name=?)"
+        return "r.sessionid=?"
+
+    def get_top_speakers(self, session_id, start_timestamp: int = None, end_timestamp: int = None,
+                         limit: int = 5) -> list:
+        """
+        统计时间范围 [start_timestamp, end_timestamp) 内发言最多的人，返回 [(user, 条数)]。
+        整小时的部分读汇总表，首尾不满一小时的部分读原始记录，结果是精确的
+
+        :param limit: 返回前几名，None表示全部
+        """
+        counts = {}
+        for sql, params in self._activity_queries(session_id, start_timestamp, end_timestamp, by_user=True):
+            for user, messages in self.conn.execute(sql, params).fetchall():
+                counts[user] = counts.get(user, 0) + messages
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def get_activity_histogram(self, session_id, start_timestamp: int = None, end_timestamp: int = None) -> list:
+        """统计时间范围内每小时的消息数，返回 [(小时起始时间戳, 条数)]，只包含有消息的小时"""
+        counts = {}
+        for sql, params in self._activity_queries(session_id, start_timestamp, end_timestamp):
+            for hour, messages in self.conn.execute(sql, params).fetchall():
+                counts[hour] = counts.get(hour, 0) + messages
+        return [(hour * self.ACTIVITY_BUCKET, counts[hour]) for hour in sorted(counts)]
+
+    def _activity_queries(self, session_id, start_timestamp: int = None, end_timestamp: int = None,
+                          by_user: bool = False) -> list:
+        """把时间范围拆成整小时部分和首尾零散部分，分别生成汇总表和原始记录上的分组查询"""
+        self._flush_for_read()
+        bucket = self.ACTIVITY_BUCKET
+        start = int(start_timestamp or 0)
+        end = int(end_timestamp) if end_timestamp else int(time.time()) + 1
+        if start >= end:
+            return []
+        select, source = self._record_source(["user"] if by_user else [])
+        # 和汇总表一致，没有发送者的消息记为空字符串
+        key = "IFNULL({}, '')".format(select) if by_user else "r.timestamp / {}".format(bucket)
+        raw_sql = ("SELECT {}, COUNT(*) FROM {} WHERE {} AND r.timestamp>=? AND r.timestamp<? "
+                   "GROUP BY 1".format(key, source, self._session_filter()))
+        first_hour = -(-start // bucket)
+        last_hour = end // bucket
+        # 汇总表还没建好或者范围不满一小时时直接统计原始记录
+        if self.schema_version < 5 or first_hour >= last_hour:
+            return [(raw_sql, (session_id, start, end))]
+
+        if by_user:
+            rollup_sql = ("SELECT user, SUM(messages) FROM chat_user_activity "
+                          "WHERE sessionid=? AND hour>=? AND hour<? GROUP BY user")
+        else:
+            rollup_sql = "SELECT hour, messages FROM chat_activity WHERE sessionid=? AND hour>=? AND hour<?"
+        queries = [(rollup_sql, (session_id, first_hour, last_hour))]
+        if start < first_hour * bucket:
+            queries.append((raw_sql, (session_id, start, first_hour * bucket)))
+        if last_hour * bucket < end:
+            queries.append((raw_sql, (session_id, last_hour * bucket, end)))
+        return queries
+
+    def find_users(self, session_id, names: list[str]) -> list:
+        """
+        在会话的用户名表中查找用户：优先精确匹配，其次前缀匹配，都没有时再按包含匹配
+        """
+        conn = self.conn
+        users = []
+        for name in names:
+            rows = conn.execute("SELECT user FROM chat_users WHERE sessionid=? AND user=?",
+                                (session_id, name)).fetchall()
+            if not rows:
+                # 前缀匹配走主键索引
+                rows = conn.execute("SELECT user FROM chat_users WHERE sessionid=? AND user>=? AND user<?",
+                                    (session_id, name, name + "\U0010ffff")).fetchall()
+            if not rows:
+                # 单个会话的用户不多，包含匹配扫描这个会话的用户即可
+                rows = conn.execute("SELECT user FROM chat_users WHERE sessionid=? AND instr(user, ?) > 0",
+                                    (session_id, name)).fetchall()
+            users.extend(row[0] for row in rows if row[0] not in users)
+        return users
+
+    def is_disabled(self, session_id) -> bool:
+        """会话是否关闭了总结，只查内存"""
+        return session_id in self.disable_group
+
+    def save_digest(self, session_id, start_time: int, watermark: int, report: str, watermark_id: int = 0):
+        """保存预先生成的报告，覆盖该群之前的一份。迁移到版本8之前不保存"""
+        if self.schema_version < 8:
+            return
+        with self._write_lock:
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO summary_digest (sessionid, start_time, watermark, "
+                                  "watermark_id, report, created) VALUES (?,?,?,?,?,?)",
+                                  (session_id, start_time, watermark, watermark_id, report, int(time.time())))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def get_digest(self, session_id) -> Optional[dict]:
+        """该群最新的预生成报告，没有时返回None"""
+        if self.schema_version < 8:
+            return None
+        row = self._fetchone(self.conn, "SELECT start_time, watermark, watermark_id, report, created "
+                                        "FROM summary_digest WHERE sessionid=?", (session_id,))
+        if row is None:
+            return None
+        return dict(zip(("start_time", "watermark", "watermark_id", "report", "created"), row))
 
     # 删除禁用的群聊
     def delete_summary_stop(self, session_id):
         try:
-            c = self.conn.cursor()
-            c.execute("DELETE FROM summary_stop WHERE sessionid=?", (session_id,))
-            self.conn.commit()
-            if session_id in self.disable_group:
-                self.disable_group.remove(session_id)
+            with self._write_lock:
+                c = self.conn.cursor()
+                c.execute("DELETE FROM summary_stop WHERE sessionid=?", (session_id,))
+                self.conn.commit()
+                self.disable_group = self.disable_group - {session_id}
         except Exception as e:
+            self.conn.rollback()
             logger.error(e)
 
     # 保存禁用的群聊
     def save_summary_stop(self, session_id):
         try:
-            c = self.conn.cursor()
-            c.execute("INSERT OR REPLACE INTO summary_stop VALUES (?)",
-                      (session_id,))
-            self.conn.commit()
-            self.disable_group.add(session_id)
+            with self._write_lock:
+                c = self.conn.cursor()
+                c.execute("INSERT INTO summary_stop VALUES (?) ON CONFLICT (sessionid) DO NOTHING", (session_id,))
+                self.conn.commit()
+                self.disable_group = self.disable_group | {session_id}
         except Exception as e:
+            self.conn.rollback()
             logger.error(e)
 
     # 获取所有禁用的群聊
-    def _get_summary_stop(self):
-        c = self.conn.cursor()
-        c.execute("SELECT sessionid FROM summary_stop")
-        return set(c.fetchall())
-
-
+    def _get_summary_stop(self) -> frozenset:
+        return frozenset(row[0] for row in self.conn.execute("SELECT sessionid FROM summary_stop").fetchall())
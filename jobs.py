@@ -0,0 +1,180 @@
+# encoding:utf-8
+"""
+总结任务队列：请求入队后立即返回，由固定数量的工作线程按优先级执行，
+同时限制全局和单个会话的并发数，并支持任务超时。
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Callable, Optional
+
+from common.log import logger
+
+# 优先级，数值越小越先执行
+PRIORITY_ADMIN = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BACKGROUND = 20
+
+
+class SummaryJob:
+    def __init__(self, session_id: str, run: Callable[[], object], on_result: Callable[[object], None],
+                 on_timeout: Callable[[], None] = None, on_finish: Callable[[], None] = None,
+                 priority: int = PRIORITY_NORMAL, timeout: float = None, seq: int = 0):
+        """
+        :param run: 任务本体，在工作线程中执行，返回值交给on_result
+        :param on_result: 任务正常完成后的回调
+        :param on_timeout: 排队或执行超时的回调，超时后任务结果会被丢弃
+        :param on_finish: 任务结束(完成、出错、超时)后一定会调用一次，用于释放资源
+        """
+        self.session_id = session_id
+        self.run = run
+        self.on_result = on_result
+        self.on_timeout = on_timeout
+        self.on_finish = on_finish
+        self.priority = priority
+        self.timeout = timeout
+        self.seq = seq
+        self.created = time.time()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def expired(self) -> bool:
+        return self.timeout is not None and time.time() - self.created > self.timeout
+
+
+class SummaryJobQueue:
+    def __init__(self, workers: int = 2, per_session: int = 1, timeout: float = 300):
+        """
+        :param workers: 工作线程数，即全局同时执行的任务上限
+        :param per_session: 单个会话同时执行的任务上限
+        :param timeout: 任务默认超时时间(单位秒)，从入队开始计算
+        """
+        self.workers = max(int(workers), 1)
+        self.per_session = max(int(per_session), 1)
+        self.timeout = timeout
+        self._pending = []
+        self._running = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._stopped = False
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"summary-worker-{i}", daemon=True).start()
+
+    def submit(self, session_id: str, run: Callable[[], object], on_result: Callable[[object], None],
+               on_timeout: Callable[[], None] = None, on_finish: Callable[[], None] = None,
+               priority: int = PRIORITY_NORMAL, timeout: float = None) -> int:
+        """提交任务，返回前面还有多少个任务在排队"""
+        job = SummaryJob(session_id, run, on_result, on_timeout, on_finish, priority,
+                         timeout if timeout is not None else self.timeout, next(self._seq))
+        with self._cond:
+            ahead = sum(1 for pending in self._pending if pending < job)
+            heapq.heappush(self._pending, job)
+            self._cond.notify()
+        logger.debug("[Summary] job queued for %s, priority=%d, ahead=%d", session_id, priority, ahead)
+        return ahead
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"pending": len(self._pending), "running": sum(self._running.values())}
+
+    def idle(self) -> bool:
+        with self._cond:
+            return not self._pending and not any(self._running.values())
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _take(self) -> Optional[SummaryJob]:
+        """取出优先级最高且所在会话未达到并发上限的任务，调用方需持有锁"""
+        skipped = []
+        job = None
+        while self._pending:
+            candidate = heapq.heappop(self._pending)
+            if self._running.get(candidate.session_id, 0) < self.per_session:
+                job = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self._pending, candidate)
+        return job
+
+    def _worker_loop(self):
+        runner = _Runner(threading.current_thread().name.replace("worker", "job"))
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None and not self._stopped:
+                    self._cond.wait()
+                    job = self._take()
+                if job is None:
+                    return
+                self._running[job.session_id] = self._running.get(job.session_id, 0) + 1
+            try:
+                self._execute(job, runner)
+            finally:
+                with self._cond:
+                    self._running[job.session_id] -= 1
+                    if not self._running[job.session_id]:
+                        del self._running[job.session_id]
+                    self._cond.notify_all()
+
+    def _execute(self, job: SummaryJob, runner: "_Runner"):
+        try:
+            if job.expired():
+                logger.warning("[Summary] job for %s expired in queue", job.session_id)
+                self._callback(job.on_timeout)
+                return
+
+            # 超时的任务仍然占用并发名额直到真正结束
+            future = runner.submit(job.run)
+            remaining = None if job.timeout is None else max(job.timeout - (time.time() - job.created), 0)
+            done, _ = wait([future], timeout=remaining)
+            if not done:
+                logger.warning("[Summary] job for %s timed out", job.session_id)
+                self._callback(job.on_timeout)
+                wait([future])
+            elif future.exception() is not None:
+                logger.error("[Summary] job for %s failed: %s", job.session_id, future.exception())
+            else:
+                self._callback(job.on_result, future.result())
+        finally:
+            self._callback(job.on_finish)
+
+    @staticmethod
+    def _callback(func, *args):
+        if func is None:
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error("[Summary] job callback failed: %s", e)
+
+
+class _Runner:
+    """
+    工作线程专用的执行线程，任务本体在其中执行以便按时返回超时提示。
+    线程反复使用，其中打开的数据库连接等线程级资源不会随任务数增长
+    """
+
+    def __init__(self, name: str):
+        self._calls = queue.Queue()
+        threading.Thread(target=self._loop, name=name, daemon=True).start()
+
+    def submit(self, func: Callable[[], object]) -> Future:
+        future = Future()
+        self._calls.put((func, future))
+        return future
+
+    def _loop(self):
+        while True:
+            func, future = self._calls.get()
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
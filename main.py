@@ -1,11 +1,21 @@
 # encoding:utf-8
 
+import copy
+import io
 import json
 import os, re
+import random
 import time
 import threading
-from typing import Optional, Tuple
+from datetime import datetime
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Tuple
 
+# 下面这些依赖的导入耗时，和初始化耗时一起在启动日志和状态指令中给出
+_IMPORT_STARTED = time.perf_counter()
+
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerPool
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from bot import bot_factory
@@ -21,8 +31,20 @@ from common.log import logger
 from common import const
 
 from plugins.linkai.utils import Util
-from plugins.plugin_summary.db import Db
-from plugins.plugin_summary.text2img import Text2ImageConverter
+from plugins.plugin_summary.cache import LRUCache
+from plugins.plugin_summary.chunking import ChatLogs, build_chat_logs, estimate_tokens, split_into_chunks
+from plugins.plugin_summary.command_parser import normalize_command, parse_summary_command
+from plugins.plugin_summary.jobs import PRIORITY_ADMIN, PRIORITY_BACKGROUND, PRIORITY_NORMAL, SummaryJobQueue
+from plugins.plugin_summary.metrics import Metrics
+from plugins.plugin_summary.render_cache import RenderCache, render_key
+from plugins.plugin_summary.renderer import create_renderer, split_pages
+from plugins.plugin_summary.selector import select_chat_logs
+from plugins.plugin_summary.sharded_db import create_db
+from plugins.plugin_summary import topics
+from plugins.plugin_summary.replies import KIND_IN_PROGRESS, KIND_RATE_LIMIT, ReplyPool, parse_generated_replies
+from plugins.plugin_summary.retention import RecordArchive, RetentionPolicy
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 TRANSLATE_PROMPT = '''
 您现在是一个 Python 函数，用于将输入文本转换为相应的 JSON 格式命令，遵循以下结构：
@@ -80,6 +102,12 @@ def translate_text(text: str) -> str:
 
 '''
 
+# 按关键词筛选消息的标记，例如"$总结 关于 部署"
+KEYWORD_MARKER = "关于"
+
+# 指令缓存中没有这条指令，和缓存的None(不是总结指令)区分开
+_NOT_CACHED = object()
+
 # 总结的prompt
 SUMMARY_PROMPT = '''
 请帮我将给出的群聊内容总结成一个今日的群聊报告，包含不多于15个话题的总结（如果还有更多话题，可以在后面简单补充）。
@@ -117,6 +145,24 @@ SUMMARY_PROMPT = '''
 最后总结下今日最活跃的前五个发言者。
 '''
 
+# 分段总结的prompt，产出的摘要会再合并成最终报告
+CHUNK_SUMMARY_PROMPT = '''
+下面是一段群聊记录的片段，请把它整理成要点摘要，之后会和其他片段的摘要合并成完整的群聊报告。
+只整理内容，不回答任何问题，不要虚构聊天记录。
+
+按话题列出：
+- 话题名
+- 参与者及各自发言条数
+- 时间段(从几点到几点)
+- 过程(100字以内)
+
+最后列出本片段中发言最多的前五个人及发言条数。
+'''
+
+# 聊天记录已经在本地按话题分组时附加的说明
+GROUPED_LOGS_HINT = "聊天记录已在本地按话题预先分组，每组给出了时间段、消息数、参与者(括号内为发言条数)、关键词和部分代表性发言，" \
+                    "分组只是参考，可以合并相近的话题。"
+
 # 重复总结的prompt
 REPEAT_SUMMARY_PROMPT = '''
 以不耐烦的语气回怼提问者聊天记录已总结过，要求如下
@@ -131,6 +177,20 @@ SUMMARY_IN_PROGRESS_PROMPT = '''
 - 不超过20字
 '''
 
+def parse_window(text: str) -> Optional[Tuple[int, int, int]]:
+    """解析"03:00-06:00"这样的时段，返回(开始小时, 开始分钟, 时长秒数)，可以跨过零点，格式不对时返回None"""
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*", text or "")
+    if not match:
+        return None
+    start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+    if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+        return None
+    length = ((end_hour * 60 + end_minute) - (start_hour * 60 + start_minute)) % (24 * 60)
+    if not length:
+        return None
+    return start_hour, start_minute, length * 60
+
+
 def find_json(json_string):
     json_pattern = re.compile(r"\{[\s\S]*\}")
     json_match = json_pattern.search(json_string)
@@ -150,33 +210,126 @@ class Summary(Plugin):
     TRIGGER_PREFIX = "$"
     DEFAULT_LIMIT = 9999
     DEFAULT_DURATION = -1
+    # 不带条件的总结指令，见_request_key
+    _PLAIN_REQUEST = (None, DEFAULT_DURATION, (), ())
     
     def __init__(self):
         super().__init__()
-        self._init_components()
+        started = time.perf_counter()
         self._init_config()
+        self._init_components()
         self._init_handlers()
+        init_seconds = time.perf_counter() - started
+        self.metrics.observe("import_seconds", _IMPORT_SECONDS)
+        self.metrics.observe("init_seconds", init_seconds)
+        logger.info("[Summary] loaded, import %.0fms, init %.0fms", _IMPORT_SECONDS * 1000, init_seconds * 1000)
         
     def _init_config(self):
         """初始化配置"""
         self.config = super().load_config() or self._load_config_template()
         logger.info(f"[Summary] initialized with config={self.config}")
-        
-        # 设置定时清理任务
-        save_time = self.config.get("save_time", -1)
-        if save_time > 0:
-            self._setup_scheduler()
             
     def _init_components(self):
         """初始化组件"""
-        self.text2img = Text2ImageConverter()
-        self.db = Db()
-        self.bot = bot_factory.create_bot(Bridge().btype['chat'])
+        # 各阶段耗时和计数，管理员用"$总结 状态"查看，配置了metrics_file时定期导出
+        self.metrics = Metrics()
+        metrics_file = self.config.get("metrics_file")
+        if metrics_file:
+            if not os.path.isabs(metrics_file):
+                metrics_file = os.path.join(os.path.dirname(__file__), metrics_file)
+            self.metrics.start_export(metrics_file, self.config.get("metrics_interval", 60))
+
+        # 渲染器和大模型客户端在第一次用到时才创建，见renderer和bot属性；
+        # 数据库打开时只做很快的迁移，耗时长的迁移和启动时的过期清理都在后台线程进行
+        self._renderer = None
+        self._bot = None
+        self._components_lock = threading.Lock()
+        self.db = create_db(self.config, os.path.dirname(__file__), self.metrics)
+
+        # 渲染结果按文本和样式缓存在内存和磁盘，长报告按话题分页后渲染
+        render_cache_dir = self.config.get("render_cache_dir", "render_cache")
+        if render_cache_dir and not os.path.isabs(render_cache_dir):
+            render_cache_dir = os.path.join(os.path.dirname(__file__), render_cache_dir)
+        self._render_cache = RenderCache(render_cache_dir or None,
+                                         memory_bytes=self.config.get("render_cache_memory_mb", 32) << 20,
+                                         disk_bytes=self.config.get("render_cache_disk_mb", 256) << 20)
+        self._render_pool = ThreadPoolExecutor(max_workers=self.config.get("render_workers", 2),
+                                               thread_name_prefix="summary-render")
         
-        # 线程安全相关
+        # 分段总结共用的线程池，限制同时进行的大模型调用数
+        self._llm_pool = ThreadPoolExecutor(max_workers=self.config.get("summary_parallelism", 4),
+                                            thread_name_prefix="summary-llm")
+
+        # 总结任务队列，限制同时进行的总结数量
+        self._job_queue = SummaryJobQueue(workers=self.config.get("summary_workers", 2),
+                                          per_session=self.config.get("summary_session_concurrency", 1),
+                                          timeout=self.config.get("summary_timeout", 300))
+
+        # 限流和总结中的快捷回复，空闲时后台补充
+        self._reply_pool = ReplyPool(os.path.join(os.path.dirname(__file__), "replies.json"),
+                                     generator=self._generate_replies, is_idle=self._job_queue.idle)
+
+        # 每个会话最近一次的报告及其覆盖到的消息时间，用于增量总结
+        self._report_cache = LRUCache(maxsize=self.config.get("report_cache_size", 200),
+                                      ttl=self.config.get("report_cache_ttl", 24 * 60) * 60)
+
+        # 短时间内条件相同、期间没有新消息的重复请求直接用上次的报告，见_get_cached_result，有效期为0时不缓存
+        result_ttl = self.config.get("result_cache_ttl", 120)
+        self._result_cache = LRUCache(maxsize=self.config.get("report_cache_size", 200),
+                                      ttl=result_ttl) if result_ttl > 0 else None
+
+        # 大模型解析指令的结果缓存
+        self._command_cache = LRUCache(maxsize=self.config.get("command_cache_size", 256))
+
+        # 线程安全相关，每个会话正在进行的总结，见_acquire_summary_lock
         self._summary_locks = {}
         self._locks_lock = threading.Lock()
+
+        # 设置定时清理任务
+        archive_dir = self.config.get("archive_dir")
+        if archive_dir and not os.path.isabs(archive_dir):
+            archive_dir = os.path.join(os.path.dirname(__file__), archive_dir)
+        self._retention = RetentionPolicy(self.db, save_time=self.config.get("save_time", -1),
+                                          overrides=self.config.get("save_time_overrides"),
+                                          archive=RecordArchive(archive_dir) if archive_dir else None,
+                                          batch_size=self.config.get("retention_batch_size", 500))
+        # 低峰期预生成报告的时段
+        self._digest_windows = []
+        for text in self.config.get("digest_windows") or []:
+            window = parse_window(text)
+            if window is None:
+                logger.warning("[Summary] invalid digest window %s, expected like 03:00-06:00", text)
+            else:
+                self._digest_windows.append(window)
+
+        if self._retention.enabled() or self._digest_windows:
+            self._setup_scheduler()
         
+    @property
+    def renderer(self):
+        if self._renderer is None:
+            return self._create_component("renderer", lambda: create_renderer(self.config, self.metrics))
+        return self._renderer
+
+    @property
+    def bot(self):
+        if self._bot is None:
+            return self._create_component("bot", lambda: bot_factory.create_bot(Bridge().btype['chat']))
+        return self._bot
+
+    def _create_component(self, name: str, factory: Callable):
+        """创建第一次用到的组件并记录耗时，在锁内赋值，保证并发的总结任务只创建一次"""
+        with self._components_lock:
+            component = getattr(self, "_" + name)
+            if component is None:
+                started = time.perf_counter()
+                component = factory()
+                seconds = time.perf_counter() - started
+                self.metrics.observe(name + "_init_seconds", seconds)
+                logger.info("[Summary] %s created in %.0fms", name, seconds * 1000)
+                setattr(self, "_" + name, component)
+            return component
+
     def _init_handlers(self):
         """初始化事件处理器"""
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
@@ -222,59 +375,182 @@ class Summary(Plugin):
         if "关闭" in content:
             self.db.save_summary_stop(session_id)
             return Reply(ReplyType.TEXT, "关闭成功")
+
+        # 只认"$总结 状态"，其他插件的指令(如"$天气 状态")放行
+        if "".join(content.split()) == self.TRIGGER_PREFIX + "总结状态":
+            return Reply(ReplyType.TEXT, self.metrics.format_status(session_id))
             
         return None
 
-    def _handle_summary_command(self, content: str, session_id: str, e_context: EventContext) -> Reply:
-        """处理总结命令"""
+    def _handle_summary_command(self, content: str, session_id: str, e_context: EventContext) -> Optional[Reply]:
+        """处理总结命令：检查通过后放入任务队列，立即回复排队情况，总结结果由工作线程发送"""
+        key = self._request_key(content)
         # 检查锁
-        if not self._acquire_summary_lock(session_id):
-            return self._get_in_progress_reply(session_id, content)
-            
+        flight = self._acquire_summary_lock(session_id, key, e_context)
+        if flight is None:
+            # 条件相同的总结正在进行时等它的结果，不用再回复
+            if self._join_summary(session_id, key, e_context):
+                self.metrics.incr("summary_coalesced", session_id=session_id)
+                return self._quiet_reply(e_context, None)
+            return self._quiet_reply(e_context, self._get_in_progress_reply(session_id))
+
         try:
+            # 已有条件相同或覆盖相同范围的报告且之后没有新消息时直接回复，不用排队。
+            # 不调用大模型，所以在限流之前检查，也不计入群里的总结次数
+            result_key = (session_id, self.db.latest_rowid(session_id), key)
+            ready = None
+            if not self.db.is_disabled(session_id):
+                ready = self._get_cached_result(result_key) or self._get_ready_report(session_id, key)
+            if ready:
+                self._release_summary_lock(session_id)
+                if len(ready) == 1:
+                    return ready[0]
+                # 多页时按顺序由通道发送
+                _send_replies(e_context, ready)
+                return self._quiet_reply(e_context, None)
+
             # 检查限制
-            if error_reply := self._check_summary_limits(session_id):
-                return error_reply
-            
-            # 添加回复
-            _send_info(e_context, "正在加速生成总结，请稍等")
-            # 解析命令参数
-            limit, duration, username = self._parse_summary_args(content)
-            
-            # 生成总结
-            start_time = int(time.time()) - duration if duration > 0 else 0
-            return self._generate_summary(session_id,start_time= start_time,limit= limit ,username=username)
-            
+            blocked, error_reply = self._check_summary_limits(session_id)
+            if blocked:
+                self._release_summary_lock(session_id)
+                return self._quiet_reply(e_context, error_reply)
+
+            priority = PRIORITY_ADMIN if Util.is_admin(e_context) else PRIORITY_NORMAL
+            queued_at = time.perf_counter()
+            self.metrics.incr("summary_requests", session_id=session_id)
+            ahead = self._job_queue.submit(
+                session_id,
+                run=lambda: self._run_summary_job(content, session_id, e_context, queued_at, result_key,
+                                                  on_report=lambda: flight.update(summarized=True)),
+                on_result=lambda replies: flight.update(replies=replies),
+                on_timeout=lambda: self._summary_timed_out(flight),
+                on_finish=lambda: self._finish_summary(session_id),
+                priority=priority,
+            )
         except Exception as e:
             logger.error(f"[Summary] Error handling summary command: {e}")
-            return Reply(ReplyType.TEXT, "处理总结命令时发生错误")
-        finally:
             self._release_summary_lock(session_id)
+            return Reply(ReplyType.TEXT, "处理总结命令时发生错误")
 
-    def _check_summary_limits(self, session_id: str) -> Optional[Reply]:
-        """检查总结"""
-        if session_id in self.db.disable_group:
-            return Reply(ReplyType.TEXT, "请联系管理员开启总结功能")
+        if ahead:
+            return Reply(ReplyType.TEXT, f"已加入总结队列，前面还有{ahead}个任务，请稍等")
+        return Reply(ReplyType.TEXT, "正在加速生成总结，请稍等")
+
+    def _run_summary_job(self, content: str, session_id: str, e_context: EventContext,
+                         queued_at: float = None, result_key: tuple = None,
+                         on_report: Callable[[], None] = None) -> List[Reply]:
+        """在工作线程中执行的总结任务，result_key见_get_cached_result，on_report见_generate_summary"""
+        if queued_at is not None:
+            self.metrics.observe("queue_wait_seconds", time.perf_counter() - queued_at, session_id)
+        try:
+            with self.metrics.timer("summary", session_id):
+                # 解析命令参数
+                with self.metrics.timer("parse", session_id):
+                    limit, duration, username, keywords = self._parse_summary_args(content)
+
+                # 生成总结
+                start_time = int(time.time()) - duration if duration and duration > 0 else 0
+                return self._generate_summary(session_id, start_time=start_time, limit=limit, username=username,
+                                              keywords=keywords, progress=lambda text: _send_info(e_context, text),
+                                              result_key=result_key, on_report=on_report)
+            
+        except Exception as e:
+            logger.error(f"[Summary] Error handling summary command: {e}")
+            return [Reply(ReplyType.TEXT, "处理总结命令时发生错误")]
+
+    def _request_key(self, content: str) -> tuple:
+        """
+        总结请求的条件，相同的请求可以共用一次总结的结果。只用本地规则解析，
+        识别不了的按归一化后的指令区分
+        """
+        limit, duration, username, keywords = self._parse_summary_args(content, use_llm=False)
+        if duration is None:
+            return "text", normalize_command(content)
+        return limit, duration, tuple(sorted(username)), tuple(sorted(keywords))
+
+    def _covers(self, running: tuple, key: tuple) -> bool:
+        """
+        条件为running的总结是否覆盖条件为key的请求：@的人和关键词相同，running不限条数(或条数相同)，
+        时长不短于key(DEFAULT_DURATION表示全部记录)。识别不了的指令只和相同的指令共用
+        """
+        if running == key:
+            return True
+        if running[0] == "text" or key[0] == "text" or running[2:] != key[2:]:
+            return False
+        if running[0] is not None and running[0] != key[0]:
+            return False
+        return running[1] == self.DEFAULT_DURATION or key[1] != self.DEFAULT_DURATION and key[1] <= running[1]
+
+    def _get_cached_result(self, result_key: tuple) -> Optional[List[Reply]]:
+        """
+        同一个群短时间内条件相同的请求，期间没有新消息时直接用上次的报告，图片通常已在渲染缓存中。
+        按时长总结时起止时间会随时间推移，在result_cache_ttl内视为相同
+
+        :param result_key: (群, 最后写入的记录的rowid, 请求条件)，rowid精确到每条消息，同一秒内的新消息也会让缓存失效
+        """
+        if self._result_cache is None:
+            return None
+        report = self._result_cache.get(result_key)
+        if report is None:
+            return None
+        self.metrics.incr("result_cache_hits", session_id=result_key[0])
+        return self._report_replies(result_key[0], report)
+
+    def _get_ready_report(self, session_id: str, key: tuple) -> Optional[List[Reply]]:
+        """
+        不带条件的总结指令，如果已有的报告(低峰期预生成的或上次总结的)覆盖全部记录、之后没有新消息，
+        直接返回报告图片，图片通常已在渲染缓存中
+        """
+        if key != self._PLAIN_REQUEST:
+            return None
+        cached = self._get_cached_report(session_id, 0)
+        if not cached or cached["start_time"] != 0:
+            return None
+        if self.db.latest_rowid(session_id) > cached["watermark_id"]:
+            return None
+        if cached.get("digest"):
+            self.metrics.incr("digest_hits", session_id=session_id)
+        return self._report_replies(session_id, cached["report"])
+
+    def _check_summary_limits(self, session_id: str) -> Tuple[bool, Optional[Reply]]:
+        """检查总结限制，返回(是否拦截, 回复)，拦截但回复为None表示防抖期内的重复触发"""
+        if self.db.is_disabled(session_id):
+            return True, Reply(ReplyType.TEXT, "请联系管理员开启总结功能")
             
         limit_time = self.config.get("rate_limit_summary", 60) * 60
         last_time = self.db.get_summary_time(session_id)
         
         if last_time and time.time() - last_time < limit_time:
-            return self._get_rate_limit_reply(session_id)
+            # 限流期内每个群只回怼一次
+            return True, self._get_rate_limit_reply(session_id, last_time + limit_time - time.time())
             
-        return None
+        return False, None
 
-    def _parse_summary_args(self, content: str) -> Tuple[int, int, str]:
+    @staticmethod
+    def _quiet_reply(e_context: EventContext, reply: Optional[Reply]) -> Optional[Reply]:
+        """回复为None时不回复，但仍然拦截这条消息，避免交给其他插件或机器人"""
+        if reply is None:
+            e_context.action = EventAction.BREAK_PASS
+        return reply
+
+    def _parse_summary_args(self, content: str, use_llm: bool = True) -> Tuple[int, int, list, list]:
         """解析总结参数
         
         Args:
-            content: 用户输入的命令内容，例如"@妮可 @欧尼 3小时内的前99条消息"
+            content: 用户输入的命令内容，例如"@妮可 @欧尼 3小时内的前99条消息"、"关于 部署 上线"
+            use_llm: 本地规则识别不了时是否交给大模型解析
             
         Returns:
-            Tuple[int, int, str]: 返回(消息数量限制, 时间范围(秒), 用户名列表)的���组
-            如果解析失败返回(None, None, None)
+            Tuple[int, int, list, list]: 返回(消息数量限制, 时间范围(秒), 用户名列表, 关键词列表)的元组
+            如果解析失败返回(None, None, None, None)
         """
         try:
+            # "关于"之后的内容都是关键词
+            keywords = []
+            if KEYWORD_MARKER in content:
+                content, keyword_text = content.split(KEYWORD_MARKER, 1)
+                keywords = [k for k in re.split(r"[\s,，、]+", keyword_text) if k]
+
             # 先提取所有@用户名
             usernames = []
             parts = content.split()
@@ -287,32 +563,54 @@ class Summary(Plugin):
                     cleaned_content.append(part)
                     
             content = ''.join(cleaned_content)
-            print(f"[Summary] username: {len(usernames)}")
-            # 将中文内容转换为标准命令格式
-            command_json = find_json(self._translate_text_to_commands(content))
-            command = json.loads(command_json)
-            
-            if command["name"].lower() == "summary":
-                args = command["args"]
-                limit = int(args.get("count", None))
-                # 获取消息数量限制
-                # limit = max(int(args.get("count", self.DEFAULT_LIMIT)), 0)
-                
-                # 获取时间范围(秒)
-                duration = args.get("duration_in_seconds", self.DEFAULT_DURATION)
-                if isinstance(duration, str):
-                    # 处理可能的时间字符串
-                    duration = int(float(duration))
-                duration = max(int(duration), 0) or self.DEFAULT_DURATION
-                
-                logger.debug(f"[Summary] Parsed args: limit={limit}, duration={duration}, users={usernames}")
-                return limit, duration, usernames
+            logger.debug(f"[Summary] username: {len(usernames)}")
+            # 先用本地规则解析，识别不了的再交给大模型
+            parsed = parse_summary_command(content)
+            if parsed is None and use_llm:
+                parsed = self._parse_summary_args_by_llm(content)
+            if parsed is not None:
+                limit, duration = parsed
+                duration = duration or self.DEFAULT_DURATION
+                logger.debug(f"[Summary] Parsed args: limit={limit}, duration={duration}, users={usernames}, "
+                             f"keywords={keywords}")
+                return limit, duration, usernames, keywords
                 
         except Exception as e:
             logger.error(f"[Summary] Failed to parse command: {e}")
             logger.debug(f"[Summary] Original content: {content}")
             
-        return None, None, None
+        return None, None, None, None
+
+    def _parse_summary_args_by_llm(self, content: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """用大模型解析本地规则识别不了的指令，结果按归一化后的指令缓存"""
+        cache_key = normalize_command(content)
+        parsed = self._command_cache.get(cache_key, _NOT_CACHED)
+        if parsed is not _NOT_CACHED:
+            logger.debug(f"[Summary] command cache hit: {cache_key}")
+            return parsed
+
+        # 将中文内容转换为标准命令格式
+        command_json = find_json(self._translate_text_to_commands(content))
+        command = json.loads(command_json)
+        if command["name"].lower() != "summary":
+            # 不是总结指令的结果也缓存，重复发送同样的内容不再调用大模型
+            self._command_cache.set(cache_key, None)
+            return None
+
+        args = command["args"]
+        # 获取消息数量限制
+        count = args.get("count")
+        limit = int(count) if count else None
+        # 获取时间范围(秒)
+        duration = args.get("duration_in_seconds")
+        if isinstance(duration, str):
+            # 处理可能的时间字符串
+            duration = int(float(duration))
+        duration = max(int(duration), 0) if duration else None
+
+        parsed = (limit, duration)
+        self._command_cache.set(cache_key, parsed)
+        return parsed
 
     def _load_config_template(self):
         logger.debug("No summary plugin config.json, use plugins/linkai/config.json.template")
@@ -329,18 +627,85 @@ class Summary(Plugin):
         # 创建调度器
         self.scheduler = BackgroundScheduler()
 
-        # 清理旧记录的函数
-        def clean_old_records():
-            # 配置文件单位分钟，转换为秒
-            save_time = self.config.get("save_time", 12 * 60) * 60
-            self.db.delete_records(int(time.time()) - save_time)
-
-        # 设置定时任务，每天凌晨12点执行
-        self.scheduler.add_job(clean_old_records, 'cron', hour=00, minute=00)
+        # 设置定时任务，按固定间隔分批清理过期记录，启动后立即在后台执行一次
+        if self._retention.enabled():
+            interval = self.config.get("retention_interval", 60)
+            self.scheduler.add_job(self._retention.run, 'interval', minutes=interval, next_run_time=datetime.now(),
+                                   max_instances=1, coalesce=True)
+            logger.info("Cleaning old records every %d minutes.", interval)
+
+        # 每个低峰时段开始时挑出活跃的群，在时段内错开预生成报告；
+        # 预生成任务在单独的线程池中提交并等待完成，线程数即同时进行的预生成数量
+        if self._digest_windows:
+            self.scheduler.add_executor(SchedulerPool(max(self.config.get("digest_concurrency", 1), 1)), "digest")
+            for hour, minute, length in self._digest_windows:
+                self.scheduler.add_job(self._plan_digests, 'cron', hour=hour, minute=minute, args=[length],
+                                       max_instances=1, coalesce=True, misfire_grace_time=length // 2)
+                logger.info("Generating digests from %02d:%02d for %d minutes.", hour, minute, length // 60)
         # 启动调度器
         self.scheduler.start()
-        clean_old_records()
-        logger.info("Scheduler started. Cleaning old records every day at midnight.")
+        logger.info("Scheduler started.")
+
+    def _plan_digests(self, length: int):
+        """低峰时段开始时执行：挑出没有关闭总结、新消息足够多的群，把预生成任务随机错开在时段内"""
+        now = time.time()
+        min_messages = self.config.get("digest_min_messages", 50)
+        sessions = [session_id for session_id in self.db.list_sessions()
+                    if not self.db.is_disabled(session_id) and self._count_new_messages(session_id) >= min_messages]
+        # 时段的最后五分之一留给排队和执行
+        for session_id in sessions:
+            run_at = datetime.fromtimestamp(now + random.uniform(0, length * 0.8))
+            self.scheduler.add_job(self._run_digest, 'date', run_date=run_at, args=[session_id, now + length],
+                                   executor="digest", misfire_grace_time=None)
+        logger.info("[Summary] %d groups scheduled for digest in the next %d minutes", len(sessions), length // 60)
+
+    def _count_new_messages(self, session_id: str) -> int:
+        """上次报告之后的新消息数，从活跃度汇总表统计"""
+        cached = self._report_cache.get(session_id) or self._load_digest(session_id)
+        # 包括与watermark同一秒、之后写入的消息，多算的只有同一秒内已经总结过的几条
+        since = cached["watermark"] if cached else None
+        return sum(count for _, count in self.db.get_activity_histogram(session_id, since))
+
+    def _run_digest(self, session_id: str, deadline: float):
+        """在digest线程池中执行：以最低优先级提交到总结队列并等待完成，用户的总结请求总是优先"""
+        if time.time() > deadline:
+            logger.info("[Summary] digest window is over, skip %s", session_id)
+            return
+        # 关闭了总结的群跳过
+        if self.db.is_disabled(session_id):
+            return
+        # 排队期间不加锁，群里的总结请求照常排在前面；开始执行时正在总结的群跳过
+        started = {}
+        finished = threading.Event()
+
+        def run() -> Optional[List[Reply]]:
+            # 执行期间群里发来的不带条件的总结指令挂到这次预生成上，完成后发给他们
+            flight = self._acquire_summary_lock(session_id, self._PLAIN_REQUEST)
+            if flight is None:
+                return None
+            started["flight"] = flight
+            return self._generate_digest(session_id)
+
+        def on_result(replies):
+            if "flight" in started:
+                started["flight"].update(replies=replies)
+
+        def on_timeout():
+            if "flight" in started:
+                self._summary_timed_out(started["flight"])
+
+        def on_finish():
+            if "flight" in started:
+                self._finish_summary(session_id)
+            finished.set()
+
+        self._job_queue.submit(session_id, run=run, on_result=on_result, on_timeout=on_timeout, on_finish=on_finish,
+                               priority=PRIORITY_BACKGROUND)
+        finished.wait()
+
+    def _generate_digest(self, session_id: str) -> List[Reply]:
+        with self.metrics.timer("digest", session_id):
+            return self._generate_summary(session_id, background=True)
 
     def on_receive_message(self, e_context: EventContext):
 
@@ -349,19 +714,18 @@ class Summary(Plugin):
         context = e_context['context']
         cmsg: ChatMessage = e_context['context']['msg']
         
-        session_id = cmsg.from_user_id
-        if session_id in self.db.disable_group:
-            logger.info("[Summary] group %s is disabled" % session_id)
+        # itchat channel id会变动，只好用群名作为session id，开关总结时用的也是这个id
+        session_id = self._get_session_id(cmsg)
+        if self.db.is_disabled(session_id):
+            logger.debug("[Summary] group %s is disabled" % session_id)
             return
         
-        if "{trigger_prefix}总结" in context.content:
+        # 与_handle_command的判断一致，总结指令不保存，否则会推后最新消息的时间，已有的报告就用不上了
+        if self.TRIGGER_PREFIX + "总结" in context.content:
             logger.debug("[Summary] 指令不保存: %s" % context.content)
             return
         
         username = None
- 
-        if conf().get('channel_type', 'wx') == 'wx' and cmsg.from_user_nickname is not None:
-            session_id = cmsg.from_user_nickname  # itchat channel id会变动，只好用群名作为session id
 
         if context.get("isgroup", False):
             username = cmsg.actual_user_nickname
@@ -389,75 +753,408 @@ class Summary(Plugin):
         logger.debug("[Summary] save record: %s" % context.content)
         self.db.insert_record(session_id, cmsg.msg_id, username, context.content, str(context.type), cmsg.create_time,
                               int(is_triggered))
+        self.metrics.incr("messages_ingested", session_id=session_id)
 
-    def _acquire_summary_lock(self, session_id: str) -> bool:
+    def _acquire_summary_lock(self, session_id: str, key: tuple = None,
+                              e_context: EventContext = None) -> Optional[dict]:
         """
         尝试获取指定会话的总结锁
-        返回是否成功获取锁
+        成功时返回这次总结的记录，任务完成后结果存入其中的replies，生成了报告时summarized为True；
+        正在进行总结时返回None
+
+        :param key: 请求条件，见_request_key，条件相同的请求可以挂到这次总结上
+        :param e_context: 发起人，预生成报告时为None
         """
         with self._locks_lock:
             if session_id in self._summary_locks:
                 # 如果锁已存在，说明正在进行总结
+                return None
+            flight = {"key": key, "e_context": e_context, "waiters": [], "replies": None, "summarized": False,
+                      "closed": False}
+            self._summary_locks[session_id] = flight
+            return flight
+
+    def _join_summary(self, session_id: str, key: tuple, e_context: EventContext) -> bool:
+        """正在进行的总结覆盖这次请求的范围时挂到它上面，完成后一起收到结果，返回是否挂上"""
+        with self._locks_lock:
+            flight = self._summary_locks.get(session_id)
+            if flight is None or flight["closed"] or not self._covers(flight["key"], key):
                 return False
-            self._summary_locks[session_id] = time.time()
+            flight["waiters"].append(e_context)
             return True
 
-    def _release_summary_lock(self, session_id: str):
-        """释放指定会话的总结锁"""
+    def _release_summary_lock(self, session_id: str) -> Optional[dict]:
+        """释放指定会话的总结锁，返回这次总结的记录"""
+        with self._locks_lock:
+            return self._summary_locks.pop(session_id, None)
+
+    def _summary_timed_out(self, flight: dict):
+        """总结超时，结果会被丢弃，之后的请求不再挂到这次总结上"""
         with self._locks_lock:
-            self._summary_locks.pop(session_id, None)
+            flight["closed"] = True
+            targets = _flight_targets(flight)
+        if targets:
+            _send_info(targets[0], "总结超时了，请稍后再试")
+
+    def _finish_summary(self, session_id: str):
+        """总结任务结束：释放锁并发送结果，挂上来的请求都在同一个群里，发一次大家都能看到"""
+        flight = self._release_summary_lock(session_id)
+        if not flight or not flight["replies"]:
+            return
+        targets = _flight_targets(flight)
+        if flight["waiters"]:
+            logger.info("[Summary] %d requests of %s coalesced into one summary", len(flight["waiters"]), session_id)
+        if not targets:
+            return
+        if flight["e_context"] is not None and flight["summarized"]:
+            # 报告送达后才计入群里的总结次数。预生成的报告有人在等时和直接回复预生成的报告一样，不计入
+            self.db.save_summary_time(session_id, int(time.time()))
+        _send_replies(targets[0], flight["replies"])
+
+    def _generate_summary(self, session_id: str, start_time: int = None, limit: int = None, username: list = None,
+                          keywords: list = None, progress: Callable[[str], None] = None,
+                          background: bool = False, result_key: tuple = None,
+                          on_report: Callable[[], None] = None) -> List[Reply]:
+        """生成聊天记录总结
 
-    def _generate_summary(self, session_id: str, start_time: int = None, limit: int = None, username: list = None) -> Reply:
-        """生成聊天记录总结"""
+        Args:
+            keywords: 只总结包含这些关键词的消息
+            progress: 进度回调，分段总结时用来向群里发送进度
+            background: 低峰期预生成，报告保存为该群的预生成报告，图片留在渲染缓存中
+            on_report: 报告生成成功后的回调
+            result_key: 报告存入短期结果缓存时的键，见_get_cached_result
+
+        Returns:
+            要发送的回复，报告较长时每页一张图片
+        """
         try:
-            records = self.db.get_records(session_id, start_timestamp=start_time, limit=limit, username=username)
-
-            # 检查记录数量
-            if not records:
-                return Reply(ReplyType.TEXT, "未找到相关聊天记录")
-            if len(records) == 1:
-                return Reply(ReplyType.TEXT, "聊天记录太少，无法生成有意义的总结")
-
-            # 构建聊天记录文本
-            chat_logs = []
-            for record in records:
-                chat_logs.append(f"{record[2]}({record[7]}): {record[3]}")
-            chat_text = "\n".join(chat_logs)
-            
-            logger.debug("[Summary] Processing %d chat records for summary", len(records))
+            start_time = start_time or 0
+            # 只有不限条数、不按人筛选的总结才能在上次报告的基础上增量更新
+            incremental = not limit and not username and not keywords
+            cached = self._get_cached_report(session_id, start_time) if incremental else None
+            budget = self.config.get("prompt_token_budget", 60000)
+            # 读到的最新一条记录的时间和最大的rowid，作为报告覆盖到的位置
+            newest = {}
+            if cached:
+                # 上次报告之后写入的消息，包括时间较早、晚到的消息
+                with self.metrics.timer("select", session_id), \
+                        closing(self.db.iter_records(session_id, start_timestamp=max(cached["start_time"], start_time),
+                                                     after_id=cached["watermark_id"],
+                                                     columns="user, timestamp, content, rowid")) as rows:
+                    chat_logs = build_chat_logs(_track_newest(rows, newest), budget)
+                if chat_logs.truncated:
+                    # 新消息超出预算时放弃增量，整个范围重新抽样总结，报告的位置不会越过没放进去的新消息
+                    logger.info("[Summary] too many new records for an incremental summary of %s, summarize again",
+                                session_id)
+                    cached = None
+                    newest = {}
+                else:
+                    logger.info("[Summary] incremental summary for %s, %d new records", session_id, chat_logs.rows)
+            if cached:
+                segmenter = cached.get("topics")
+                if chat_logs.rows and segmenter:
+                    # 新消息继续归入上次的话题分组，复制一份以免合并失败时污染缓存
+                    chat_logs, segmenter = self._group_by_topic(session_id, chat_logs, copy.deepcopy(segmenter))
+                if chat_logs.rows:
+                    stats = self._format_activity(session_id, max(cached["start_time"], start_time),
+                                                  max(chat_logs.newest, cached["watermark"]) + 1)
+                    reply_content = self._merge_into_report(session_id, cached, chat_logs, start_time, progress,
+                                                            stats)
+                else:
+                    reply_content = cached["report"]
+                # 晚到的消息时间可能早于上次的watermark
+                watermark = max(newest.get("timestamp", 0), cached["watermark"])
+                watermark_id = newest.get("rowid", cached["watermark_id"])
+            else:
+                with self.metrics.timer("select", session_id), \
+                        closing(self.db.iter_records(session_id, start_timestamp=start_time, limit=limit,
+                                                     username=username, keywords=keywords,
+                                                     columns="user, timestamp, content, is_triggered, rowid")) as rows:
+                    chat_logs = select_chat_logs(_track_newest(rows, newest), budget, buckets=self.config.get("sample_buckets", 12),
+                                                 max_line_tokens=self.config.get("max_line_tokens", 200))
+
+                # 检查记录数量
+                if not chat_logs.rows:
+                    return [Reply(ReplyType.TEXT, "未找到相关聊天记录")]
+                if chat_logs.rows == 1:
+                    return [Reply(ReplyType.TEXT, "聊天记录太少，无法生成有意义的总结")]
+
+                logger.info("[Summary] selected %d chat records (%d tokens) for %s, dropped %d records (%d tokens)",
+                            chat_logs.rows, chat_logs.tokens, session_id, chat_logs.dropped_rows,
+                            chat_logs.dropped_tokens)
+
+                chat_logs, segmenter = self._group_by_topic(session_id, chat_logs)
+                # 按人或关键词筛选时统计的是筛选后的记录，汇总表给不出，交给大模型自己数
+                stats = "" if username or keywords else \
+                    self._format_activity(session_id, chat_logs.oldest, chat_logs.newest + 1)
+
+                # 生成总结
+                reply_content = self._summarize_chat_logs(session_id, chat_logs, progress, stats)
+                watermark, watermark_id = newest["timestamp"], newest["rowid"]
+            if not reply_content:
+                return [Reply(ReplyType.TEXT, "生成总结失败，请稍后重试")]
+
+            report = None
+            if incremental:
+                report = {
+                    "report": reply_content,
+                    "start_time": max(cached["start_time"], start_time) if cached else start_time,
+                    "watermark": watermark,
+                    "watermark_id": watermark_id,
+                    "topics": segmenter,
+                    # 预生成的报告，直接回复时计入digest_hits
+                    "digest": background,
+                }
+                self._report_cache.set(session_id, report)
+            if result_key is not None and self._result_cache is not None:
+                self._result_cache.set(result_key, reply_content)
+
+            # 总结时间由调用方在结果送达后记录，超时被丢弃的结果不计入群里的总结次数
+            if on_report is not None:
+                on_report()
+
+            # 转换为图片，预生成时渲染好的图片留在渲染缓存中
+            replies = self._report_replies(session_id, reply_content)
+            if background:
+                self.db.save_digest(session_id, report["start_time"], report["watermark"], reply_content,
+                                    report["watermark_id"])
+                self.metrics.incr("digests", session_id=session_id)
+                logger.info("[Summary] digest of %s is ready", session_id)
+            return replies
 
-            # 生成总结
-            session = self.bot.sessions.build_session(session_id, SUMMARY_PROMPT)
-            session.add_query(f"需要你总结的聊天记录如下：{chat_text}")
-            result = self.bot.reply_text(session)
-            
-            total_tokens, completion_tokens, reply_content = (
-                result['total_tokens'],
-                result['completion_tokens'],
-                result['content']
-            )
-            logger.debug("[Summary] tokens(total=%d, completion=%d)", total_tokens, completion_tokens)
+        except Exception as e:
+            logger.error("[Summary] Error generating summary: %s", str(e))
+            return [Reply(ReplyType.TEXT, "生成总结时发生错误，请稍后重试")]
 
-            if completion_tokens == 0:
-                return Reply(ReplyType.TEXT, "生成总结失败，请稍后重试")
+    def _get_cached_report(self, session_id: str, start_time: int) -> Optional[dict]:
+        """获取可以增量更新的上次报告，要求本次的起始时间落在上次报告覆盖的范围内"""
+        cached = self._report_cache.get(session_id) or self._load_digest(session_id)
+        if cached and cached["start_time"] <= start_time <= cached["watermark"]:
+            return cached
+        return None
 
-            # 记录本次总结时间
-            self.db.save_summary_time(session_id, int(time.time()))
+    def _report_replies(self, session_id: str, report: str) -> List[Reply]:
+        """把报告渲染为图片回复，渲染失败时回复文本"""
+        try:
+            with self.metrics.timer("render", session_id):
+                images = self.convert_text_to_images(report)
+            return [Reply(ReplyType.IMAGE, io.BytesIO(image)) for image in images]
+        except Exception as e:
+            self.metrics.incr("render_failures", session_id=session_id)
+            logger.error("[Summary] Failed to convert text to image: %s", str(e))
+            return [Reply(ReplyType.TEXT, report)]
+
+    def _load_digest(self, session_id: str) -> Optional[dict]:
+        """内存中没有上次的报告时(例如重启之后)，取数据库中未过期的预生成报告放入缓存"""
+        try:
+            digest = self.db.get_digest(session_id)
+        except Exception as e:
+            logger.warning("[Summary] load digest of %s failed: %s", session_id, e)
+            return None
+        if digest is None or digest["created"] < time.time() - self.config.get("report_cache_ttl", 24 * 60) * 60:
+            return None
+        report = {
+            "report": digest["report"],
+            "start_time": digest["start_time"],
+            "watermark": digest["watermark"],
+            "watermark_id": digest["watermark_id"],
+            "topics": None,
+            "digest": True,
+        }
+        self._report_cache.set(session_id, report)
+        return report
+
+    def _group_by_topic(self, session_id: str, chat_logs: ChatLogs, segmenter: "topics.TopicSegmenter" = None) \
+            -> Tuple[ChatLogs, Optional["topics.TopicSegmenter"]]:
+        """
+        在本地把聊天记录按话题预先分组，返回整理成话题材料的聊天记录和分组状态，
+        未启用、没有安装numpy或者记录太少时原样返回
 
-            # 转换为图片
+        Args:
+            segmenter: 上次的分组状态，传入时新消息继续归入已有话题
+        """
+        if not self.config.get("topic_clustering", True) or not topics.available():
+            return chat_logs, segmenter
+        continued = segmenter is not None
+        if not continued:
+            if chat_logs.rows < self.config.get("topic_min_records", 50):
+                return chat_logs, None
+            segmenter = topics.TopicSegmenter(max_gap=self.config.get("topic_gap", 30) * 60)
+        start = time.time()
+        with self.metrics.timer("topics", session_id):
+            touched = segmenter.add(chat_logs.messages)
+            bundles = topics.build_topic_bundles(segmenter, touched, chat_logs.lines,
+                                                 max_lines=self.config.get("topic_max_lines", 20), continued=continued)
+        tokens = sum(estimate_tokens(bundle) + 1 for bundle in bundles)
+        logger.info("[Summary] grouped %d lines of %s into %d topics in %.2fs, tokens %d -> %d",
+                    len(chat_logs.lines), session_id, len(touched), time.time() - start, chat_logs.tokens, tokens)
+        if tokens >= chat_logs.tokens:
+            # 消息很少时分组的表头反而更占token，仍然提交原始记录，只保留分组状态
+            return chat_logs, segmenter
+        return chat_logs._replace(lines=bundles, tokens=tokens, grouped=True), segmenter
+
+    def _format_activity(self, session_id: str, start: int, end: int) -> str:
+        """从汇总表精确统计时间范围内的消息数、发言人和各时段热度，作为事实写进prompt，不让大模型自己数"""
+        top = self.config.get("top_speakers", 5)
+        if top <= 0:
+            return ""
+        try:
+            with self.metrics.timer("activity", session_id):
+                speakers = self.db.get_top_speakers(session_id, start, end, limit=None)
+                histogram = self.db.get_activity_histogram(session_id, start, end)
+        except Exception as e:
+            logger.warning("[Summary] query activity of %s failed: %s", session_id, e)
+            return ""
+        if not histogram:
+            return ""
+        # 没有发送者的消息计入总数，不算作发言人
+        speakers = [(user, count) for user, count in speakers if user]
+
+        total = sum(count for _, count in histogram)
+        if histogram[-1][0] - histogram[0][0] > 48 * 3600:
+            # 跨度太长时按天统计
+            days = {}
+            for hour, count in histogram:
+                day = time.strftime("%m-%d", time.localtime(hour))
+                days[day] = days.get(day, 0) + count
+            slots = "、".join(f"{day} {count}条" for day, count in days.items())
+        else:
+            same_day = time.strftime("%Y%m%d", time.localtime(histogram[0][0])) == \
+                time.strftime("%Y%m%d", time.localtime(histogram[-1][0]))
+            fmt = "%H时" if same_day else "%m-%d %H时"
+            slots = "、".join(f"{time.strftime(fmt, time.localtime(hour))} {count}条" for hour, count in histogram)
+        top_speakers = "、".join(f"{user}({count}条)" for user, count in speakers[:top])
+        return f"以下数字由程序根据完整的聊天记录精确统计，报告中的消息数、参与人数、各时段热度和最活跃的发言者请直接使用，" \
+               f"不要自己估算：\n消息总数：{total}条，发言人数：{len(speakers)}人\n" \
+               f"最活跃的前{min(top, len(speakers))}个发言者：{top_speakers}\n各时段消息数：{slots}\n\n"
+
+    def _merge_into_report(self, session_id: str, cached: dict, chat_logs: ChatLogs, start_time: int,
+                           progress: Callable[[str], None] = None, stats: str = "") -> Optional[str]:
+        """把上次报告之后的新消息合并进上次的报告"""
+        budget = self.config.get("chunk_tokens", 6000) - estimate_tokens(cached["report"])
+        if chat_logs.tokens > budget:
+            # 新消息太多时先分段整理成摘要再合并
+            chunks = split_into_chunks(chat_logs.lines, self.config.get("chunk_tokens", 6000))
+            if progress:
+                progress(f"新增聊天记录较多，已分成{len(chunks)}段并行总结，请稍等")
+            partials = self._summarize_chunks(session_id, chunks, progress, grouped=chat_logs.grouped)
+            if not partials:
+                return None
+            delta = "\n------------\n".join(partials)
+        else:
+            delta = "\n".join(chat_logs.lines)
+            if chat_logs.grouped:
+                delta = f"{GROUPED_LOGS_HINT}\n{delta}"
+
+        query = f"这是之前生成的群聊报告：\n{cached['report']}\n\n" \
+                f"下面是报告生成之后新增的聊天记录，请把新增内容合并进报告，" \
+                f"更新话题、热度、参与者、时间段和最活跃的发言者，输出完整的新报告。"
+        if start_time > cached["start_time"]:
+            begin = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time))
+            query += f"只保留{begin}之后仍有讨论的话题。"
+        return self._ask_llm(session_id, SUMMARY_PROMPT, f"{stats}{query}\n新增聊天记录如下：{delta}")
+
+    def _summarize_chat_logs(self, session_id: str, chat_logs: ChatLogs,
+                             progress: Callable[[str], None] = None, stats: str = "") -> Optional[str]:
+        """总结聊天记录，记录超出单次token预算时先分段并行总结，再合并成最终报告
+
+        Args:
+            stats: 程序统计好的活跃度数据，放在最终生成报告的prompt开头
+        """
+        chunk_tokens = self.config.get("chunk_tokens", 6000)
+        chunks = split_into_chunks(chat_logs.lines, chunk_tokens)
+        if len(chunks) == 1:
+            hint = GROUPED_LOGS_HINT if chat_logs.grouped else ""
+            return self._ask_llm(session_id, SUMMARY_PROMPT, f"{stats}{hint}需要你总结的聊天记录如下：{chunks[0]}")
+
+        # 分段摘要合起来仍然超出预算时继续分段归并
+        level = 1
+        while len(chunks) > 1:
+            logger.info("[Summary] summarizing %d chunks (level %d) for %s", len(chunks), level, session_id)
+            if progress:
+                progress(f"聊天记录较多，已分成{len(chunks)}段并行总结，请稍等")
+            # 只有第一轮的输入是话题材料，之后归并的是摘要
+            partials = self._summarize_chunks(session_id, chunks, progress, grouped=chat_logs.grouped and level == 1)
+            if not partials:
+                return None
+            merged = "\n------------\n".join(partials)
+            if estimate_tokens(merged) <= chunk_tokens:
+                break
+            next_chunks = split_into_chunks(partials, chunk_tokens)
+            if len(next_chunks) >= len(chunks):
+                # 摘要没有变短，继续归并没有意义
+                break
+            chunks = next_chunks
+            level += 1
+        else:
+            merged = chunks[0]
+
+        if progress:
+            progress("分段总结完成，正在生成最终报告")
+        return self._ask_llm(session_id, SUMMARY_PROMPT,
+                             f"{stats}以下是按时间顺序分段整理的群聊摘要，请据此生成报告：{merged}")
+
+    def _summarize_chunks(self, session_id: str, chunks: List[str], progress: Callable[[str], None] = None,
+                          grouped: bool = False) -> List[str]:
+        """在线程池中并行总结每一段，按原顺序返回成功的部分"""
+        hint = GROUPED_LOGS_HINT if grouped else ""
+        futures = {
+            self._llm_pool.submit(self._ask_llm, f"{session_id}#chunk{time.time()}-{i}", CHUNK_SUMMARY_PROMPT,
+                                  f"{hint}需要你整理的聊天记录如下：{chunk}", True, session_id): i
+            for i, chunk in enumerate(chunks)
+        }
+        partials = [None] * len(chunks)
+        done = 0
+        # 大约每完成四分之一汇报一次进度
+        report_every = max(len(chunks) // 4, 1)
+        for future in as_completed(futures):
+            i = futures[future]
+            done += 1
             try:
-                image_path = self.convert_text_to_image(reply_content)
-                reply = Reply(ReplyType.IMAGE, open(image_path, 'rb'))
-                os.remove(image_path)
-                return reply
+                partials[i] = future.result()
             except Exception as e:
-                logger.error("[Summary] Failed to convert text to image: %s", str(e))
-                # 如果图片转换失败，返回文本
-                return Reply(ReplyType.TEXT, reply_content)
+                logger.error("[Summary] chunk %d failed: %s", i, e)
+            if progress and done < len(chunks) and done % report_every == 0:
+                progress(f"总结进度：{done}/{len(chunks)}")
+        failed = partials.count(None)
+        if failed:
+            logger.warning("[Summary] %d of %d chunks failed", failed, len(chunks))
+        return [partial for partial in partials if partial]
+
+    def _ask_llm(self, session_id: str, prompt: str, query: str, temporary: bool = False,
+                 owner: str = None) -> Optional[str]:
+        """调用大模型，失败返回None
 
-        except Exception as e:
-            logger.error("[Summary] Error generating summary: %s", str(e))
-            return Reply(ReplyType.TEXT, "生成总结时发生错误，请稍后重试")
+        Args:
+            temporary: 是否为一次性会话，是则调用后清除会话
+            owner: 耗时和token计入哪个群，默认为session_id
+        """
+        owner = owner or session_id
+        session = self.bot.sessions.build_session(session_id, prompt)
+        self.metrics.incr("llm_calls", session_id=owner)
+        try:
+            session.add_query(query)
+            with self.metrics.timer("llm", owner):
+                result = self.bot.reply_text(session)
+        except Exception:
+            self.metrics.incr("llm_failures", session_id=owner)
+            raise
+        finally:
+            if temporary:
+                self.bot.sessions.clear_session(session_id)
+
+        total_tokens, completion_tokens, reply_content = (
+            result['total_tokens'],
+            result['completion_tokens'],
+            result['content']
+        )
+        logger.debug("[Summary] tokens(total=%d, completion=%d)", total_tokens, completion_tokens)
+        self.metrics.incr("llm_tokens", total_tokens, session_id=owner)
+        self.metrics.incr("llm_completion_tokens", completion_tokens, session_id=owner)
+        if completion_tokens == 0:
+            self.metrics.incr("llm_failures", session_id=owner)
+            return None
+        return reply_content
 
     def on_handle_context(self, e_context: EventContext):
         """处理上下文事件"""
@@ -484,9 +1181,12 @@ class Summary(Plugin):
         session_id = str(time.time())
         session = self.bot.sessions.build_session(session_id, system_prompt=TRANSLATE_PROMPT)
         session.add_query(text)
-        result = self.bot.reply_text(session)
+        self.metrics.incr("llm_calls")
+        with self.metrics.timer("translate"):
+            result = self.bot.reply_text(session)
         total_tokens, completion_tokens, reply_content = result['total_tokens'], result['completion_tokens'], \
                 result['content']
+        self.metrics.incr("llm_tokens", total_tokens)
         logger.debug("[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s" % (
                 total_tokens, completion_tokens, reply_content))
         if completion_tokens == 0:
@@ -503,66 +1203,70 @@ class Summary(Plugin):
         help_text += f"使用方法:输入\"{trigger_prefix}总结 最近消息数量\"，我会帮助你总结聊天记录。\n例如：\"{trigger_prefix}总结 100\"，我会总结最近100条消息。\n\n你也可以直接输入\"{trigger_prefix}总结前99条信息\"或\"{trigger_prefix}总结3小时内的最近10条消息\"\n我会尽可能理解你的指令。"
         return help_text
 
-    def convert_text_to_image(self, text):
-        converter = Text2ImageConverter()
-        converter.setup_driver()
-        image_path = converter.convert_text_to_image(text)
-        converter.close()
-        return image_path
+    def convert_text_to_image(self, text) -> bytes:
+        """把总结文本渲染为PNG图片数据，相同的文本和样式直接取缓存"""
+        renderer = self.renderer
+        key = render_key(text, renderer.style)
+        image = self._render_cache.get(key)
+        if image is not None:
+            self.metrics.incr("render_cache_hits")
+            return image
+        self.metrics.incr("render_cache_misses")
+        image = renderer.render(text)
+        self._render_cache.set(key, image)
+        return image
+
+    def convert_text_to_images(self, text) -> List[bytes]:
+        """按话题分页渲染，每页一张图片，渲染器支持时多页并行渲染"""
+        pages = split_pages(text, self.config.get("image_page_topics", 5))
+        if len(pages) == 1 or not (self.config.get("render_parallel", True) and self.renderer.parallel):
+            return [self.convert_text_to_image(page) for page in pages]
+        return list(self._render_pool.map(self.convert_text_to_image, pages))
+
+    def _get_in_progress_reply(self, session_id: str) -> Optional[Reply]:
+        """获取正在处理中的回复，防抖期内重复触发返回None"""
+        content = self._reply_pool.get(KIND_IN_PROGRESS, session_id,
+                                       debounce=self.config.get("reply_debounce", 60))
+        return Reply(ReplyType.TEXT, content) if content else None
+
+    def _get_rate_limit_reply(self, session_id: str, debounce: float) -> Optional[Reply]:
+        """获取频率限制的回复，防抖期内重复触发返回None"""
+        content = self._reply_pool.get(KIND_RATE_LIMIT, session_id, debounce=debounce)
+        return Reply(ReplyType.TEXT, content) if content else None
+
+    def _generate_replies(self, kind: str) -> List[str]:
+        """空闲时调用大模型批量生成拒绝场景的回复，补充回复池"""
+        prompt = REPEAT_SUMMARY_PROMPT if kind == KIND_RATE_LIMIT else SUMMARY_IN_PROGRESS_PROMPT
+        query = "问题：重复总结请求" if kind == KIND_RATE_LIMIT else "问题：总结好了没有"
+        content = self._ask_llm(f"summary-replies-{kind}", prompt,
+                                f"{query}\n请一次给出10条不同角色口吻的回答，每行一条，不要编号", True)
+        return parse_generated_replies(content)
 
-    def _get_in_progress_reply(self, session_id: str, content: str) -> Reply:
-        """获取正在处理中的回复"""
-        try:
-            session = self.bot.sessions.build_session(session_id, SUMMARY_IN_PROGRESS_PROMPT)
-            session.add_query(f"问题：{content}")
-            result = self.bot.reply_text(session)
-            
-            total_tokens, completion_tokens, reply_content = (
-                result['total_tokens'],
-                result['completion_tokens'],
-                result['content']
-            )
-            
-            logger.debug(
-                "[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s",
-                total_tokens, completion_tokens, reply_content
-            )
-            
-            if completion_tokens == 0:
-                return Reply(ReplyType.TEXT, "正在总结中，请稍后再试")
-            return Reply(ReplyType.TEXT, reply_content)
-            
-        except Exception as e:
-            logger.error(f"[Summary] Failed to get in progress reply: {e}")
-            return Reply(ReplyType.TEXT, "正在总结中，请稍后再试")
+def _send_info(e_context: EventContext, content: str):
+    _send_reply(e_context, Reply(ReplyType.TEXT, content))
 
-    def _get_rate_limit_reply(self, session_id: str) -> Reply:
-        """获取频率限制的回复"""
-        try:
-            session = self.bot.sessions.build_session(session_id, REPEAT_SUMMARY_PROMPT)
-            session.add_query("问题：重复总结请求")
-            result = self.bot.reply_text(session)
-            
-            total_tokens, completion_tokens, reply_content = (
-                result['total_tokens'],
-                result['completion_tokens'],
-                result['content']
-            )
-            
-            logger.debug(
-                "[Summary] total_tokens: %d, completion_tokens: %d, reply_content: %s",
-                total_tokens, completion_tokens, reply_content
-            )
-            
-            if completion_tokens == 0:
-                return Reply(ReplyType.ERROR, "地主家的驴都没我累，请让我休息一会儿")
-            return Reply(ReplyType.TEXT, reply_content)
-            
-        except Exception as e:
-            logger.error(f"[Summary] Failed to get rate limit reply: {e}")
-            return Reply(ReplyType.TEXT, "请稍后再试")
 
-def _send_info(e_context: EventContext, content: str):
-    reply = Reply(ReplyType.TEXT, content)
+def _send_replies(e_context: EventContext, replies: List[Reply]):
+    for reply in replies:
+        _send_reply(e_context, reply)
+
+
+def _track_newest(rows, newest: dict):
+    """产出去掉末尾rowid列的记录，记录按时间倒序，第一条的时间和读到的最大rowid存入newest"""
+    for row in rows:
+        if not newest:
+            # 迁移到版本3之前时间存为文本
+            newest["timestamp"], newest["rowid"] = int(row[1]), row[-1]
+        elif row[-1] > newest["rowid"]:
+            newest["rowid"] = row[-1]
+        yield row[:-1]
+
+
+def _flight_targets(flight: dict) -> List[EventContext]:
+    """一次总结的发起人和挂上来的请求，预生成报告没有发起人"""
+    return ([flight["e_context"]] if flight["e_context"] is not None else []) + flight["waiters"]
+
+
+def _send_reply(e_context: EventContext, reply: Reply):
     channel = e_context["channel"]
     channel.send(reply, e_context["context"])
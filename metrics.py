@@ -0,0 +1,254 @@
+# encoding:utf-8
+"""
+插件内置的运行指标：总结流程各阶段的耗时、收消息和调用大模型等计数，支持按群细分。
+耗时保留最近若干次的样本用于计算p50/p95，同时按固定区间累计直方图，可以定期导出为Prometheus文本格式的文件。
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from common.log import logger
+
+# 耗时直方图的区间上限(单位秒)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 批量写库条数的区间上限
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 200, 500, 1000, 5000)
+
+# 状态指令中列出的阶段，按总结流程的顺序排列
+STAGES = (
+    ("summary", "总结总耗时"),
+    ("digest", "低峰期预生成"),
+    ("queue_wait", "排队"),
+    ("parse", "解析指令"),
+    ("translate", "大模型解析指令"),
+    ("select", "读取记录"),
+    ("topics", "话题分组"),
+    ("activity", "活跃度统计"),
+    ("llm", "单次大模型调用"),
+    ("render", "生成图片"),
+    ("browser_wait", "等待浏览器"),
+    ("browser_start", "启动浏览器"),
+    ("db_write", "批量写库"),
+)
+# 插件启动和首次使用时创建组件的耗时，各只有一次，状态指令中单独一行列出
+STARTUP_STAGES = (
+    ("import", "导入模块"),
+    ("init", "初始化"),
+    ("renderer_init", "首次创建渲染器"),
+    ("bot_init", "首次创建大模型客户端"),
+)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "recent")
+
+    def __init__(self, buckets: tuple, window: int):
+        self.buckets = buckets
+        # 最后一个是+Inf区间
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """最近样本的分位数"""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Metrics:
+    def __init__(self, window: int = 200, max_sessions: int = 500):
+        """
+        :param window: 计算p50/p95时使用的最近样本数
+        :param max_sessions: 最多按多少个群细分，超出后新的群只计入总数，避免指标无限增长
+        """
+        self.window = window
+        self.max_sessions = max_sessions
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # (指标名, 群) -> 直方图或计数，群为None的是总数
+        self._histograms: Dict[Tuple[str, Optional[str]], _Histogram] = {}
+        self._counters: Dict[Tuple[str, Optional[str]], float] = {}
+        self._sessions = set()
+        self._export_thread = None
+
+    def observe(self, name: str, value: float, session_id: str = None, buckets: tuple = SECONDS_BUCKETS):
+        """记录一个样本，耗时类指标的name以_seconds结尾"""
+        with self._lock:
+            for key in self._keys(name, session_id):
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram(buckets, self.window)
+                histogram.observe(value)
+
+    def incr(self, name: str, value: float = 1, session_id: str = None):
+        with self._lock:
+            for key in self._keys(name, session_id):
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str, session_id: str = None):
+        """记录代码块的耗时，出错时也会记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage + "_seconds", time.perf_counter() - start, session_id)
+
+    def quantiles(self, name: str, session_id: str = None) -> Tuple[int, Optional[float], Optional[float]]:
+        """返回(总次数, 最近样本的p50, p95)"""
+        with self._lock:
+            histogram = self._histograms.get((name, session_id))
+            if histogram is None:
+                return 0, None, None
+            return histogram.count, histogram.quantile(0.5), histogram.quantile(0.95)
+
+    def counter(self, name: str, session_id: str = None) -> float:
+        with self._lock:
+            return self._counters.get((name, session_id), 0)
+
+    def format_status(self, session_id: str = None) -> str:
+        """状态指令的回复，列出各阶段最近的p50/p95和主要计数"""
+        lines = [f"总结插件运行状态(已运行{_format_duration(time.time() - self.started)}，分位数取最近{self.window}次)"]
+        startup = []
+        for stage, label in STARTUP_STAGES:
+            count, p50, _ = self.quantiles(stage + "_seconds")
+            if count:
+                startup.append(f"{label}{_format_seconds(p50)}")
+        if startup:
+            lines.append("启动耗时：" + "，".join(startup))
+        for stage, label in STAGES:
+            count, p50, p95 = self.quantiles(stage + "_seconds")
+            if count:
+                lines.append(f"{label}：p50 {_format_seconds(p50)}，p95 {_format_seconds(p95)}，共{count}次")
+        batches, _, _ = self.quantiles("db_batch_size")
+        received = self.counter("messages_ingested")
+        line = f"收到消息：{int(received)}条"
+        if batches:
+            line += f"，分{batches}批写库"
+        lines.append(line)
+        lines.append(f"大模型：调用{int(self.counter('llm_calls'))}次，失败{int(self.counter('llm_failures'))}次，"
+                     f"消耗token {int(self.counter('llm_tokens'))}")
+        digests, hits = self.counter("digests"), self.counter("digest_hits")
+        if digests or hits:
+            lines.append(f"预生成报告：生成{int(digests)}次，直接回复{int(hits)}次")
+        coalesced, hits = self.counter("summary_coalesced"), self.counter("result_cache_hits")
+        if coalesced or hits:
+            lines.append(f"重复请求：合并到进行中的总结{int(coalesced)}次，直接用上次结果{int(hits)}次")
+        hits, misses = self.counter("render_cache_hits"), self.counter("render_cache_misses")
+        if hits or misses:
+            lines.append(f"图片缓存：命中{int(hits)}次，渲染{int(misses)}次")
+        failures = self.counter("render_failures")
+        if failures:
+            lines.append(f"图片生成失败：{int(failures)}次")
+        if session_id:
+            count, p50, p95 = self.quantiles("summary_seconds", session_id)
+            line = f"本群：收到消息{int(self.counter('messages_ingested', session_id))}条"
+            if count:
+                line += f"，总结{count}次，p50 {_format_seconds(p50)}，p95 {_format_seconds(p95)}"
+            tokens = self.counter("llm_tokens", session_id)
+            if tokens:
+                line += f"，消耗token {int(tokens)}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        """导出为Prometheus文本格式，按群细分的部分单独成为summary_session_前缀的指标"""
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+            counters = sorted(self._counters.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+            out = []
+            declared = set()
+            for (name, session_id), histogram in histograms:
+                if session_id is None:
+                    metric = "summary_" + name
+                    out.append(f"# TYPE {metric} histogram")
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        out.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                    out.append(f"{metric}_sum {histogram.sum:.6f}")
+                    out.append(f"{metric}_count {histogram.count}")
+                    continue
+                metric = "summary_session_" + name
+                if metric not in declared:
+                    declared.add(metric)
+                    out.append(f"# TYPE {metric} summary")
+                label = f'session="{_escape(session_id)}"'
+                for q in (0.5, 0.95):
+                    out.append(f'{metric}{{{label},quantile="{q}"}} {histogram.quantile(q):.6f}')
+                out.append(f"{metric}_sum{{{label}}} {histogram.sum:.6f}")
+                out.append(f"{metric}_count{{{label}}} {histogram.count}")
+            for (name, session_id), value in counters:
+                metric = ("summary_" if session_id is None else "summary_session_") + name + "_total"
+                if metric not in declared:
+                    declared.add(metric)
+                    out.append(f"# TYPE {metric} counter")
+                label = "" if session_id is None else f'{{session="{_escape(session_id)}"}}'
+                out.append(f"{metric}{label} {value:g}")
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path: str):
+        """先写临时文件再替换，采集方不会读到写了一半的文件"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def start_export(self, path: str, interval: float = 60):
+        """后台定期把指标写入path，供node_exporter的textfile采集器等读取"""
+        if self._export_thread is not None:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        def loop():
+            while True:
+                try:
+                    self.write_prometheus(path)
+                except Exception as e:
+                    logger.warning("[Summary] write metrics to %s failed: %s", path, e)
+                time.sleep(interval)
+
+        self._export_thread = threading.Thread(target=loop, name="summary-metrics-export", daemon=True)
+        self._export_thread.start()
+
+    def _keys(self, name: str, session_id: Optional[str]):
+        """需要更新的键：总数，以及未超出上限时该群的细分，需要持有锁调用"""
+        keys = [(name, None)]
+        if session_id is not None:
+            if session_id in self._sessions or len(self._sessions) < self.max_sessions:
+                self._sessions.add(session_id)
+                keys.append((name, session_id))
+        return keys
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    return f"{value * 1000:.0f}ms" if value < 1 else f"{value:.1f}s"
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds < 3600:
+        return f"{int(seconds // 60)}分钟"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f}小时"
+    return f"{seconds / 86400:.1f}天"
@@ -0,0 +1,137 @@
+# encoding:utf-8
+"""
+渲染结果的缓存，以文本和渲染样式的sha256为键。
+内存中保留最近用过的图片，磁盘上保留更多，两者都按总字节数淘汰最久未用的，
+重试、重发以及预生成的报告再次发送时不用重新渲染。
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from common.log import logger
+
+
+def render_key(text: str, style: str) -> str:
+    """同样的文本用同样的样式渲染，得到的图片相同"""
+    return hashlib.sha256((style + "\0" + text).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, directory: str = None, memory_bytes: int = 32 << 20, disk_bytes: int = 256 << 20):
+        """
+        :param directory: 磁盘缓存目录，None表示只缓存在内存中
+        :param memory_bytes: 内存中缓存的图片总字节数上限，0表示不用内存缓存
+        :param disk_bytes: 磁盘缓存的总字节数上限，0表示不用磁盘缓存
+        """
+        self.directory = directory
+        self.memory_bytes = max(int(memory_bytes), 0)
+        self.disk_bytes = max(int(disk_bytes), 0) if directory else 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # 磁盘上的文件及大小，按最近使用排序，第一次用到时才扫描目录
+        self._disk = None
+        self._disk_size = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        data = self._read(key)
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def set(self, key: str, data: bytes):
+        self._remember(key, data)
+        self._write(key, data)
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".png")
+
+    def _disk_index(self) -> OrderedDict:
+        """磁盘缓存的索引，按文件修改时间恢复使用顺序，需要持有锁调用"""
+        if self._disk is None:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".tmp"):
+                    # 上次写了一半的文件
+                    _remove(entry.path)
+                elif entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            entries.sort()
+            self._disk = OrderedDict((key, size) for _, key, size in entries)
+            self._disk_size = sum(self._disk.values())
+        return self._disk
+
+    def _read(self, key: str) -> Optional[bytes]:
+        if not self.disk_bytes:
+            return None
+        with self._lock:
+            index = self._disk_index()
+            if key not in index:
+                return None
+            index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 更新修改时间，重启后仍然按最近使用的顺序淘汰
+            os.utime(path)
+            return data
+        except OSError as e:
+            logger.warning("[Summary] read render cache %s failed: %s", path, e)
+            with self._lock:
+                self._disk_size -= self._disk.pop(key, 0)
+            return None
+
+    def _write(self, key: str, data: bytes):
+        if len(data) > self.disk_bytes:
+            return
+        with self._lock:
+            if key in self._disk_index():
+                return
+        path = self._path(key)
+        # 先写临时文件再替换，读到的总是完整的图片
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("[Summary] write render cache %s failed: %s", path, e)
+            _remove(tmp_path)
+            return
+        with self._lock:
+            self._disk_size += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            while self._disk_size > self.disk_bytes:
+                evicted, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                _remove(self._path(evicted))
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
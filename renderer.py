@@ -0,0 +1,248 @@
+# encoding:utf-8
+"""
+总结文本转图片的渲染器。
+默认使用Pillow在进程内离线渲染，不需要浏览器和网络；也可以通过配置 "renderer": "selenium" 切换为浏览器渲染。
+"""
+import io
+import os
+import re
+import time
+from typing import List, Optional, Tuple
+
+from common.log import logger
+
+# 常见系统中的中文字体和彩色emoji字体位置，按顺序查找第一个存在的
+CJK_FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+)
+EMOJI_FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf",
+    "/usr/share/fonts/noto/NotoColorEmoji.ttf",
+    "/usr/share/fonts/google-noto-emoji/NotoColorEmoji.ttf",
+    "/System/Library/Fonts/Apple Color Emoji.ttc",
+    "C:/Windows/Fonts/seguiemj.ttf",
+)
+# 位图emoji字体只能以固定字号加载，依次尝试
+EMOJI_FONT_SIZES = (109, 160, 136, 96, 64)
+
+# 报告中话题之间的分割线，分页时按独占一行的分割线切分
+REPORT_SEPARATOR = "------------"
+_SEPARATOR_LINE_RE = re.compile(r"^[ \t]*-{6,}[ \t]*$", re.M)
+
+# 一个emoji字符簇：键帽(1️⃣)、或emoji本体加上变体选择符、肤色、零宽连接的后续部分
+_EMOJI_CLUSTER_RE = re.compile(
+    "[0-9#*]\ufe0f?\u20e3"
+    "|[\U0001F000-\U0001FAFF\u2300-\u23FF\u2600-\u27BF\u2B00-\u2BFF\u3030\u303D\u3297\u3299]"
+    "[\ufe0f\U0001F3FB-\U0001F3FF]*"
+    "(?:\u200d[\U0001F000-\U0001FAFF\u2600-\u27BF][\ufe0f\U0001F3FB-\U0001F3FF]*)*"
+)
+
+
+def find_font(candidates) -> Optional[str]:
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class PillowRenderer:
+    """用Pillow把文本渲染成PNG，支持中文自动换行和彩色emoji"""
+
+    name = "pillow"
+    # 排版和画字持有GIL，PNG压缩和缩放时Pillow会释放GIL，多核时多页并行渲染仍能缩短耗时，单核时只会互相争抢
+    parallel = (os.cpu_count() or 1) > 1
+
+    def __init__(self, font_path: str = None, emoji_font_path: str = None, width: int = 800,
+                 font_size: int = 26, padding: int = 40, line_spacing: float = 1.5,
+                 background: str = "#ffffff", foreground: str = "#222222"):
+        from PIL import ImageFont, features
+
+        self.width = width
+        self.font_size = font_size
+        self.padding = padding
+        self.line_height = int(font_size * line_spacing)
+        self.background = background
+        self.foreground = foreground
+
+        font_path = font_path or find_font(CJK_FONT_CANDIDATES)
+        if font_path:
+            self.font = ImageFont.truetype(font_path, font_size)
+        else:
+            logger.warning("[Summary] no CJK font found, chinese text may not render, set font_path in config")
+            self.font = ImageFont.load_default()
+
+        self.emoji_font = None
+        emoji_font_path = emoji_font_path or find_font(EMOJI_FONT_CANDIDATES)
+        if emoji_font_path:
+            for size in EMOJI_FONT_SIZES:
+                try:
+                    self.emoji_font = ImageFont.truetype(emoji_font_path, size)
+                    break
+                except OSError:
+                    continue
+        if self.emoji_font is None:
+            logger.warning("[Summary] no emoji font found, emoji will be drawn as plain text")
+        # 字形图片缓存，同一个emoji只渲染一次
+        self._emoji_cache = {}
+        self._raqm = features.check_feature("raqm")
+        # 影响渲染结果的参数，作为渲染缓存键的一部分
+        self.style = "{}:{}:{}:{}:{}:{}:{}:{}:{}".format(self.name, width, font_size, padding, self.line_height,
+                                                         background, foreground, font_path, emoji_font_path)
+
+    def render(self, text: str) -> bytes:
+        """渲染文本，返回PNG图片数据"""
+        from PIL import Image, ImageDraw
+
+        start = time.time()
+        lines = self._layout(text.strip())
+        height = self.padding * 2 + self.line_height * max(len(lines), 1)
+        image = Image.new("RGBA", (self.width, height), self.background)
+        draw = ImageDraw.Draw(image)
+        y = self.padding
+        # 文字在行内垂直居中
+        text_offset = (self.line_height - self.font_size) // 2
+        for line in lines:
+            x = self.padding
+            # 连续的文字一次画完，逐字调用draw.text的开销比绘制本身还大
+            run, run_x = "", x
+            for cluster, width, is_emoji in line:
+                if is_emoji:
+                    if run:
+                        draw.text((run_x, y + text_offset), run, font=self.font, fill=self.foreground)
+                        run = ""
+                    glyph = self._emoji_image(cluster)
+                    image.paste(glyph, (x, y + (self.line_height - glyph.height) // 2), glyph)
+                else:
+                    if not run:
+                        run_x = x
+                    run += cluster
+                x += width
+            if run:
+                draw.text((run_x, y + text_offset), run, font=self.font, fill=self.foreground)
+            y += self.line_height
+
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="PNG", optimize=True)
+        logger.debug("[Summary] rendered %d lines in %.3fs", len(lines), time.time() - start)
+        return output.getvalue()
+
+    def _layout(self, text: str) -> List[List[Tuple[str, int, bool]]]:
+        """把文本拆成字符簇并按宽度折行，返回每行的(字符簇, 宽度, 是否emoji)"""
+        max_width = self.width - self.padding * 2
+        lines = []
+        for paragraph in text.split("\n"):
+            line, line_width = [], 0
+            for cluster, is_emoji in self._clusters(paragraph):
+                width = self._cluster_width(cluster, is_emoji)
+                if line and line_width + width > max_width:
+                    lines.append(line)
+                    line, line_width = [], 0
+                    if cluster == " ":
+                        continue
+                line.append((cluster, width, is_emoji))
+                line_width += width
+            lines.append(line)
+        return lines
+
+    def _clusters(self, text: str):
+        """拆分为字符簇：emoji按完整序列，其余按单个字符"""
+        pos = 0
+        for match in _EMOJI_CLUSTER_RE.finditer(text):
+            for ch in text[pos:match.start()]:
+                yield ch, False
+            cluster = match.group(0)
+            yield cluster, self.emoji_font is not None or cluster.endswith("\u20e3")
+            pos = match.end()
+        for ch in text[pos:]:
+            yield ch, False
+
+    def _cluster_width(self, cluster: str, is_emoji: bool) -> int:
+        if is_emoji:
+            return self._emoji_image(cluster).width + 2
+        return int(self.font.getlength(cluster))
+
+    def _emoji_image(self, cluster: str):
+        """渲染单个emoji并缩放到行高"""
+        glyph = self._emoji_cache.get(cluster)
+        if glyph is not None:
+            return glyph
+
+        from PIL import Image, ImageDraw
+
+        size = self.font_size
+        if cluster.endswith("\u20e3") and (not self._raqm or self.emoji_font is None):
+            # 没有raqm时无法组合键帽序列，手动画一个圆角方块
+            glyph = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(glyph)
+            draw.rounded_rectangle((0, 0, size - 1, size - 1), radius=size // 5, fill="#5b8def")
+            digit = cluster[0]
+            digit_width = self.font.getlength(digit)
+            draw.text(((size - digit_width) / 2, 0), digit, font=self.font, fill="#ffffff")
+        else:
+            left, top, right, bottom = self.emoji_font.getbbox(cluster)
+            raw = Image.new("RGBA", (max(right, 1), max(bottom, 1)), (0, 0, 0, 0))
+            ImageDraw.Draw(raw).text((0, 0), cluster, font=self.emoji_font, embedded_color=True)
+            raw = raw.crop((max(left, 0), max(top, 0), max(right, 1), max(bottom, 1)))
+            scale = size / max(raw.height, 1)
+            glyph = raw.resize((max(int(raw.width * scale), 1), size), Image.LANCZOS)
+        self._emoji_cache[cluster] = glyph
+        return glyph
+
+
+class SeleniumRenderer:
+    """用常驻的无头浏览器加载本地模板渲染，需要安装chrome和selenium"""
+
+    name = "selenium"
+    # 多页可以同时交给池中的多个浏览器渲染
+    parallel = True
+
+    def __init__(self, pool_size: int = 2, max_renders: int = 50, timeout: int = 30, metrics=None):
+        from plugins.plugin_summary.text2img import TEMPLATE_PATH, BrowserPool
+
+        self.pool = BrowserPool(size=pool_size, max_renders=max_renders, timeout=timeout, metrics=metrics)
+        # 修改模板后旧的渲染缓存不再命中
+        self.style = "{}:{:.0f}".format(self.name, os.path.getmtime(TEMPLATE_PATH))
+
+    def render(self, text: str) -> bytes:
+        return self.pool.render(text)
+
+
+def split_pages(text: str, topics_per_page: int) -> List[str]:
+    """
+    按话题分割线把报告拆成多页，每页最多topics_per_page段，段数不超过时或topics_per_page<=0时不拆分。
+    最后一页只剩一段时并入前一页，避免结尾的活跃发言者统计单独成页
+    """
+    if topics_per_page <= 0:
+        return [text]
+    sections = [section.strip() for section in _SEPARATOR_LINE_RE.split(text)]
+    sections = [section for section in sections if section]
+    if len(sections) <= topics_per_page + 1:
+        return [text]
+    pages = [sections[i:i + topics_per_page] for i in range(0, len(sections), topics_per_page)]
+    if len(pages[-1]) == 1:
+        pages[-2].extend(pages.pop())
+    separator = "\n{}\n".format(REPORT_SEPARATOR)
+    return [separator.join(page) for page in pages]
+
+
+def create_renderer(config: dict, metrics=None):
+    """根据配置创建渲染器，未配置时使用Pillow"""
+    name = (config.get("renderer") or PillowRenderer.name).lower()
+    if name == SeleniumRenderer.name:
+        return SeleniumRenderer(pool_size=config.get("browser_pool_size", 2),
+                                max_renders=config.get("browser_max_renders", 50), metrics=metrics)
+    if name != PillowRenderer.name:
+        logger.warning("[Summary] unknown renderer %s, fallback to pillow", name)
+    return PillowRenderer(font_path=config.get("font_path"),
+                          emoji_font_path=config.get("emoji_font_path"),
+                          width=config.get("image_width", 800),
+                          font_size=config.get("image_font_size", 26))
@@ -0,0 +1,141 @@
+# encoding:utf-8
+"""
+限流、总结中等拒绝场景的快捷回复。
+回复从预先生成的候选池中轮流取用，候选池在空闲时由大模型后台补充并缓存到磁盘，
+拒绝路径本身不再调用大模型。
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from common.log import logger
+
+KIND_RATE_LIMIT = "rate_limit"
+KIND_IN_PROGRESS = "in_progress"
+
+# 没有缓存时使用的默认回复
+DEFAULT_REPLIES = {
+    KIND_RATE_LIMIT: [
+        "刚总结过，别催了，歇会儿吧",
+        "同样的活干两遍？想得美",
+        "总结过了，往上翻翻不行吗",
+        "地主家的驴都没我累，请让我休息一会儿",
+        "刚交完作业，下课再来",
+        "再催就罢工了啊",
+    ],
+    KIND_IN_PROGRESS: [
+        "正在总结中，别急别急",
+        "在写了在写了，催也没用",
+        "稍等，正在奋笔疾书",
+        "总结中，再催就重写",
+        "忙着呢，马上就好",
+        "正在总结中，请稍后再试",
+    ],
+}
+
+
+class ReplyPool:
+    def __init__(self, path: str, generator: Callable[[str], List[str]] = None, size: int = 30,
+                 refresh_interval: float = 6 * 3600, is_idle: Callable[[], bool] = None):
+        """
+        :param path: 候选回复的磁盘缓存文件
+        :param generator: 传入回复类型，返回一批新生成的回复，用于后台补充候选池
+        :param size: 每种回复保留的候选数量
+        :param refresh_interval: 后台补充的间隔(单位秒)
+        :param is_idle: 判断当前是否空闲，只在空闲时调用大模型补充
+        """
+        self.path = path
+        self.generator = generator
+        self.size = max(int(size), 1)
+        self.refresh_interval = refresh_interval
+        self.is_idle = is_idle
+        self._lock = threading.Lock()
+        self._replies = self._load()
+        # 每个(类型, 会话)最近一次回复的时间，用于防抖
+        self._last_sent: Dict[tuple, float] = {}
+        self._last_picked: Dict[str, str] = {}
+        if generator:
+            threading.Thread(target=self._refresh_loop, name="summary-reply-refresh", daemon=True).start()
+
+    def get(self, kind: str, session_id: str, debounce: float = 0) -> Optional[str]:
+        """
+        取一条回复，同一会话在debounce秒内重复触发时返回None，调用方应静默忽略
+
+        :param kind: 回复类型
+        :param session_id: 会话ID
+        :param debounce: 防抖时间(单位秒)
+        """
+        now = time.time()
+        with self._lock:
+            key = (kind, session_id)
+            if debounce > 0 and now - self._last_sent.get(key, 0) < debounce:
+                return None
+            self._last_sent[key] = now
+            candidates = self._replies.get(kind) or DEFAULT_REPLIES.get(kind) or ["请稍后再试"]
+            # 避免连续两次给出同一句
+            choices = [reply for reply in candidates if reply != self._last_picked.get(kind)] or candidates
+            reply = random.choice(choices)
+            self._last_picked[kind] = reply
+            return reply
+
+    def refresh(self):
+        """调用生成器为每种回复补充候选，并写入磁盘缓存"""
+        for kind in DEFAULT_REPLIES:
+            try:
+                generated = [reply for reply in self.generator(kind) if reply]
+            except Exception as e:
+                logger.warning("[Summary] generate %s replies failed: %s", kind, e)
+                continue
+            if not generated:
+                continue
+            with self._lock:
+                merged = list(dict.fromkeys(generated + self._replies.get(kind, [])))
+                self._replies[kind] = merged[:self.size]
+            logger.info("[Summary] refreshed %d %s replies", len(generated), kind)
+        self._save()
+
+    def _refresh_loop(self):
+        # 已有磁盘缓存时等一个周期再补充，否则尽快补充
+        next_refresh = time.time() + (self.refresh_interval if self._replies else 60)
+        while True:
+            time.sleep(30)
+            if time.time() < next_refresh:
+                continue
+            if self.is_idle and not self.is_idle():
+                continue
+            self.refresh()
+            next_refresh = time.time() + self.refresh_interval
+
+    def _load(self) -> Dict[str, List[str]]:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.warning("[Summary] load reply cache failed: %s", e)
+        return {}
+
+    def _save(self):
+        try:
+            with self._lock:
+                data = json.dumps(self._replies, ensure_ascii=False, indent=1)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning("[Summary] save reply cache failed: %s", e)
+
+
+def parse_generated_replies(text: str, max_length: int = 30) -> List[str]:
+    """把大模型一次生成的多行回复拆开，去掉序号和引号，丢弃过长的"""
+    replies = []
+    for line in (text or "").splitlines():
+        line = re.sub(r"^\s*(?:[-*•]|\d+[.、)）]|[（(]\d+[)）])\s*", "", line).strip().strip("\"'“”「」")
+        if line and len(line) <= max_length:
+            replies.append(line)
+    return replies
@@ -0,0 +1,102 @@
+# encoding:utf-8
+"""
+聊天记录的过期清理。
+按会话分小批删除过期记录，每批之间让出写锁，不会长时间阻塞收消息；
+可选在删除前把记录按天归档为gzip压缩的JSONL文件，删除后做增量VACUUM回收空间。
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+from common.log import logger
+
+
+class RecordArchive:
+    """
+    过期记录的归档，目录结构为 <目录>/<会话>/<日期>.jsonl.gz，每行一条记录。
+    同一天的文件多次追加时会产生多个gzip成员，gzip.open可以连续读出。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def write(self, session_id: str, rows: List[dict]):
+        """按记录的日期分组追加写入，写入失败时抛出异常，调用方不应删除这批记录"""
+        by_day: Dict[str, List[dict]] = {}
+        for row in rows:
+            day = time.strftime("%Y-%m-%d", time.localtime(row["timestamp"]))
+            by_day.setdefault(day, []).append(row)
+        session_dir = os.path.join(self.directory, self._safe_name(session_id))
+        with self._lock:
+            os.makedirs(session_dir, exist_ok=True)
+            for day, day_rows in by_day.items():
+                data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in day_rows)
+                with gzip.open(os.path.join(session_dir, day + ".jsonl.gz"), "ab") as f:
+                    f.write(data.encode("utf-8"))
+
+    @staticmethod
+    def _safe_name(session_id: str) -> str:
+        """群名可能包含路径中不允许的字符，替换后加上哈希避免不同的群撞名"""
+        name = re.sub(r"[^\w\-]+", "_", str(session_id)).strip("_")[:40] or "session"
+        return "{}_{}".format(name, hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:8])
+
+
+class RetentionPolicy:
+    def __init__(self, db, save_time: int = -1, overrides: Dict[str, int] = None,
+                 archive: Optional[RecordArchive] = None, batch_size: int = 500, vacuum_pages: int = 2000):
+        """
+        :param db: Db实例
+        :param save_time: 默认保留时间(单位分钟)，<=0表示永久保留
+        :param overrides: 按会话覆盖的保留时间(单位分钟)，<=0表示该会话永久保留
+        :param archive: 删除前归档，None表示不归档
+        :param batch_size: 每批删除的条数
+        :param vacuum_pages: 每次清理后最多回收的空闲页数
+        """
+        self.db = db
+        self.save_time = save_time
+        self.overrides = overrides or {}
+        self.archive = archive
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._running = threading.Lock()
+
+    def enabled(self) -> bool:
+        return self.save_time > 0 or any(minutes > 0 for minutes in self.overrides.values())
+
+    def save_time_of(self, session_id: str) -> int:
+        return self.overrides.get(session_id, self.save_time)
+
+    def run(self) -> int:
+        """清理所有会话的过期记录，返回删除的条数"""
+        if not self._running.acquire(blocking=False):
+            logger.info("[Summary] retention is already running, skip")
+            return 0
+        try:
+            if self.db.migrating:
+                # 在线迁移按rowid搬运数据，期间不删除，等下一轮
+                logger.info("[Summary] database migration in progress, skip retention")
+                return 0
+            start = time.time()
+            now = int(start)
+            deleted = 0
+            for session_id in self.db.list_sessions():
+                minutes = self.save_time_of(session_id)
+                if minutes <= 0:
+                    continue
+                writer = (lambda rows, session=session_id: self.archive.write(session, rows)) if self.archive else None
+                try:
+                    deleted += self.db.purge_records(now - minutes * 60, session_id, self.batch_size, writer)
+                except Exception as e:
+                    logger.error("[Summary] clean records of %s failed: %s", session_id, e)
+            freed = self.db.incremental_vacuum(self.vacuum_pages) if deleted else 0
+            logger.info("[Summary] retention deleted %d records, freed %d pages in %.2fs",
+                        deleted, freed, time.time() - start)
+            return deleted
+        finally:
+            self._running.release()
@@ -0,0 +1,289 @@
+# encoding:utf-8
+"""
+按token预算挑选聊天记录。
+先把表情、"哈哈哈"、复读等低信息量的消息折叠成一行，截断超长的粘贴，
+超出预算时把时间范围分成若干段分层抽样，每段内轮流从不同发言人中挑选。
+@提及和触发机器人的消息优先保留，但最多先占用一半预算，同样按时间分段抽样，剩余预算用不完时再补充。
+记录流式读取，超出预算后每段只保留有限的候选，内存只与预算有关，与时间范围内的记录数无关。
+"""
+import random
+import re
+import time
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+
+from plugins.plugin_summary.chunking import ChatLogs, estimate_tokens
+from plugins.plugin_summary.topics import MENTION_RE
+
+# 没有实际内容的短消息，连续出现时折叠
+_LOW_INFO_RE = re.compile(
+    r"^(?:[哈呵嘿嘻hH]+|2{0,2}3{2,}|笑死(?:了|我了)?|草+|[6６]+|\+1|1+|[嗯哦噢喔啊哇呀]+|ok|好的?|收到|是的?|对+|"
+    r"\[[^\[\]\s]{1,8}\]|[\W_]+)$",
+    re.IGNORECASE,
+)
+
+
+class _Entry:
+    __slots__ = ("timestamp", "newest", "users", "content", "rows", "keep", "low_info", "line", "tokens", "seq")
+
+    def __init__(self, user: str, timestamp: int, content: str, keep: bool, low_info: bool):
+        # 折叠后timestamp是其中最早一条的时间，newest是最晚一条的时间
+        self.timestamp = timestamp
+        self.newest = timestamp
+        self.users = [user]
+        self.content = content
+        self.rows = 1
+        self.keep = keep
+        self.low_info = low_info
+        self.line = ""
+        self.tokens = 0
+        # 到达的顺序，越大越早
+        self.seq = 0
+
+    def render(self, max_line_tokens: int):
+        create_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+        content = self.content
+        if max_line_tokens > 0 and estimate_tokens(content) > max_line_tokens:
+            # 按中文最坏情况截取，保证截断后不超过上限
+            content = f"{content[:max_line_tokens]}…(长消息已截断，原文{len(self.content)}字)"
+        if self.rows > 1:
+            names = "、".join(self.users[:3]) + (f"等{len(self.users)}人" if len(self.users) > 3 else "")
+            self.line = f"{names}({create_time}): {content} (连续{self.rows}条)"
+        else:
+            self.line = f"{self.users[0]}({create_time}): {content}"
+        self.tokens = estimate_tokens(self.line) + 1
+
+
+def select_chat_logs(records: Iterable[Tuple[str, int, str, int]], token_budget: int, buckets: int = 12,
+                     max_line_tokens: int = 200) -> ChatLogs:
+    """
+    从按时间倒序的 (user, timestamp, content, is_triggered) 记录中挑选不超过预算的聊天记录
+
+    :param records: 按时间倒序的记录，可以是数据库游标上的生成器
+    :param token_budget: token预算，<=0 表示不限制
+    :param buckets: 超出预算时把时间范围分成多少段抽样
+    :param max_line_tokens: 单条消息的token上限，超出的截断
+    """
+    buckets = max(int(buckets), 1)
+    sampler = _StreamSampler(token_budget, buckets)
+    newest = oldest = 0
+    total_rows = total_tokens = 0
+    for entry in _collapse(records):
+        entry.render(max_line_tokens)
+        total_rows += entry.rows
+        total_tokens += entry.tokens
+        newest = newest or entry.newest
+        oldest = entry.timestamp
+        sampler.add(entry)
+    if not total_rows:
+        return ChatLogs([], 0, 0, 0, False)
+
+    candidates = sampler.candidates()
+    if token_budget <= 0 or total_tokens <= token_budget:
+        selected = candidates
+    else:
+        selected = _stratified_sample(candidates, token_budget, buckets)
+
+    rows = sum(entry.rows for entry in selected)
+    tokens = sum(entry.tokens for entry in selected)
+    return ChatLogs(
+        lines=[entry.line for entry in selected],
+        rows=rows,
+        tokens=tokens,
+        newest=newest,
+        truncated=rows < total_rows,
+        dropped_rows=total_rows - rows,
+        dropped_tokens=total_tokens - tokens,
+        messages=[(entry.users, entry.timestamp, entry.content) for entry in selected],
+        oldest=oldest,
+    )
+
+
+def _collapse(records: Iterable[Tuple[str, int, str, int]]) -> Iterator[_Entry]:
+    """按时间倒序逐条产出，连续的低信息量消息和复读折叠成一条，折叠完成后才产出"""
+    later = None
+    seq = 0
+    for user, timestamp, content, is_triggered in records:
+        content = (content or "").strip()
+        keep = bool(is_triggered) or bool(MENTION_RE.search(content))
+        low_info = not keep and bool(_LOW_INFO_RE.match(content))
+        # 记录按时间倒序到达，前一条是时间上更晚的那条
+        if later is not None and not keep and not later.keep and \
+                (low_info and later.low_info or content == later.content):
+            later.rows += 1
+            later.timestamp = int(timestamp)
+            if user not in later.users:
+                later.users.insert(0, user)
+            if len(content) > len(later.content) and low_info:
+                later.content = content
+            continue
+        if later is not None:
+            yield later
+        seq += 1
+        later = _Entry(user, int(timestamp), content, keep, low_info)
+        later.seq = seq
+    if later is not None:
+        yield later
+
+
+class _StreamSampler:
+    """
+    按时间倒序接收折叠后的消息，留下供分层抽样的候选。
+    总token不超过预算时全部保留；超出后按距最新一条的时间分段，段宽从1秒起，段数超过buckets的两倍时
+    段宽加倍、相邻两段合并。每段按随机键只保留键最小的、token不超过两倍平均额度的消息(bottom-k抽样，合并后
+    仍是合并范围内的均匀抽样)，优先保留的消息和其余消息分开抽样
+    """
+
+    def __init__(self, token_budget: int, buckets: int):
+        self.token_budget = token_budget
+        self.max_bins = buckets * 2
+        self.bin_tokens = max(token_budget * 2 // buckets, 1)
+        # 随机数固定种子，同样的记录得到同样的抽样结果
+        self._random = random.Random(0)
+        self._entries = []
+        self._tokens = 0
+        # (段号, 是否优先保留) -> [token数, [(随机键, 消息)]]
+        self._bins = None
+        self._origin = 0
+        self._width = 1
+
+    def add(self, entry: _Entry):
+        if self._bins is None:
+            self._entries.append(entry)
+            self._tokens += entry.tokens
+            if 0 < self.token_budget < self._tokens:
+                # 超出预算，之后只保留候选
+                entries, self._entries = self._entries, []
+                self._bins = {}
+                self._origin = entries[0].newest
+                for item in entries:
+                    self._sample(item)
+            return
+        self._sample(entry)
+
+    def candidates(self) -> List[_Entry]:
+        """按时间正序返回候选"""
+        if self._bins is None:
+            entries = self._entries
+        else:
+            entries = [entry for _, items in self._bins.values() for _, entry in items]
+        return sorted(entries, key=lambda entry: -entry.seq)
+
+    def _sample(self, entry: _Entry):
+        index = (self._origin - entry.timestamp) // self._width
+        while index >= self.max_bins:
+            self._width *= 2
+            merged = {}
+            for (old_index, keep), (tokens, items) in self._bins.items():
+                target = merged.setdefault((old_index // 2, keep), [0, []])
+                target[0] += tokens
+                target[1].extend(items)
+            self._bins = merged
+            for key in merged:
+                self._trim(key, self.bin_tokens * 3 // 2)
+            index = (self._origin - entry.timestamp) // self._width
+        key = (index, entry.keep)
+        target = self._bins.setdefault(key, [0, []])
+        target[0] += entry.tokens
+        target[1].append((self._random.random(), entry))
+        # 超出额度一半以上时才整理，分摊排序的开销
+        self._trim(key, self.bin_tokens * 3 // 2)
+
+    def _trim(self, key: tuple, limit: int):
+        """段内token超过limit时只留下随机键最小的、token不超过额度的消息"""
+        target = self._bins[key]
+        if target[0] <= limit:
+            return
+        target[1].sort(key=lambda item: item[0])
+        kept = []
+        tokens = 0
+        for key, entry in target[1]:
+            if tokens + entry.tokens > self.bin_tokens:
+                continue
+            kept.append((key, entry))
+            tokens += entry.tokens
+        target[0], target[1] = tokens, kept
+
+
+def _stratified_sample(entries: List[_Entry], token_budget: int, buckets: int) -> List[_Entry]:
+    """
+    按时间分段、段内按发言人轮流抽样。必须保留的消息先用最多一半的预算抽样，
+    再用剩余预算抽样其余消息，最后还有剩余时补充必须保留的消息
+    """
+    selected = set()
+    first, last = entries[0].timestamp, entries[-1].timestamp
+    span = max(last - first, 1)
+    keep = [index for index, entry in enumerate(entries) if entry.keep]
+    used = _sample_groups(entries, keep, token_budget // 2, buckets, first, span, selected)
+    used += _sample_groups(entries, [index for index, entry in enumerate(entries) if not entry.keep],
+                           token_budget - used, buckets, first, span, selected)
+    _sample_groups(entries, [index for index in keep if index not in selected],
+                   token_budget - used, buckets, first, span, selected)
+    return [entries[index] for index in sorted(selected)]
+
+
+def _sample_groups(entries: List[_Entry], indexes: List[int], budget: int, buckets: int, first: int, span: int,
+                   selected: set) -> int:
+    """把indexes按时间分段，预算平均分给各段，用不完的部分再分给其他段，返回用掉的token数"""
+    groups = [[] for _ in range(buckets)]
+    for index in indexes:
+        groups[min((entries[index].timestamp - first) * buckets // span, buckets - 1)].append(index)
+    groups = [group for group in groups if group]
+
+    remaining = budget
+    while groups and remaining > 0:
+        quota = remaining // len(groups)
+        if quota <= 0:
+            break
+        spent = 0
+        next_groups = []
+        for group in groups:
+            taken = _take_round_robin(entries, group, quota, selected)
+            spent += taken
+            if group:
+                next_groups.append(group)
+        if spent == 0:
+            break
+        remaining -= spent
+        groups = next_groups
+    return budget - remaining
+
+
+def _take_round_robin(entries: List[_Entry], group: List[int], quota: int, selected: set) -> int:
+    """在一个时间段内按发言人轮流挑选，直到用完额度，group中只留下这次放不下的消息"""
+    by_user = {}
+    for index in group:
+        by_user.setdefault(entries[index].users[0], []).append(index)
+    queues = [_spread(indexes) for indexes in by_user.values()]
+    spent = 0
+    skipped = []
+    while queues:
+        next_queues = []
+        for queue in queues:
+            index = queue.popleft()
+            entry = entries[index]
+            if spent + entry.tokens <= quota:
+                selected.add(index)
+                spent += entry.tokens
+            else:
+                skipped.append(index)
+            if queue:
+                next_queues.append(queue)
+        queues = next_queues
+    group[:] = skipped
+    return spent
+
+
+def _spread(items: List[int]) -> deque:
+    """按二分的顺序重排，使任意前缀都大致均匀地分布在整个时间段内"""
+    result = deque()
+    ranges = deque([(0, len(items))])
+    while ranges:
+        low, high = ranges.popleft()
+        if low >= high:
+            continue
+        middle = (low + high) // 2
+        result.append(items[middle])
+        ranges.append((low, middle))
+        ranges.append((middle + 1, high))
+    return result
@@ -0,0 +1,216 @@
+# encoding:utf-8
+"""
+按会话分库存储。
+会话ID哈希到N个数据库文件，每个文件有自己的连接、写锁和后台写线程，
+不同群的写入、清理和总结查询互不阻塞。对外接口与Db相同。
+
+从单个chat.db迁移到分库，或者调整分库数量：
+    python -m plugins.plugin_summary.sharded_db --source plugins/plugin_summary/chat.db \
+        --target plugins/plugin_summary/shards --shards 4
+"""
+import argparse
+import os
+import sqlite3
+import time
+import zlib
+from typing import List
+
+from common.log import logger
+from plugins.plugin_summary.db import Db, content_text
+
+SHARD_FILE = "chat_{}.db"
+
+
+def shard_index(session_id, shards: int) -> int:
+    """会话所在的分库，用crc32而不是hash()，保证进程重启后结果不变"""
+    return zlib.crc32(str(session_id).encode("utf-8")) % shards
+
+
+class ShardedDb:
+    def __init__(self, directory: str, shards: int = 4, **kwargs):
+        """
+        :param directory: 分库文件所在目录
+        :param shards: 分库数量，修改后需要用迁移工具重新分配已有数据
+        :param kwargs: 传给每个Db的参数
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shards: List[Db] = [Db(os.path.join(directory, SHARD_FILE.format(i)), **kwargs)
+                                 for i in range(max(int(shards), 1))]
+
+    def shard(self, session_id) -> Db:
+        return self.shards[shard_index(session_id, len(self.shards))]
+
+    # 按会话路由的操作
+    def insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered=0):
+        self.shard(session_id).insert_record(session_id, msg_id, user, content, msg_type, timestamp, is_triggered)
+
+    def get_records(self, session_id, *args, **kwargs) -> list:
+        return self.shard(session_id).get_records(session_id, *args, **kwargs)
+
+    def iter_records(self, session_id, *args, **kwargs):
+        return self.shard(session_id).iter_records(session_id, *args, **kwargs)
+
+    def latest_rowid(self, session_id) -> int:
+        return self.shard(session_id).latest_rowid(session_id)
+
+    def find_users(self, session_id, names: list) -> list:
+        return self.shard(session_id).find_users(session_id, names)
+
+    def get_top_speakers(self, session_id, *args, **kwargs) -> list:
+        return self.shard(session_id).get_top_speakers(session_id, *args, **kwargs)
+
+    def get_activity_histogram(self, session_id, *args, **kwargs) -> list:
+        return self.shard(session_id).get_activity_histogram(session_id, *args, **kwargs)
+
+    def purge_records(self, before_timestamp: int, session_id, *args, **kwargs) -> int:
+        return self.shard(session_id).purge_records(before_timestamp, session_id, *args, **kwargs)
+
+    def save_summary_time(self, session_id, summary_time):
+        self.shard(session_id).save_summary_time(session_id, summary_time)
+
+    def get_summary_time(self, session_id):
+        return self.shard(session_id).get_summary_time(session_id)
+
+    def save_summary_stop(self, session_id):
+        self.shard(session_id).save_summary_stop(session_id)
+
+    def delete_summary_stop(self, session_id):
+        self.shard(session_id).delete_summary_stop(session_id)
+
+    def is_disabled(self, session_id) -> bool:
+        return self.shard(session_id).is_disabled(session_id)
+
+    def save_digest(self, session_id, *args, **kwargs):
+        self.shard(session_id).save_digest(session_id, *args, **kwargs)
+
+    def get_digest(self, session_id):
+        return self.shard(session_id).get_digest(session_id)
+
+    # 涉及所有分库的操作
+    @property
+    def disable_group(self) -> frozenset:
+        return frozenset().union(*(db.disable_group for db in self.shards))
+
+    @property
+    def schema_version(self) -> int:
+        return min(db.schema_version for db in self.shards)
+
+    @property
+    def migrating(self) -> bool:
+        return any(db.migrating for db in self.shards)
+
+    def wait_migrations(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        for db in self.shards:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not db.wait_migrations(remaining):
+                return False
+        return True
+
+    def list_sessions(self) -> list:
+        return [session_id for db in self.shards for session_id in db.list_sessions()]
+
+    def delete_records(self, start_timestamp) -> int:
+        return sum(db.delete_records(start_timestamp) for db in self.shards)
+
+    def incremental_vacuum(self, pages: int = 0) -> int:
+        return sum(db.incremental_vacuum(pages) for db in self.shards)
+
+    def flush(self):
+        for db in self.shards:
+            db.flush()
+
+    def close(self):
+        for db in self.shards:
+            db.close()
+
+
+def create_db(config: dict, directory: str, metrics=None):
+    """根据配置创建存储，db_shards大于1时按会话分库"""
+    kwargs = dict(metrics=metrics,
+                  batch_size=config.get("insert_batch_size", 200),
+                  flush_interval=config.get("insert_flush_interval", 1.0),
+                  queue_size=config.get("insert_queue_size", 10000),
+                  compress_threshold=config.get("compress_threshold", 256))
+    shards = config.get("db_shards", 1)
+    if shards > 1:
+        return ShardedDb(os.path.join(directory, "shards"), shards=shards, **kwargs)
+    return Db(os.path.join(directory, "chat.db"), **kwargs)
+
+
+def migrate(sources: List[str], target, batch_size: int = 5000) -> int:
+    """
+    把旧库中的聊天记录、总结时间和禁用列表拷贝到目标存储，返回拷贝的记录数。
+    源可以是单个chat.db，也可以是旧的分库文件(调整分库数量时)；源库只读，不会被修改。
+    """
+    target.wait_migrations()
+    targets = target.shards if isinstance(target, ShardedDb) else [target]
+    copied = 0
+    for source in sources:
+        conn = sqlite3.connect("file:{}?mode=ro".format(source), uri=True)
+        try:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_records)")}
+            if "session" in columns:
+                # 版本6之后的库：名称存在ID表中，较长的内容是压缩的
+                conn.create_function("summary_text", 1, content_text, deterministic=True)
+                c = conn.execute("SELECT s.name, r.msgid, u.name, summary_text(r.content), t.name, r.timestamp, "
+                                 "IFNULL(r.is_triggered, 0) FROM chat_records r "
+                                 "LEFT JOIN chat_session_ids s ON s.id = r.session "
+                                 "LEFT JOIN chat_user_ids u ON u.id = r.user "
+                                 "LEFT JOIN chat_type_ids t ON t.id = r.type ORDER BY r.rowid")
+            else:
+                c = conn.execute("SELECT sessionid, msgid, user, content, type, CAST(timestamp AS INTEGER), "
+                                 "IFNULL(is_triggered, 0) FROM chat_records ORDER BY rowid")
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                # 按目标分库分组后批量写入
+                grouped = {}
+                for row in rows:
+                    db = target.shard(row[0]) if isinstance(target, ShardedDb) else target
+                    grouped.setdefault(id(db), (db, []))[1].append(row)
+                for db, db_rows in grouped.values():
+                    db._write_batch(db_rows)
+                copied += len(rows)
+                logger.info("[Summary] copied {} records from {}".format(copied, source))
+            if "summary_time" in tables:
+                for session_id, summary_time in conn.execute("SELECT sessionid, summary_time FROM summary_time"):
+                    target.save_summary_time(session_id, summary_time)
+            if "summary_stop" in tables:
+                for (session_id,) in conn.execute("SELECT sessionid FROM summary_stop"):
+                    target.save_summary_stop(session_id)
+        finally:
+            conn.close()
+    for db in targets:
+        db.flush()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把聊天记录迁移到按会话分库的存储，或者调整分库数量")
+    parser.add_argument("--source", nargs="+", required=True, help="旧的数据库文件，可以有多个")
+    parser.add_argument("--target", required=True, help="分库目录，shards为1时为目标数据库文件")
+    parser.add_argument("--shards", type=int, default=4, help="分库数量")
+    args = parser.parse_args()
+
+    target_path = os.path.abspath(args.target)
+    for source in args.source:
+        if os.path.abspath(source).startswith(target_path):
+            parser.error("source {} is inside target, migrate into a new directory instead".format(source))
+    if args.shards > 1:
+        target = ShardedDb(target_path, shards=args.shards)
+    else:
+        target = Db(target_path)
+    start = time.time()
+    try:
+        copied = migrate(args.source, target)
+    finally:
+        target.close()
+    print("copied {} records in {:.1f}s".format(copied, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
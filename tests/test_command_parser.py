@@ -0,0 +1,57 @@
+# encoding:utf-8
+"""
+总结指令的本地解析。运行环境复用基准测试的harness，没有安装框架时使用其中的替身。
+
+    python tests/test_command_parser.py
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from harness import bootstrap  # noqa: E402
+
+bootstrap()
+
+from plugins.plugin_summary.command_parser import parse_summary_command  # noqa: E402
+
+HOUR = 3600
+
+# (指令, 期望的(消息数量, 时间范围))，None表示交给大模型解析
+CASES = (
+    # README的指令参考
+    ("$总结 999", (999, None)),
+    ("$总结 3 小时内消息", (None, 3 * HOUR)),
+    ("$总结 前九十九条", (99, None)),
+    ("$总结 一个半小时内的最近50条消息", (50, 90 * 60)),
+    ("$总结 3小时内", (None, 3 * HOUR)),
+    ("$总结 last 50 messages", (50, None)),
+    ("$总结 2 hours", (None, 2 * HOUR)),
+    # 帮助文本中的例子
+    ("$总结 100", (100, None)),
+    ("$总结前99条信息", (99, None)),
+    ("$总结3小时内的最近10条消息", (10, 3 * HOUR)),
+    # "聊天"中的"天"不是时间单位
+    ("$总结 聊天记录 3小时内", (None, 3 * HOUR)),
+    ("$总结 群聊天记录", (None, None)),
+    ("$总结 最近两天的聊天", (None, 2 * 24 * HOUR)),
+    ("$总结 半天", (None, 12 * HOUR)),
+    ("$总结 前3千条", (3000, None)),
+    ("$总结 帮我看看大家在吵什么", None),
+)
+
+
+class ParseSummaryCommandTest(unittest.TestCase):
+    def test_cases(self):
+        for text, expected in CASES:
+            with self.subTest(text=text):
+                self.assertEqual(parse_summary_command(text), expected)
+
+    def test_today(self):
+        now = time.mktime((2024, 5, 1, 10, 30, 0, 0, 0, -1))
+        self.assertEqual(parse_summary_command("$总结 今天的聊天记录", now=now), (None, 10 * HOUR + 30 * 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
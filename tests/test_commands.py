@@ -0,0 +1,204 @@
+# encoding:utf-8
+"""
+指令经过框架的完整流程：框架先把消息交给收消息入口，再交给处理入口。
+运行环境复用基准测试的harness，没有安装框架时使用其中的替身。
+
+    python tests/test_commands.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from harness import FakeChannel, FakeLLM, bootstrap, create_plugin, make_event  # noqa: E402
+
+bootstrap()
+
+GROUP = "测试群"
+
+
+class CommandFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix="summary-test-")
+        self.llm = FakeLLM()
+        self.channel = FakeChannel()
+        self.plugin = create_plugin(self.data_dir, self.llm, save_time=-1)
+        self.now = int(time.time())
+        self.msg_id = 0
+        for index in range(60):
+            self.receive("部署新版本{}".format(index), user="成员{}".format(index % 4), timestamp=self.now - 600 + index)
+        self.plugin.db.flush()
+
+    def tearDown(self):
+        # 等排队的总结做完再关库
+        self.wait_idle()
+        self.plugin.db.close()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def wait_idle(self, timeout: float = 30):
+        deadline = time.time() + timeout
+        while not self.plugin._job_queue.idle() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def event(self, text: str, user: str = "成员0", timestamp: int = None):
+        self.msg_id += 1
+        return make_event(text, GROUP, user, self.msg_id, timestamp or self.now, self.channel)
+
+    def receive(self, text: str, **kwargs):
+        self.plugin.on_receive_message(self.event(text, **kwargs))
+
+    def command(self, text: str):
+        """和框架一样先经过收消息入口，再交给处理入口"""
+        e_context = self.event(text)
+        self.plugin.on_receive_message(e_context)
+        self.plugin.on_handle_context(e_context)
+        return e_context
+
+    def replies(self, e_context) -> list:
+        """指令的回复，报告分成多页时由通道依次发送"""
+        reply = e_context.get("reply")
+        if reply is not None:
+            return [reply]
+        return [reply for _, context_id, reply in self.channel.replies if context_id == id(e_context["context"])]
+
+    def test_command_not_saved(self):
+        self.command("$总结")
+        contents = [row[3] for row in self.plugin.db.get_records(GROUP)]
+        self.assertNotIn("$总结", contents)
+        self.assertEqual(len(contents), 60)
+
+    def test_status_only_for_summary_command(self):
+        main = sys.modules["plugins.plugin_summary.main"]
+        with mock.patch.object(main.Util, "is_admin", return_value=True):
+            other = self.command("$天气 状态")
+            status = self.command("$总结 状态")
+        self.assertIsNone(other.get("reply"))
+        self.assertEqual(other.action, main.EventAction.CONTINUE)
+        self.assertEqual(status.get("reply").type.name, "TEXT")
+
+    def test_digest_served_without_llm(self):
+        self.plugin._generate_digest(GROUP)
+        calls = self.llm.calls
+        e_context = self.command("$总结")
+        replies = self.replies(e_context)
+        self.assertTrue(replies)
+        self.assertTrue(all(reply.type.name == "IMAGE" for reply in replies))
+        self.assertEqual(self.llm.calls, calls)
+        self.assertEqual(self.plugin.metrics.counter("digest_hits"), 1)
+
+    def test_unrecognized_command_translated_once(self):
+        with mock.patch.object(self.plugin, "_translate_text_to_commands",
+                               return_value='{"name": "none", "args": {}}') as translate:
+            for _ in range(2):
+                self.assertEqual(self.plugin._parse_summary_args("帮我看看大家在吵什么"), (None, None, None, None))
+        self.assertEqual(translate.call_count, 1)
+
+    def test_queued_digest_does_not_block_requests(self):
+        # 占满所有工作线程，预生成任务只能排队
+        release = threading.Event()
+        for index in range(self.plugin._job_queue.workers):
+            self.plugin._job_queue.submit("其他群{}".format(index), run=release.wait, on_result=lambda result: None)
+        digest = threading.Thread(target=self.plugin._run_digest, args=(GROUP, time.time() + 60))
+        try:
+            digest.start()
+            time.sleep(0.1)
+            e_context = self.command("$总结")
+        finally:
+            release.set()
+        # 排在预生成任务前面，而不是被告知正在总结
+        self.assertEqual(e_context["reply"].content, "正在加速生成总结，请稍等")
+        digest.join(10)
+        self.wait_idle()
+        replies = [reply for _, context_id, reply in self.channel.replies if context_id == id(e_context["context"])]
+        self.assertTrue(replies)
+        self.assertTrue(all(reply.type.name == "IMAGE" for reply in replies))
+        self.assertIsNotNone(self.plugin.db.get_summary_time(GROUP))
+
+    def test_shorter_window_joins_running_summary(self):
+        self.llm.latency = 0.3
+        first = self.command("$总结 3小时内")
+        shorter = self.command("$总结 2小时内")
+        longer = self.command("$总结 5小时内")
+        self.wait_idle()
+        self.assertEqual(self.plugin.metrics.counter("summary_coalesced"), 1)
+        self.assertIsNone(shorter.get("reply"))
+        self.assertEqual(longer.get("reply").type.name, "TEXT")
+        self.assertTrue(self.replies(first))
+
+    def test_same_second_message_in_next_report(self):
+        self.plugin._generate_summary(GROUP)
+        report = self.plugin._report_cache.get(GROUP)
+        # 与报告中最新一条消息同一秒、之后才写入的消息，下次增量总结时要包括进来
+        self.receive("同一秒的新消息", timestamp=report["watermark"])
+        calls = self.llm.calls
+        self.plugin._generate_summary(GROUP)
+        self.assertGreater(self.llm.calls, calls)
+        merged = self.plugin._report_cache.get(GROUP)
+        self.assertEqual(merged["watermark"], report["watermark"])
+        self.assertGreater(merged["watermark_id"], report["watermark_id"])
+
+    def test_late_message_in_next_report(self):
+        self.plugin._generate_summary(GROUP)
+        report = self.plugin._report_cache.get(GROUP)
+        # 报告之后才收到、时间比报告中最新一条消息早的消息
+        self.receive("晚到的消息", timestamp=report["watermark"] - 100)
+        with mock.patch.object(self.plugin, "_merge_into_report", wraps=self.plugin._merge_into_report) as merge:
+            self.plugin._generate_summary(GROUP)
+        self.assertEqual(merge.call_count, 1)
+        self.assertIn("晚到的消息", "\n".join(merge.call_args[0][2].lines))
+        merged = self.plugin._report_cache.get(GROUP)
+        self.assertEqual(merged["watermark"], report["watermark"])
+        self.assertEqual(merged["watermark_id"], self.plugin.db.latest_rowid(GROUP))
+
+    def test_truncated_new_messages_summarized_again(self):
+        self.plugin._generate_summary(GROUP)
+        for index in range(50):
+            self.receive("新版本上线后的问题反馈第{}条".format(index), timestamp=self.now - 100 + index)
+        # 新消息放不进预算时不在旧报告上合并，整个范围重新抽样，报告位置不越过没总结的消息
+        self.plugin.config["prompt_token_budget"] = 300
+        with mock.patch.object(self.plugin, "_merge_into_report", wraps=self.plugin._merge_into_report) as merge:
+            self.plugin._generate_summary(GROUP)
+        merge.assert_not_called()
+        self.assertEqual(self.plugin._report_cache.get(GROUP)["watermark_id"], self.plugin.db.latest_rowid(GROUP))
+
+    def test_repeat_request_served_from_result_cache(self):
+        self.command("$总结 @成员1")
+        self.wait_idle()
+        calls = self.llm.calls
+        # 默认限流期内，条件相同、没有新消息的请求直接用上次的报告
+        replies = self.replies(self.command("$总结 @成员1"))
+        self.assertTrue(replies)
+        self.assertTrue(all(reply.type.name == "IMAGE" for reply in replies))
+        self.assertEqual(self.llm.calls, calls)
+        self.assertEqual(self.plugin.metrics.counter("result_cache_hits"), 1)
+
+        # 同一秒内的新消息也让缓存失效
+        newest = self.plugin.db.get_records(GROUP, limit=1)[0][5]
+        self.receive("同一秒的新消息", user="成员1", timestamp=newest)
+        self.command("$总结 @成员1")
+        self.assertEqual(self.plugin.metrics.counter("result_cache_hits"), 1)
+
+    def test_timed_out_summary_not_counted(self):
+        self.plugin._job_queue.timeout = 0.2
+        self.llm.latency = 0.5
+        self.command("$总结")
+        self.wait_idle()
+        self.assertIsNone(self.plugin.db.get_summary_time(GROUP))
+        self.assertTrue(any("超时" in str(reply.content) for _, _, reply in self.channel.replies))
+
+        # 超时的任务生成的报告仍然留在缓存中，有新消息时才需要再总结，结果送达后计入总结次数
+        self.plugin._job_queue.timeout = 300
+        self.llm.latency = 0
+        self.receive("新消息")
+        self.command("$总结")
+        self.wait_idle()
+        self.assertIsNotNone(self.plugin.db.get_summary_time(GROUP))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# encoding:utf-8
+"""
+聊天记录库的写入。运行环境复用基准测试的harness，没有安装框架时使用其中的替身。
+
+    python tests/test_db.py
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from harness import bootstrap  # noqa: E402
+
+bootstrap()
+
+from plugins.plugin_summary.db import Db  # noqa: E402
+
+GROUP = "测试群"
+
+
+class WriteBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix="summary-test-")
+        # 后台线程不主动落盘，由测试调用flush
+        self.db = Db(os.path.join(self.data_dir, "chat.db"), flush_interval=60)
+        self.db.wait_migrations(30)
+        self.now = int(time.time())
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def insert(self, count: int, start: int = 0, **kwargs):
+        for msg_id in range(start, start + count):
+            fields = dict(user="成员{}".format(msg_id % 3), content="消息{}".format(msg_id), timestamp=self.now)
+            fields.update(kwargs)
+            self.db.insert_record(GROUP, msg_id, fields["user"], fields["content"], "TEXT", fields["timestamp"])
+
+    def test_bad_record_does_not_drop_batch(self):
+        self.insert(5)
+        self.insert(1, start=5, content={"不能存储": True})
+        self.insert(5, start=6)
+        self.db.flush()
+        msg_ids = sorted(row[1] for row in self.db.get_records(GROUP))
+        self.assertEqual(msg_ids, [0, 1, 2, 3, 4, 6, 7, 8, 9, 10])
+
+    def test_missing_user_is_stored(self):
+        # 放在整点的一小时内，发言统计读汇总表
+        hour = (self.now // 3600 - 2) * 3600
+        self.insert(5, timestamp=hour + 10)
+        self.insert(1, start=5, user=None, timestamp=hour + 20)
+        self.db.flush()
+        self.assertEqual(sorted(row[2] for row in self.db.get_records(GROUP)), ["", "成员0", "成员0", "成员1", "成员1", "成员2"])
+        speakers = dict(self.db.get_top_speakers(GROUP, hour, hour + 3600, limit=None))
+        self.assertEqual(sum(speakers.values()), 6)
+        self.assertEqual(speakers[""], 1)
+
+        # 删除时汇总表同步减掉
+        self.db.purge_records(hour + 3600, GROUP)
+        self.assertEqual(self.db.get_top_speakers(GROUP, hour, hour + 3600), [])
+
+    def test_locked_database_keeps_records(self):
+        self.insert(5)
+        with mock.patch.object(self.db, "_write_batch", side_effect=sqlite3.OperationalError("database is locked")):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.flush()
+        self.insert(1, start=5)
+        self.db.flush()
+        self.assertEqual(sorted(row[1] for row in self.db.get_records(GROUP)), [0, 1, 2, 3, 4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# encoding:utf-8
+"""
+按token预算挑选聊天记录。运行环境复用基准测试的harness，没有安装框架时使用其中的替身。
+
+    python tests/test_selector.py
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from harness import bootstrap  # noqa: E402
+
+bootstrap()
+
+from plugins.plugin_summary.chunking import estimate_tokens  # noqa: E402
+from plugins.plugin_summary.selector import select_chat_logs  # noqa: E402
+
+NOW = 1700000000
+
+
+def make_records(count: int, mention_ratio: float, interval: int = 12) -> list:
+    """按时间倒序的 (user, timestamp, content, is_triggered) 记录，其中一部分@了别人"""
+    rng = random.Random(1)
+    records = []
+    for index in range(count):
+        if rng.random() < mention_ratio:
+            content = "@成员{} 看一下这个问题".format(rng.randint(1, 9))
+        else:
+            content = "讨论部署细节第{}条，性能和稳定性".format(index)
+        records.append(("成员{}".format(rng.randint(1, 30)), NOW - index * interval, content, 0))
+    return records
+
+
+class SelectChatLogsTest(unittest.TestCase):
+    def test_mentions_capped_and_spread_over_time(self):
+        records = make_records(5000, 0.2)
+        logs = select_chat_logs(iter(records), 2000)
+        self.assertLessEqual(logs.tokens, 2000)
+        mentions = [message for message in logs.messages if "@" in message[2]]
+        mention_tokens = sum(estimate_tokens(line) + 1 for line in logs.lines if "@" in line)
+        # 必须保留的消息最多先占一半预算，其余消息够多时不再补充，并且和其他消息一样覆盖整个时间范围
+        self.assertLessEqual(mention_tokens, 1000)
+        self.assertGreater(logs.tokens - mention_tokens, 500)
+        hours = {(NOW - timestamp) // 3600 for _, timestamp, _ in mentions}
+        self.assertEqual(len(hours), (NOW - records[-1][1]) // 3600 + 1)
+
+    def test_mentions_fill_unused_budget(self):
+        logs = select_chat_logs(iter(make_records(2000, 1.0)), 2000)
+        self.assertGreater(logs.tokens, 1500)
+
+    def test_email_is_not_mention(self):
+        records = [("成员1", NOW - index, "发到 ops{}@example.com 了".format(index), 0) for index in range(500)]
+        logs = select_chat_logs(iter(records), 500)
+        self.assertLess(len(logs.messages), 500)
+        selected = {timestamp for _, timestamp, _ in logs.messages}
+        # 不当作必须保留的消息，按时间均匀抽样而不是只留最新的
+        self.assertLess(min(selected), NOW - 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
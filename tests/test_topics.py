@@ -0,0 +1,53 @@
+# encoding:utf-8
+"""
+聊天记录按话题预分组。运行环境复用基准测试的harness，没有安装框架时使用其中的替身。
+
+    python tests/test_topics.py
+"""
+import copy
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from harness import bootstrap  # noqa: E402
+
+bootstrap()
+
+from plugins.plugin_summary import topics  # noqa: E402
+
+NOW = 1700000000
+
+
+def make_batch(day: int, count: int = 40) -> list:
+    """一天的消息，每天讨论不同的话题"""
+    return [(["成员{}".format(index % 5)], NOW + day * 86400 + index * 30, "第{}天的话题讨论{}".format(day, index))
+            for index in range(count)]
+
+
+@unittest.skipUnless(topics.available(), "需要安装numpy")
+class TopicSegmenterTest(unittest.TestCase):
+    def test_state_does_not_grow_with_closed_topics(self):
+        segmenter = topics.TopicSegmenter(max_gap=1800)
+        sizes = []
+        for day in range(30):
+            # 和增量总结一样，每次在复制的状态上继续分组
+            segmenter = copy.deepcopy(segmenter)
+            touched = segmenter.add(make_batch(day))
+            self.assertTrue(touched)
+            sizes.append(len(pickle.dumps(segmenter)))
+        # 之前的话题都已结束，状态大小只和进行中的话题有关
+        self.assertLessEqual(sizes[-1], sizes[1] * 1.1)
+        self.assertLessEqual(len(segmenter._active), segmenter.max_active)
+
+    def test_topic_ids_keep_increasing(self):
+        segmenter = topics.TopicSegmenter(max_gap=1800)
+        first = {topic.id for topic, _ in segmenter.add(make_batch(0))}
+        second = {topic.id for topic, _ in segmenter.add(make_batch(1))}
+        self.assertFalse(first & second)
+        self.assertGreater(min(second), max(first))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,146 +4,87 @@ Date: 2024-11-11 17:42:22
 LastEditors: sineom h.sineom@gmail.com
 LastEditTime: 2024-11-21 18:15:04
 FilePath: /plugin_summary/text2img.py
-Description: 
+Description:
 
-Copyright (c) 2024 by sineom, All Rights Reserved. 
+Copyright (c) 2024 by sineom, All Rights Reserved.
 '''
+import atexit
 import os
+import pathlib
+import queue
+import threading
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.common.exceptions import WebDriverException
 import time
-import base64
 import logging
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 本地渲染模板，通过 window.renderSummary(text) 填充文本，完成后派发 summary-rendered 事件
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'summary.html')
+
+RENDER_SCRIPT = """
+const text = arguments[0];
+const done = arguments[arguments.length - 1];
+document.addEventListener('summary-rendered', function (e) { done(e.detail); }, {once: true});
+window.renderSummary(text);
+"""
+
 
 class Text2ImageConverter:
-    def __init__(self):
+    """单个无头浏览器实例，加载本地模板后可以反复渲染"""
+
+    def __init__(self, timeout: int = 30):
         self.driver = None
-        self.url = 'https://www.text2image.online/zh-cn/'
-        self.output_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
-        
+        self.timeout = timeout
+        self.url = pathlib.Path(TEMPLATE_PATH).as_uri()
+        # 已渲染的次数，浏览器池据此回收实例
+        self.renders = 0
+
     def setup_driver(self):
-        """初始化浏览器驱动"""
+        """初始化浏览器驱动并加载模板"""
         try:
             option = webdriver.ChromeOptions()
             option.add_argument('--headless')
             option.add_argument('--disable-gpu')
             option.add_argument('--no-sandbox')
             option.add_argument('--disable-dev-shm-usage')
-            option.add_argument('--remote-debugging-port=9222')
-            
+            option.add_argument('--hide-scrollbars')
+
             self.driver = webdriver.Chrome(options=option)
-            
+            self.driver.set_script_timeout(self.timeout)
+            self.driver.get(self.url)
+            # 等待模板脚本就绪
+            WebDriverWait(self.driver, self.timeout).until(
+                lambda driver: driver.execute_script("return typeof window.renderSummary === 'function'")
+            )
+            logger.info("Template loaded successfully")
+
         except WebDriverException as e:
             logger.error(f"Failed to initialize Chrome driver: {e}")
+            self.close()
             raise
 
-    def convert_text_to_image(self, text):
-        """将文本转换为图片"""
+    def convert_text_to_image(self, text) -> bytes:
+        """将文本转换为图片，返回PNG数据"""
         try:
-            # 打开网页
-            self.driver.get(self.url)
-            
-            # 等待页面完全加载
-            WebDriverWait(self.driver, 10).until(
-                lambda driver: driver.execute_script("return document.readyState") == "complete"
-            )
-            time.sleep(1)  # 额外等待以确保 JavaScript 完全执行
-            
-            logger.info("Website loaded successfully")
-
-            # 先处理底部链接下拉菜单
-            try:
-                select_element = WebDriverWait(self.driver, 10).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, "div.cell:nth-child(12) select"))
-                )
-                # 使用 JavaScript 来设置选择值，避免直接点击可能引起的问题
-                self.driver.execute_script("""
-                    let select = arguments[0];
-                    select.value = 'N';  // 假设 '1' 是"隐藏"选项的值
-                    select.dispatchEvent(new Event('change'));
-                """, select_element)
-                logger.info("Bottom link hidden")
-            except TimeoutException:
-                logger.warning("Bottom link dropdown menu not found")
-
-            # 等待文本框加载并确保它是可交互的
-            text_box = WebDriverWait(self.driver, 10).until(
-                EC.element_to_be_clickable((By.CSS_SELECTOR, 'textarea'))
-            )
-            logger.info("Text box found and clickable")
-
-            # 使用更可靠的方式清空文本框
-            try:
-                # 先尝试使用 JavaScript 清空
-                self.driver.execute_script("""
-                    let textarea = arguments[0];
-                    textarea.value = '';
-                    textarea.dispatchEvent(new Event('input'));
-                    textarea.dispatchEvent(new Event('change'));
-                """, text_box)
-                
-                # 再次检查并确保文本框为空
-                if text_box.get_attribute('value').strip():
-                    # 如果还有内容，使用键盘快捷键清空
-                    text_box.click()
-                    time.sleep(0.5)
-                    text_box.send_keys(Keys.CONTROL + "a")
-                    text_box.send_keys(Keys.DELETE)
-                    time.sleep(0.5)
-                
-                logger.info("Textarea cleared successfully")
-            except Exception as e:
-                logger.warning(f"Error clearing textarea: {e}")
-                # 如果清空失败，我们仍然继续执行，因为接下来的输入可能会覆盖现有内容
-
-            # 输入新文本
-            # 使用 JavaScript 设置文本，这样更可靠
-            self.driver.execute_script("arguments[0].value = arguments[1];", text_box, text)
-            # 触发必要的事件
-            self.driver.execute_script("""
-                let textarea = arguments[0];
-                textarea.dispatchEvent(new Event('input'));
-                textarea.dispatchEvent(new Event('change'));
-            """, text_box)
-            logger.info("Text input completed")
-
-            # 等待图片生成
-            img_element = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, 'img[alt="Image"]'))
-            )
-            # 确保图片已经更新（等待src属性变化）
-            time.sleep(0.7)
-            logger.info("Image generated")
-
-            # 获取并保存图片
-            img_base64_data = img_element.get_attribute('src').split(',')[1]
-            img_data = base64.b64decode(img_base64_data)
-            
-            # 确保输出目录存在
-            os.makedirs(self.output_dir, exist_ok=True)
-            
-            # 生成唯一的文件名
-            timestamp = time.strftime("%Y%m%d_%H%M%S")
-            image_path = os.path.join(self.output_dir, f'image_{timestamp}.png')
-            
-            with open(image_path, 'wb') as f:
-                f.write(img_data)
-            logger.info(f"Image saved to {image_path}")
-            return image_path
+            # 等待模板派发渲染完成事件，拿到卡片尺寸
+            size = self.driver.execute_async_script(RENDER_SCRIPT, text)
+            # 调整窗口让整张卡片都在视口内，否则超出部分截不到
+            self.driver.set_window_size(size['width'] + 40, size['height'] + 40)
+            image = self.driver.find_element(By.ID, 'card').screenshot_as_png
+            self.renders += 1
+            logger.info(f"Image generated, {size['width']}x{size['height']}")
+            return image
 
         except Exception as e:
             logger.error(f"Error during conversion: {e}")
             raise
-        
+
     def close(self):
         """关闭浏览器"""
         if self.driver:
@@ -152,12 +93,110 @@ class Text2ImageConverter:
                 logger.info("Browser closed successfully")
             except Exception as e:
                 logger.error(f"Error closing browser: {e}")
+            finally:
+                self.driver = None
+
+
+class BrowserPool:
+    """
+    预热的浏览器池，多个总结共用若干个常驻的浏览器实例。
+    实例渲染达到上限次数或者出错后会被关闭并重新创建。
+    """
+
+    def __init__(self, size: int = 2, max_renders: int = 50, timeout: int = 30, metrics=None):
+        """
+        :param size: 浏览器实例数量，也是同时渲染的上限
+        :param max_renders: 单个实例最多渲染多少次后回收，避免浏览器内存持续增长
+        :param timeout: 等待空闲实例和单次渲染的超时时间(单位秒)
+        :param metrics: 记录等待空闲实例和启动浏览器的耗时，None表示不记录
+        """
+        self.metrics = metrics
+        self.size = max(int(size), 1)
+        self.max_renders = max(int(max_renders), 1)
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._closed = False
+        # 后台预先启动浏览器，不阻塞插件加载
+        for _ in range(self.size):
+            threading.Thread(target=self._release, args=(None,), name="summary-browser-start", daemon=True).start()
+        # 进程退出时关闭浏览器，避免留下chrome进程
+        atexit.register(self.close)
+
+    def render(self, text) -> bytes:
+        """取一个空闲实例渲染文本，返回PNG数据"""
+        start = time.perf_counter()
+        try:
+            converter = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("no idle browser in pool")
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("browser_wait_seconds", time.perf_counter() - start)
+        if converter is None:
+            # 之前启动失败的位置，这里再尝试启动一次
+            converter = self._create()
+        try:
+            image = converter.convert_text_to_image(text)
+        except Exception:
+            converter.close()
+            self._release_async(None)
+            raise
+        if converter.renders >= self.max_renders:
+            converter.close()
+            self._release_async(None)
+        else:
+            # 渲染期间池已关闭时直接关掉
+            self._release(converter)
+        return image
+
+    def close(self):
+        """关闭池中空闲的浏览器，正在渲染和启动中的实例用完后关闭"""
+        self._closed = True
+        while True:
+            try:
+                converter = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if converter is not None:
+                converter.close()
+
+    def _create(self) -> Text2ImageConverter:
+        converter = Text2ImageConverter(timeout=self.timeout)
+        start = time.perf_counter()
+        try:
+            converter.setup_driver()
+            if self.metrics is not None:
+                self.metrics.observe("browser_start_seconds", time.perf_counter() - start)
+        except Exception:
+            # 启动失败时把空位还回去，下次渲染时重试
+            self._idle.put(None)
+            raise
+        return converter
+
+    def _release(self, converter):
+        """创建新实例(converter为None时)并放回池中"""
+        if converter is None:
+            if self._closed:
+                return
+            try:
+                converter = self._create()
+            except Exception as e:
+                logger.error(f"Failed to start browser: {e}")
+                return
+        if self._closed:
+            converter.close()
+        else:
+            self._idle.put(converter)
+
+    def _release_async(self, converter):
+        threading.Thread(target=self._release, args=(converter,), name="summary-browser-start", daemon=True).start()
+
 
 def main():
     converter = Text2ImageConverter()
     try:
         converter.setup_driver()
-        
+
         # 示例文本
         text = """
         本次总结了17条消息。
@@ -165,14 +204,17 @@ def main():
         - 一系列数字和乱码信息被发送
         - 提及"额外腐恶费"和"发热"
         - 请求妮可进行总结"""
-        
-        image_path = converter.convert_text_to_image(text)
+
+        image = converter.convert_text_to_image(text)
+        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.png')
+        with open(image_path, 'wb') as f:
+            f.write(image)
         print(f"Image generated successfully at: {image_path}")
-        
+
     except Exception as e:
         logger.error(f"Process failed: {e}")
     finally:
         converter.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
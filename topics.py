@@ -0,0 +1,259 @@
+# encoding:utf-8
+"""
+在调用大模型之前，先在本地把聊天记录按话题预先分组。
+用字符n-gram的TF-IDF向量计算消息和话题的相似度，再结合时间间隔、引用、@和同一个人连续发言等回复关系判断归属，
+每个话题预先统计好参与者和时间段，只挑代表性的发言交给大模型，减少prompt的token数。
+分组状态可以保留下来，之后的新消息继续归入已有话题，用于增量总结。
+
+需要安装numpy，没有安装时不做预分组。numpy在第一次用到时才导入，不拖慢插件加载。
+"""
+import re
+import time
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# 由available()在第一次调用时导入
+np = None
+_numpy_checked = False
+
+# 微信引用消息的格式：「某人：原消息」\n- - - - -\n回复内容
+_QUOTE_RE = re.compile(r"^「(?P<user>[^：:」]{1,32})[：:](?P<content>.*?)」\s*(?:-\s*)+", re.S)
+# @昵称，前面紧挨着英文字母或数字时是邮箱地址，不算提及
+MENTION_RE = re.compile(r"(?<![A-Za-z0-9._%+-])@([^\s@ ]{1,32})")
+_CJK_RUN_RE = re.compile(r"[一-鿿]+")
+_WORD_RE = re.compile(r"[a-z0-9_]{2,}")
+
+# 各种回复关系给相似度的加分
+QUOTE_BONUS = 0.5
+MENTION_BONUS = 0.3
+SAME_SPEAKER_BONUS = 0.2
+CONTINUITY_BONUS = 0.1
+# 同一个人连续发言、紧接上一条消息的时间窗口(单位秒)
+BURST_SECONDS = 120
+CONTINUITY_SECONDS = 60
+
+
+def available() -> bool:
+    """是否可以做预分组，第一次调用时导入numpy，使用TopicSegmenter之前需要先调用"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+        _numpy_checked = True
+    return np is not None
+
+
+def extract_grams(text: str) -> List[str]:
+    """提取中文的字符二元组和英文数字单词"""
+    text = text.lower()
+    grams = []
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            grams.append(run)
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    grams.extend(_WORD_RE.findall(text))
+    return grams
+
+
+class Topic:
+    def __init__(self, topic_id: int, timestamp: int):
+        self.id = topic_id
+        self.start = timestamp
+        self.end = timestamp
+        self.count = 0
+        self.participants = Counter()
+        # 话题内所有消息的词频之和
+        self.vector = None
+
+    def time_range(self) -> str:
+        start = time.strftime("%H:%M", time.localtime(self.start))
+        end = time.strftime("%H:%M", time.localtime(self.end))
+        return start if start == end else f"{start}-{end}"
+
+
+class TopicSegmenter:
+    def __init__(self, dims: int = 2048, max_gap: int = 1800, threshold: float = 0.15, max_active: int = 30):
+        """
+        :param dims: n-gram哈希后的向量维度
+        :param max_gap: 话题超过多久没有新消息就结束(单位秒)
+        :param threshold: 消息归入已有话题的最低得分，低于此值另起新话题
+        :param max_active: 同时进行中的话题上限，超出时结束最久没有消息的话题
+        """
+        self.dims = dims
+        self.max_gap = max_gap
+        self.threshold = threshold
+        self.max_active = max_active
+        # 只保留进行中的话题，结束的话题不会再有新消息，丢掉后分组状态的大小不随总结次数增长
+        self._active: List[Topic] = []
+        self._next_id = 0
+        # 文档频率，用于计算IDF，跨批次累计
+        self._df = np.zeros(dims, dtype=np.float32)
+        self._docs = 0
+        # 维度到n-gram的映射，用于给出话题关键词
+        self._grams: Dict[int, str] = {}
+        # 每个人最近一次发言所在的话题和时间
+        self._last_by_user: Dict[str, Tuple[Topic, int]] = {}
+        self._last: Optional[Tuple[Topic, int]] = None
+
+    def add(self, messages: List[Tuple[List[str], int, str]]) -> List[Tuple[Topic, List[int]]]:
+        """
+        按时间顺序把一批消息归入话题
+
+        :param messages: 按时间正序的 (发言人列表, 时间戳, 内容)，折叠的消息会有多个发言人
+        :return: 这批消息涉及的话题，以及每个话题包含的消息下标(按代表性从高到低)
+        """
+        if not messages:
+            return []
+        vectors = self._vectorize([content for _, _, content in messages])
+        self._df += (vectors > 0).sum(axis=0)
+        self._docs += len(messages)
+        idf = np.log((1 + self._docs) / (1 + self._df)).astype(np.float32) + 1
+
+        members: Dict[int, List[int]] = {}
+        scores: Dict[int, float] = {}
+        # 这批消息涉及的话题，可能在批次中途结束
+        topics: Dict[int, Topic] = {}
+        for index, (users, timestamp, content) in enumerate(messages):
+            timestamp = int(timestamp)
+            self._close_inactive(timestamp)
+            weighted = vectors[index] * idf
+            norm = float(np.linalg.norm(weighted))
+            topic, score = self._best_topic(users, timestamp, content, weighted, norm, idf)
+            if topic is None:
+                self._next_id += 1
+                topic = Topic(self._next_id, timestamp)
+                topic.vector = np.zeros(self.dims, dtype=np.float32)
+                self._active.append(topic)
+                score = 1.0
+            topic.vector += vectors[index]
+            topic.end = timestamp
+            topic.count += 1
+            topic.participants.update(users)
+            for user in users:
+                self._last_by_user[user] = (topic, timestamp)
+            self._last = (topic, timestamp)
+            topics[topic.id] = topic
+            members.setdefault(topic.id, []).append(index)
+            scores[index] = score
+
+        touched = []
+        for topic_id, indexes in members.items():
+            indexes.sort(key=lambda i: scores[i], reverse=True)
+            touched.append((topics[topic_id], indexes))
+        return touched
+
+    def keywords(self, topic: Topic, count: int = 3) -> List[str]:
+        if topic.vector is None or self._docs == 0:
+            return []
+        idf = np.log((1 + self._docs) / (1 + self._df)) + 1
+        weights = topic.vector * idf
+        best = np.argsort(weights)[::-1][:count]
+        return [self._grams[dim] for dim in best if weights[dim] > 0 and dim in self._grams]
+
+    def _vectorize(self, contents: List[str]):
+        """批量计算词频向量，n-gram按crc32哈希到固定维度"""
+        rows, cols = [], []
+        for row, content in enumerate(contents):
+            match = _QUOTE_RE.match(content)
+            if match:
+                content = content[match.end():]
+            for gram in extract_grams(content):
+                dim = zlib.crc32(gram.encode("utf-8")) % self.dims
+                self._grams.setdefault(dim, gram)
+                rows.append(row)
+                cols.append(dim)
+        vectors = np.zeros((len(contents), self.dims), dtype=np.float32)
+        if rows:
+            np.add.at(vectors, (np.array(rows), np.array(cols)), 1)
+        # 对词频取对数，避免刷屏的同一个词主导相似度
+        return np.log1p(vectors)
+
+    def _best_topic(self, users: List[str], timestamp: int, content: str, weighted, norm: float, idf):
+        """按相似度和回复关系给进行中的话题打分，返回得分最高且达到阈值的话题"""
+        if not self._active:
+            return None, 0
+        centroids = np.stack([topic.vector for topic in self._active]) * idf
+        norms = np.linalg.norm(centroids, axis=1)
+        if norm > 0:
+            scores = centroids @ weighted / np.maximum(norms * norm, 1e-6)
+        else:
+            scores = np.zeros(len(self._active), dtype=np.float32)
+        bonus = {}
+
+        def add_bonus(topic: Topic, value: float):
+            bonus[topic.id] = bonus.get(topic.id, 0) + value
+
+        quote = _QUOTE_RE.match(content)
+        if quote and quote.group("user") in self._last_by_user:
+            add_bonus(self._last_by_user[quote.group("user")][0], QUOTE_BONUS)
+        for name in set(MENTION_RE.findall(content)):
+            if name in self._last_by_user:
+                add_bonus(self._last_by_user[name][0], MENTION_BONUS)
+        last = self._last_by_user.get(users[0])
+        if last and timestamp - last[1] <= BURST_SECONDS:
+            add_bonus(last[0], SAME_SPEAKER_BONUS)
+        if self._last and timestamp - self._last[1] <= CONTINUITY_SECONDS:
+            # 没有可比较内容的消息(表情、短回复)跟着上一条走
+            add_bonus(self._last[0], CONTINUITY_BONUS if norm > 0 else self.threshold)
+
+        best, best_score = None, self.threshold
+        for topic, score in zip(self._active, scores):
+            score = float(score) + bonus.get(topic.id, 0)
+            if score >= best_score:
+                best, best_score = topic, score
+        return best, best_score
+
+    def _close_inactive(self, timestamp: int):
+        """结束太久没有新消息的话题，进行中的话题超出上限时结束最久没有消息的"""
+        active = [topic for topic in self._active if timestamp - topic.end <= self.max_gap]
+        if len(active) > self.max_active:
+            active.sort(key=lambda topic: topic.end)
+            active = active[-self.max_active:]
+        if len(active) < len(self._active):
+            # 结束的话题只在回复关系的加分中被引用，加分只给进行中的话题，一起丢掉
+            ids = {topic.id for topic in active}
+            self._last_by_user = {user: last for user, last in self._last_by_user.items() if last[0].id in ids}
+            if self._last and self._last[0].id not in ids:
+                self._last = None
+        self._active = active
+
+
+def build_topic_bundles(segmenter: TopicSegmenter, touched: List[Tuple[Topic, List[int]]], lines: List[str],
+                        max_lines: int = 20, min_size: int = 2, continued: bool = False) -> List[str]:
+    """
+    把分组结果整理成交给大模型的话题材料，每个话题一段
+
+    :param touched: TopicSegmenter.add 的返回值
+    :param lines: 和add时的消息一一对应的聊天记录行
+    :param max_lines: 每个话题最多附带多少条代表性发言
+    :param min_size: 消息数少于此值的话题归入零散消息
+    :param continued: 增量更新时标注哪些话题是之前已经出现过的
+    """
+    bundles = []
+    scattered = []
+    for topic, indexes in sorted(touched, key=lambda item: len(item[1]), reverse=True):
+        if topic.count < min_size:
+            scattered.extend(indexes)
+            continue
+        participants = "、".join(f"{name}({count})" for name, count in topic.participants.most_common(5))
+        header = f"【话题{topic.id}{'(延续)' if continued and topic.count > len(indexes) else ''}】" \
+                 f"时间：{topic.time_range()}，消息数：{topic.count}，参与者：{participants}"
+        keywords = segmenter.keywords(topic)
+        if keywords:
+            header += f"，关键词：{'、'.join(keywords)}"
+        chosen = sorted(indexes[:max_lines])
+        body = [lines[i] for i in chosen]
+        if len(indexes) > len(chosen):
+            body.append(f"(另有{len(indexes) - len(chosen)}条相关发言省略)")
+        bundles.append("\n".join([header] + body))
+    if scattered:
+        chosen = sorted(scattered[:max_lines])
+        body = [lines[i] for i in chosen]
+        if len(scattered) > len(chosen):
+            body.append(f"(另有{len(scattered) - len(chosen)}条零散发言省略)")
+        bundles.append("\n".join(["【零散消息】"] + body))
+    return bundles